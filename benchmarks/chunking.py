@@ -0,0 +1,171 @@
+"""
+Benchmark how many fragments survive typical edits with fixed and content-defined chunking: the share of a file's
+fragments after an edit whose text was already embedded before it (and so are cache hits), and how many have to be
+re-embedded.
+
+    python benchmarks/chunking.py --paths "embedit/**/*.py" --fragment-lines 20
+
+Each edit is applied to every file on its own, at a position drawn from a fixed seed, and the file is split before and
+after it, as `embedit index` does on a change.
+"""
+import glob
+import json
+import os
+import random
+from pathlib import Path
+from typing import Callable
+from typing import Optional
+from typing import Sequence
+
+import fire
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from embedit.behaviour.search.pipeline_components.a02_split import CHUNKING_MODES
+from embedit.behaviour.search.pipeline_components.a02_split import split_buffers
+
+console = Console()
+
+
+def read_files(patterns: Sequence[str]) -> dict[str, bytes]:
+    buffers = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path) and path not in buffers:
+                buffers[path] = Path(path).read_bytes()
+    return {path: buffer for path, buffer in buffers.items() if buffer.count(b"\n") >= 2}
+
+
+def insert_line_near_top(lines: list[bytes], rng: random.Random) -> list[bytes]:
+    i = rng.randrange(min(len(lines), 10))
+    return lines[:i] + [b"import something_new\n"] + lines[i:]
+
+
+def insert_block(lines: list[bytes], rng: random.Random) -> list[bytes]:
+    i = rng.randrange(len(lines))
+    block = [b"\n", b"def added(x):\n", b"    # A new helper\n", b"    return x + 1\n", b"\n"]
+    return lines[:i] + block + lines[i:]
+
+
+def delete_line(lines: list[bytes], rng: random.Random) -> list[bytes]:
+    i = rng.randrange(len(lines))
+    return lines[:i] + lines[i + 1:]
+
+
+def modify_line(lines: list[bytes], rng: random.Random) -> list[bytes]:
+    i = rng.randrange(len(lines))
+    return lines[:i] + [lines[i].rstrip(b"\n") + b"  # changed\n"] + lines[i + 1:]
+
+
+def append_lines(lines: list[bytes], rng: random.Random) -> list[bytes]:
+    return lines + [b"\n", b"print('appended')\n"]
+
+
+EDITS: dict[str, Callable[[list[bytes], random.Random], list[bytes]]] = {
+    "insert line near top": insert_line_near_top,
+    "insert block": insert_block,
+    "delete line": delete_line,
+    "modify line": modify_line,
+    "append": append_lines,
+}
+
+
+def fragment_texts(path: str, buffer: bytes, *, fragment_lines: int, chunking: str) -> list[bytes]:
+    table = split_buffers([Path(path)], [buffer], fragment_lines=fragment_lines, chunking=chunking)
+    return [bytes(buffer[start:end]) for start, end in zip(table.byte_starts, table.byte_ends)]
+
+
+def bench_edit(
+    buffers: dict[str, bytes], edit: str, chunking: str, *, fragment_lines: int, seed: int
+) -> dict:
+    rng = random.Random(seed)
+    before_total = 0
+    after_total = 0
+    hits = 0
+    lengths = []
+    for path, buffer in buffers.items():
+        before = fragment_texts(path, buffer, fragment_lines=fragment_lines, chunking=chunking)
+        edited = b"".join(EDITS[edit](buffer.splitlines(keepends=True), rng))
+        after = fragment_texts(path, edited, fragment_lines=fragment_lines, chunking=chunking)
+        known = set(before)
+        before_total += len(before)
+        after_total += len(after)
+        hits += sum(text in known for text in after)
+        lengths.extend(text.count(b"\n") or 1 for text in after)
+    return {
+        "edit": edit,
+        "chunking": chunking,
+        "files": len(buffers),
+        "fragments_before": before_total,
+        "fragments_after": after_total,
+        "mean_lines": float(np.mean(lengths)),
+        "cache_hits": hits,
+        "re_embedded": after_total - hits,
+        "hit_rate": hits / after_total if after_total else 1.0,
+        "re_embedded_per_file": (after_total - hits) / len(buffers),
+    }
+
+
+def print_report(results: list[dict]):
+    table = Table(title="Fragments reused after an edit")
+    columns = [
+        "Edit", "Chunking", "Files", "Fragments before", "Fragments after", "Mean lines", "Cache hits",
+        "Re-embedded", "Hit rate", "Re-embedded per file",
+    ]
+    for column in columns:
+        table.add_column(column, justify="left" if column in ("Edit", "Chunking") else "right")
+    for result in results:
+        table.add_row(
+            result["edit"],
+            result["chunking"],
+            str(result["files"]),
+            str(result["fragments_before"]),
+            str(result["fragments_after"]),
+            f"{result['mean_lines']:.1f}",
+            str(result["cache_hits"]),
+            str(result["re_embedded"]),
+            f"{result['hit_rate']:.1%}",
+            f"{result['re_embedded_per_file']:.2f}",
+        )
+    console.print(table)
+
+
+def main(
+    paths: Sequence[str] = ("embedit/**/*.py",),
+    fragment_lines: int = 20,
+    edits: Sequence[str] = tuple(EDITS),
+    seed: int = 0,
+    output: Optional[str] = None,
+):
+    """
+    Run the benchmark and print a report.
+    :param paths: Glob patterns of the files to edit.
+    :param fragment_lines: The fragment length to split with (the average length, for content-defined chunking).
+    :param edits: The edits to simulate, from: insert line near top, insert block, delete line, modify line, append.
+    :param seed: Seeds where in each file the edits are made.
+    :param output: Also write the results to this JSON file.
+    """
+    if isinstance(paths, str):
+        paths = tuple(paths.split(","))
+    if isinstance(edits, str):
+        edits = tuple(edits.split(","))
+    unknown = [edit for edit in edits if edit not in EDITS]
+    if unknown:
+        raise SystemExit(f"Unknown edits: {', '.join(unknown)}. Choose from: {', '.join(EDITS)}")
+    buffers = read_files(paths)
+    if not buffers:
+        raise SystemExit(f"No files match {', '.join(paths)}")
+    results = [
+        bench_edit(buffers, edit, chunking, fragment_lines=fragment_lines, seed=seed)
+        for edit in edits
+        for chunking in CHUNKING_MODES
+    ]
+    print_report(results)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
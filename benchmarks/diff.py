@@ -0,0 +1,141 @@
+"""
+Benchmark diffing and rendering the kind of files `transform` produces: large files with a few edits, and heavy
+rewrites.
+
+    python benchmarks/diff.py --sizes 1000,5000,20000 --rewrites 0.01,0.5,1.0
+
+Compares the previous approach (a `difflib.Differ` pass for the rendering and another for the stats) with a single
+`compute_diff` shared by both. The Differ baseline is skipped above `--baseline-max-lines`, as it can take minutes.
+"""
+import difflib
+import io
+import json
+import random
+import time
+from typing import Optional
+from typing import Sequence
+
+import fire
+from rich.console import Console
+from rich.table import Table
+
+from embedit.utils.diff import compute_diff
+from embedit.utils.diff import get_diff_stats
+from embedit.utils.diff import pretty_diff
+
+console = Console()
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma tau".split()
+
+
+def make_file(rng: random.Random, num_lines: int) -> list[str]:
+    lines = []
+    while len(lines) < num_lines:
+        name = "_".join(rng.sample(WORDS, 2))
+        lines += [
+            f"def {name}_{len(lines)}(x, y):",
+            f"    # {' '.join(rng.choices(WORDS, k=6))}",
+            f"    return x * {rng.randint(0, 99)} + y",
+            "",
+        ]
+    return lines[:num_lines]
+
+
+def rewrite(rng: random.Random, lines: list[str], fraction: float, *, block_lines: int = 50) -> list[str]:
+    """
+    Rewrite a fraction of the lines, in contiguous blocks (as a model rewriting whole functions would): mostly small
+    edits within lines, plus some insertions and deletions.
+    """
+    result = []
+    for start in range(0, len(lines), block_lines):
+        block = lines[start:start + block_lines]
+        if rng.random() >= fraction:
+            result += block
+            continue
+        for line in block:
+            kind = rng.random()
+            if kind < 0.8:
+                result.append(line.replace(" ", f" {rng.choice(WORDS)} ", 1) + f"  # {rng.choice(WORDS)}")
+            elif kind < 0.9:
+                result += [line + "  # unchanged", f"    log({rng.choice(WORDS)!r})"]
+    return result
+
+
+def differ_baseline(a: str, b: str):
+    # What wrapup used to do: a full Differ comparison for the rendering and another for the stats
+    list(difflib.Differ().compare(a.splitlines(), b.splitlines()))
+    list(difflib.Differ().compare(a.splitlines(), b.splitlines()))
+
+
+def timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def render(a: str, b: str):
+    diff = compute_diff(a, b)
+    get_diff_stats(a, b, diff=diff)
+    Console(file=io.StringIO(), width=120, force_terminal=True).print(pretty_diff(a, b, diff=diff))
+
+
+def main(
+    sizes: Sequence[int] = (1000, 5000, 20000),
+    rewrites: Sequence[float] = (0.01, 0.5, 1.0),
+    baseline_max_lines: int = 5000,
+    seed: int = 0,
+    render_output: bool = True,
+    output: Optional[str] = None,
+):
+    """
+    Run the benchmark and print a report.
+    :param sizes: Numbers of lines in the synthetic files.
+    :param rewrites: Fractions of lines to rewrite.
+    :param baseline_max_lines: The largest file to time the Differ baseline on.
+    :param seed: Seed for the synthetic files.
+    :param render_output: Also time rendering the diff with `pretty_diff`.
+    :param output: Also write the results to this JSON file.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    if isinstance(rewrites, (int, float)):
+        rewrites = (rewrites,)
+    rng = random.Random(seed)
+    results = []
+    for size in sizes:
+        for fraction in rewrites:
+            a_lines = make_file(rng, size)
+            a, b = "\n".join(a_lines), "\n".join(rewrite(rng, a_lines, fraction))
+            diff = compute_diff(a, b)
+            results.append(
+                {
+                    "lines": size,
+                    "rewritten": fraction,
+                    "added": diff.stats.added,
+                    "removed": diff.stats.removed,
+                    "differ_s": timed(differ_baseline, a, b) if size <= baseline_max_lines else None,
+                    "compute_diff_s": timed(compute_diff, a, b),
+                    "render_s": timed(render, a, b) if render_output else None,
+                }
+            )
+
+    table = Table(title="Diff benchmark")
+    for column in ["Lines", "Rewritten", "+/-", "Differ x2 (s)", "compute_diff (s)", "Render (s)"]:
+        table.add_column(column, justify="right")
+    for result in results:
+        table.add_row(
+            str(result["lines"]),
+            f"{result['rewritten']:.0%}",
+            f"+{result['added']}/-{result['removed']}",
+            "skipped" if result["differ_s"] is None else f"{result['differ_s']:.3f}",
+            f"{result['compute_diff_s']:.3f}",
+            "" if result["render_s"] is None else f"{result['render_s']:.3f}",
+        )
+    console.print(table)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,215 @@
+"""
+End-to-end benchmarks of `embedit search`, `transform` and `commit-msg` against the local stub API, over synthetic
+corpora of increasing size.
+
+    python benchmarks/e2e.py --sizes 10,100,1000 --runs 5 --latency 0.05
+
+Every command runs in a fresh process, as a user would run it, so timings include start-up, imports and cache I/O.
+No API keys are needed.
+"""
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+from typing import Sequence
+
+import fire
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from embedit.utils.stub_server import StubConfig
+from embedit.utils.stub_server import start_stub_server
+
+console = Console()
+
+# The same entry point as the `embedit` script, with this interpreter
+EMBEDIT = [sys.executable, "-c", "from embedit.cli import main; main()"]
+
+WORDS = (
+    "account address backoff batch buffer cache client config connection context count data delay embed entry error "
+    "event file fragment handler header index item key limit line list load lock log message model node offset "
+    "order parse path payload query queue record request response result retry schema search session size split "
+    "state status stream table task text thread timeout token total update user value version window worker"
+).split()
+
+
+def make_corpus(directory: Path, num_files: int, *, lines_per_file: int = 60, seed: int = 0) -> list[str]:
+    """
+    Write `num_files` Python-looking files of random identifiers and comments.
+    """
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(num_files):
+        lines = []
+        while len(lines) < lines_per_file:
+            name = "_".join(rng.sample(WORDS, 2))
+            args = ", ".join(rng.sample(WORDS, 2))
+            lines += [
+                f"def {name}_{i}_{len(lines)}({args}):",
+                f"    # {' '.join(rng.choices(WORDS, k=8))}",
+                f"    return {rng.choice(WORDS)} + {rng.choice(WORDS)}",
+                "",
+            ]
+        path = directory / f"module_{i:05d}.py"
+        path.write_text("\n".join(lines[:lines_per_file]) + "\n")
+        files.append(str(path))
+    return files
+
+
+def run(args: Sequence[str], *, env: dict, cwd: Optional[Path] = None) -> tuple[float, int]:
+    """
+    Run an embedit command in a fresh process.
+
+    :return: The wall time in seconds and the peak RSS of the process in bytes.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [*EMBEDIT, *args], env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr
+        )
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"embedit {' '.join(args[:1])} failed:\n{stderr.read().decode()[-4000:]}")
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return elapsed, rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def summarise(name: str, size: int, units: str, per_run: int, samples: list[tuple[float, int]]) -> dict:
+    timings = [elapsed for elapsed, _ in samples]
+    p50 = statistics.median(timings)
+    return {
+        "benchmark": name,
+        "files": size,
+        "runs": len(samples),
+        "p50_s": p50,
+        "p99_s": float(np.percentile(timings, 99)),
+        "throughput": per_run / p50,
+        "throughput_units": f"{units}/s",
+        "peak_rss_mb": max(rss for _, rss in samples) / 2 ** 20,
+    }
+
+
+def bench_search(files: list[str], env: dict, runs: int) -> list[dict]:
+    args = ["search", "retry backoff timeout", *files, "--top-n", "3"]
+    cold = [run(args, env=env)]
+    warm = [run(args, env=env) for _ in range(runs)]
+    return [
+        summarise("search (cold cache)", len(files), "files", len(files), cold),
+        summarise("search (warm cache)", len(files), "files", len(files), warm),
+    ]
+
+
+def bench_transform(files: list[str], env: dict, runs: int, workdir: Path) -> list[dict]:
+    samples = []
+    for i in range(runs):
+        # A fresh cache for every run, so that every chunk goes to the API
+        run_env = dict(env, EMBEDIT_CACHE_FILE=str(workdir / f"transform-cache-{i}.pickle.gz"))
+        output_dir = workdir / f"transform-out-{i}"
+        args = ["transform", *files, "--prompt", "Add type hints", "--output-dir", str(output_dir), "--yes"]
+        samples.append(run([*args, "--max-chunk-len", "1600"], env=run_env))
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return [summarise("transform", len(files), "files", len(files), samples)]
+
+
+def bench_commit_msg(files: list[str], env: dict, runs: int, workdir: Path) -> list[dict]:
+    repo = workdir / "repo"
+    shutil.copytree(Path(files[0]).parent, repo)
+    git_env = dict(env, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@example.com")
+    git_env.update(GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@example.com")
+    for command in (["init", "-q"], ["add", "-A"], ["commit", "-q", "-m", "Initial commit"]):
+        subprocess.run(["git", *command], cwd=repo, env=git_env, check=True)
+    for path in sorted(repo.glob("*.py")):
+        with open(path, "a") as f:
+            f.write("\n\ndef added_function():\n    return None\n")
+    subprocess.run(["git", "add", "-A"], cwd=repo, env=git_env, check=True)
+    samples = []
+    for i in range(runs):
+        run_env = dict(env, EMBEDIT_CACHE_FILE=str(workdir / f"commit-cache-{i}.pickle.gz"))
+        samples.append(run(["commit-msg", "--num-examples", "0"], env=run_env, cwd=repo))
+    return [summarise("commit-msg", len(files), "files", len(files), samples)]
+
+
+def print_report(results: list[dict]):
+    table = Table(title="embedit end-to-end benchmarks")
+    for column in ["Benchmark", "Files", "Runs", "p50 (s)", "p99 (s)", "Throughput", "Peak RSS (MB)"]:
+        table.add_column(column, justify="left" if column == "Benchmark" else "right")
+    for result in results:
+        table.add_row(
+            result["benchmark"],
+            str(result["files"]),
+            str(result["runs"]),
+            f"{result['p50_s']:.3f}",
+            f"{result['p99_s']:.3f}",
+            f"{result['throughput']:.1f} {result['throughput_units']}",
+            f"{result['peak_rss_mb']:.1f}",
+        )
+    console.print(table)
+
+
+def main(
+    sizes: Sequence[int] = (10, 100, 1000),
+    runs: int = 5,
+    benchmarks: Sequence[str] = ("search", "transform", "commit-msg"),
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    lines_per_file: int = 60,
+    output: Optional[str] = None,
+):
+    """
+    Run the benchmarks and print a report.
+    :param sizes: Numbers of files in the synthetic corpora.
+    :param runs: Timed runs per benchmark and corpus.
+    :param benchmarks: Which of search, transform and commit-msg to run.
+    :param latency: Mean latency the stub API adds to each request, in seconds.
+    :param jitter: Standard deviation of that latency.
+    :param error_rate: Fraction of requests the stub API fails with a 500.
+    :param lines_per_file: Lines in each synthetic file.
+    :param output: Also write the results to this JSON file.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    if isinstance(benchmarks, str):
+        benchmarks = (benchmarks,)
+    server, api_base = start_stub_server(StubConfig(latency=latency, jitter=jitter, error_rate=error_rate))
+    results = []
+    try:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as workdir:
+                workdir = Path(workdir)
+                files = make_corpus(workdir / "corpus", size, lines_per_file=lines_per_file)
+                env = dict(
+                    os.environ,
+                    EMBEDIT_API_BASE=api_base,
+                    EMBEDIT_CACHE_FILE=str(workdir / "cache.pickle.gz"),
+                    OPENAI_API_KEY="stub",
+                    CO_API_KEY="stub",
+                )
+                if "search" in benchmarks:
+                    results += bench_search(files, env, runs)
+                if "transform" in benchmarks:
+                    results += bench_transform(files, env, runs, workdir)
+                if "commit-msg" in benchmarks:
+                    results += bench_commit_msg(files, env, runs, workdir)
+    finally:
+        server.shutdown()
+    print_report(results)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,125 @@
+"""
+Benchmark cold indexing: reading, splitting and token-counting files (with and without a pool of processes), and
+`embedit index` end to end against the local stub API.
+
+    python benchmarks/index.py --sizes 1000,10000 --workers 0,2,4 --latency 0.05
+
+Preparing is timed in this process, so it measures just the CPU-bound work the pool parallelises. The cold builds run
+in fresh processes with empty caches, so they include embedding, which overlaps with preparing. Corpora smaller than
+`PARALLEL_MIN_FILES` are always prepared in-process.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+from typing import Sequence
+
+import fire
+from rich.console import Console
+from rich.table import Table
+
+from e2e import make_corpus
+from e2e import run
+from embedit.behaviour.search.index import prepare_files
+from embedit.utils.stub_server import StubConfig
+from embedit.utils.stub_server import start_stub_server
+
+console = Console()
+
+
+def bench_prepare(files: list[str], workers: int) -> dict:
+    paths = [Path(file) for file in files]
+    start = time.perf_counter()
+    prepared = [prepared for prepared in prepare_files(paths, workers=workers) if prepared is not None]
+    elapsed = time.perf_counter() - start
+    return {
+        "benchmark": "prepare",
+        "files": len(files),
+        "workers": workers,
+        "seconds": elapsed,
+        "files_per_s": len(files) / elapsed,
+        "mb_per_s": sum(os.path.getsize(file) for file in files) / 2 ** 20 / elapsed,
+        "tokens_per_s": sum(file.tokens for file in prepared) / elapsed,
+    }
+
+
+def bench_build(directory: Path, workdir: Path, env: dict, workers: int) -> dict:
+    index_dir = workdir / f"index-{workers}"
+    run_env = dict(env, EMBEDIT_CACHE_FILE=str(workdir / f"cache-{workers}.pickle.gz"))
+    elapsed, rss = run(["index", str(directory), "--index-dir", str(index_dir), "--workers", str(workers)], env=run_env)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    num_files = sum(1 for _ in directory.iterdir())
+    return {
+        "benchmark": "cold build",
+        "files": num_files,
+        "workers": workers,
+        "seconds": elapsed,
+        "files_per_s": num_files / elapsed,
+        "peak_rss_mb": rss / 2 ** 20,
+    }
+
+
+def print_report(results: list[dict]):
+    table = Table(title=f"Indexing benchmark ({os.cpu_count()} CPUs)")
+    for column in ["Benchmark", "Files", "Workers", "Time (s)", "Files/s", "MB/s", "Tokens/s", "Peak RSS (MB)"]:
+        table.add_column(column, justify="right")
+    for result in results:
+        table.add_row(
+            result["benchmark"],
+            str(result["files"]),
+            str(result["workers"]),
+            f"{result['seconds']:.3f}",
+            f"{result['files_per_s']:.0f}",
+            f"{result['mb_per_s']:.1f}" if "mb_per_s" in result else "",
+            f"{result['tokens_per_s']:.0f}" if "tokens_per_s" in result else "",
+            f"{result['peak_rss_mb']:.1f}" if "peak_rss_mb" in result else "",
+        )
+    console.print(table)
+
+
+def main(
+    sizes: Sequence[int] = (1000, 10000),
+    workers: Sequence[int] = (0, 2, 4),
+    latency: float = 0.0,
+    lines_per_file: int = 200,
+    build: bool = True,
+    output: Optional[str] = None,
+):
+    """
+    Run the benchmark and print a report.
+    :param sizes: Numbers of files in the synthetic corpora.
+    :param workers: Numbers of processes to prepare files with (0 for none).
+    :param latency: Mean latency the stub API adds to each request, in seconds.
+    :param lines_per_file: Lines in each synthetic file.
+    :param build: Also time cold `embedit index` runs against the stub API.
+    :param output: Also write the results to this JSON file.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    if isinstance(workers, int):
+        workers = (workers,)
+    server, api_base = start_stub_server(StubConfig(latency=latency)) if build else (None, None)
+    results = []
+    try:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as workdir:
+                workdir = Path(workdir)
+                files = make_corpus(workdir / "corpus", size, lines_per_file=lines_per_file)
+                results += [bench_prepare(files, num_workers) for num_workers in workers]
+                if build:
+                    env = dict(os.environ, EMBEDIT_API_BASE=api_base, OPENAI_API_KEY="stub", CO_API_KEY="stub")
+                    results += [bench_build(workdir / "corpus", workdir, env, num_workers) for num_workers in workers]
+    finally:
+        if server is not None:
+            server.shutdown()
+    print_report(results)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
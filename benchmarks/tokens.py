@@ -0,0 +1,151 @@
+"""
+Benchmark the token estimator against exact counting on real code: how far off the estimate is per file and in total,
+and how much faster it is, for counting alone and for planning `transform` chunks.
+
+    python benchmarks/tokens.py --paths "embedit/**/*.py,benchmarks/*.py" --encodings cl100k_base,p50k_base
+
+The tokenisers' data has to be available (see `embedit tokenizer-data`). The report includes the calibration factor
+that would make the estimate unbiased on these files, for updating `CALIBRATION` in `embedit/utils/tokens.py`.
+"""
+import glob
+import json
+import os
+import time
+from functools import partial
+from typing import Callable
+from typing import Optional
+from typing import Sequence
+
+import fire
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from embedit.behaviour.transform import simple_transform_files_get_chunks
+from embedit.utils.tokens import CALIBRATION
+from embedit.utils.tokens import estimate_tokens
+from embedit.utils.tokens import get_encoding
+
+console = Console()
+
+# A model per encoding, since the estimator is keyed by model
+ENCODING_MODELS = {"cl100k_base": "gpt-3.5-turbo", "p50k_base": "text-davinci-003", "r50k_base": "davinci"}
+
+
+def read_files(patterns: Sequence[str]) -> dict[str, str]:
+    texts = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path) and path not in texts:
+                try:
+                    texts[path] = open(path).read()
+                except UnicodeDecodeError:
+                    continue
+    return {path: text for path, text in texts.items() if text}
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_encoding(texts: dict[str, str], encoding_name: str, *, repeat: int, max_chunk_len: int) -> dict:
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        raise SystemExit(f"The {encoding_name} tokeniser isn't available. Run `embedit tokenizer-data` first.")
+    model = ENCODING_MODELS[encoding_name]
+
+    def exact(text: str) -> int:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    estimate = partial(estimate_tokens, model=model)
+    exact_counts = np.array([exact(text) for text in texts.values()])
+    estimated_counts = np.array([estimate(text) for text in texts.values()])
+    # Per-file errors, leaving out tiny files whose relative error means little
+    large = exact_counts >= 50
+    errors = np.abs(estimated_counts[large] - exact_counts[large]) / exact_counts[large]
+    exact_s = best_time(lambda: [exact(text) for text in texts.values()], repeat)
+    estimate_s = best_time(lambda: [estimate(text) for text in texts.values()], repeat)
+    plan_exact_s = best_time(lambda: list(simple_transform_files_get_chunks(list(texts), max_chunk_len, exact)), repeat)
+    plan_estimate_s = best_time(
+        lambda: list(simple_transform_files_get_chunks(list(texts), max_chunk_len, estimate)), repeat
+    )
+    return {
+        "encoding": encoding_name,
+        "files": len(texts),
+        "mb": sum(len(text.encode()) for text in texts.values()) / 2 ** 20,
+        "tokens": int(exact_counts.sum()),
+        "bias": float(estimated_counts.sum() / exact_counts.sum() - 1),
+        "mean_error": float(errors.mean()),
+        "p90_error": float(np.percentile(errors, 90)),
+        "max_error": float(errors.max()),
+        "exact_s": exact_s,
+        "estimate_s": estimate_s,
+        "speedup": exact_s / estimate_s,
+        "planning_speedup": plan_exact_s / plan_estimate_s,
+        "calibration": CALIBRATION[encoding_name] * float(exact_counts.sum() / estimated_counts.sum()),
+    }
+
+
+def print_report(results: list[dict]):
+    table = Table(title="Token estimator benchmark")
+    columns = [
+        "Encoding", "Files", "MB", "Tokens", "Bias", "Mean error", "p90 error", "Max error", "Exact (s)",
+        "Estimate (s)", "Speed-up", "Planning speed-up", "Calibration",
+    ]
+    for column in columns:
+        table.add_column(column, justify="left" if column == "Encoding" else "right")
+    for result in results:
+        table.add_row(
+            result["encoding"],
+            str(result["files"]),
+            f"{result['mb']:.1f}",
+            str(result["tokens"]),
+            f"{result['bias']:+.1%}",
+            f"{result['mean_error']:.1%}",
+            f"{result['p90_error']:.1%}",
+            f"{result['max_error']:.1%}",
+            f"{result['exact_s']:.3f}",
+            f"{result['estimate_s']:.3f}",
+            f"{result['speedup']:.1f}x",
+            f"{result['planning_speedup']:.1f}x",
+            f"{result['calibration']:.3f}",
+        )
+    console.print(table)
+
+
+def main(
+    paths: Sequence[str] = ("embedit/**/*.py",),
+    encodings: Sequence[str] = ("cl100k_base",),
+    repeat: int = 3,
+    max_chunk_len: int = 1600,
+    output: Optional[str] = None,
+):
+    """
+    Run the benchmark and print a report.
+    :param paths: Glob patterns of the files to count tokens in.
+    :param encodings: The encodings to compare against.
+    :param repeat: Times to repeat each timing (the fastest counts).
+    :param max_chunk_len: Tokens per chunk when timing `transform`'s planning.
+    :param output: Also write the results to this JSON file.
+    """
+    if isinstance(paths, str):
+        paths = tuple(paths.split(","))
+    if isinstance(encodings, str):
+        encodings = tuple(encodings.split(","))
+    texts = read_files(paths)
+    if not texts:
+        raise SystemExit(f"No files match {', '.join(paths)}")
+    results = [bench_encoding(texts, name, repeat=repeat, max_chunk_len=max_chunk_len) for name in encodings]
+    print_report(results)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
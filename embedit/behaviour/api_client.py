@@ -0,0 +1,124 @@
+"""
+Async HTTP requests to the OpenAI and Cohere APIs, on one pooled `httpx.AsyncClient` per event loop, so that concurrent
+calls reuse connections instead of each opening its own.
+
+Errors are raised as the providers' own client libraries raise them (`openai.error.*` and `cohere.error.*`), so that
+retries and the response cache treat them the same way. Every response's rate-limit headers are passed on to the
+rate-limit governor.
+"""
+import asyncio
+import os
+import weakref
+from typing import Any
+
+import cohere
+import httpx
+import openai
+
+from embedit.utils import rate_limit
+
+# Connections per event loop, across both providers
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    The running event loop's HTTP client, created on first use.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+        )
+        _clients[loop] = client
+    return client
+
+
+async def aclose():
+    """
+    Close the running event loop's HTTP client, e.g. when an application that uses the async API shuts down.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _openai_error(response: httpx.Response) -> openai.error.OpenAIError:
+    # As the openai client interprets error responses
+    try:
+        json_body = response.json()
+    except ValueError:
+        json_body = None
+    error = json_body.get("error") if isinstance(json_body, dict) and isinstance(json_body.get("error"), dict) else {}
+    message = error.get("message") or response.text
+    details = dict(
+        http_body=response.text, http_status=response.status_code, json_body=json_body, headers=dict(response.headers)
+    )
+    status = response.status_code
+    if status in (400, 404, 415):
+        return openai.error.InvalidRequestError(message, error.get("param"), code=error.get("code"), **details)
+    error_class = {
+        401: openai.error.AuthenticationError,
+        403: openai.error.PermissionError,
+        409: openai.error.TryAgain,
+        429: openai.error.RateLimitError,
+        503: openai.error.ServiceUnavailableError,
+    }.get(status, openai.error.APIError)
+    return error_class(message, code=error.get("code"), **details)
+
+
+async def openai_request(name: str, path: str, payload: dict[str, Any], *, timeout: float) -> dict[str, Any]:
+    """
+    POST the payload to the OpenAI API's `path` (e.g. "/embeddings") and return the response's JSON.
+
+    :param name: The endpoint's name for the rate-limit governor, e.g. "openai.embeddings".
+    """
+    if not openai.api_key:
+        raise openai.error.AuthenticationError("No API key provided. Set OPENAI_API_KEY.")
+    headers = {"Authorization": f"Bearer {openai.api_key}"}
+    if openai.organization:
+        headers["OpenAI-Organization"] = openai.organization
+    try:
+        response = await get_client().post(
+            f"{openai.api_base.rstrip('/')}{path}", json=payload, headers=headers, timeout=timeout
+        )
+    except httpx.TimeoutException as e:
+        raise openai.error.Timeout(f"Request timed out: {e}") from e
+    except httpx.TransportError as e:
+        raise openai.error.APIConnectionError(f"Error communicating with OpenAI: {e}") from e
+    await rate_limit.aobserve(
+        name, response.headers, status=response.status_code, api_key=openai.api_key, model=payload.get("model", "")
+    )
+    if response.status_code >= 400:
+        raise _openai_error(response)
+    return response.json()
+
+
+async def cohere_request(name: str, endpoint: str, payload: dict[str, Any], *, timeout: float) -> dict[str, Any]:
+    """
+    POST the payload to the Cohere API's `endpoint` (e.g. "embed") and return the response's JSON.
+    """
+    api_key = os.environ.get("CO_API_KEY")
+    if not api_key:
+        raise cohere.error.CohereAPIError("No API key provided. Set CO_API_KEY.", http_status=401)
+    api_url = os.environ.get("CO_API_URL", cohere.COHERE_API_URL).rstrip("/")
+    headers = {"Authorization": f"BEARER {api_key}", "Request-Source": f"python-sdk-{cohere.SDK_VERSION}"}
+    try:
+        response = await get_client().post(
+            f"{api_url}/v{cohere.API_VERSION}/{endpoint}", json=payload, headers=headers, timeout=timeout
+        )
+    except httpx.TransportError as e:
+        raise cohere.error.CohereConnectionError(str(e)) from e
+    await rate_limit.aobserve(name, response.headers, status=response.status_code, api_key=api_key)
+    try:
+        json_body = response.json()
+    except ValueError:
+        message = f"Failed to decode json body: {response.text}"
+        raise cohere.error.CohereAPIError.from_response(response, message=message)
+    if response.status_code >= 400 or "message" in json_body:
+        raise cohere.error.CohereAPIError.from_response(response, message=json_body.get("message"))
+    return json_body
@@ -0,0 +1,232 @@
+"""
+Run many `transform` and `create` jobs from a JSON lines file in one process.
+
+Each line is a job, e.g.
+
+    {"id": "docstrings", "command": "transform", "files": ["src/**/*.py"], "prompt": "Add docstrings"}
+    {"command": "create", "prompt": "Write a README for a CLI that embeds text files"}
+
+Jobs run on a bounded pool of threads that share the response cache and a rate limiter. Their status is checkpointed to
+`status.json` in the batch's output directory after every change, so re-running the same batch skips the jobs that
+finished (unless they were edited since) and retries the rest.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from attrs import define
+from attrs import field
+from rich.console import Console
+from rich.table import Table
+
+from embedit.behaviour.create import create
+from embedit.behaviour.transform import simple_transform_files
+from embedit.utils import rate_limit
+from embedit.utils.log import logger
+from embedit.utils.usage import track_usage
+
+STATUS_FILE = "status.json"
+COMMANDS = ("transform", "create")
+# Options passed through to the command, besides the prompt and files
+JOB_OPTIONS = {
+    "transform": ("pre_prompt", "max_chunk_len", "model", "force", "split_large_files"),
+    "create": ("pre_prompt", "model", "plan", "retries"),
+}
+
+console = Console()
+
+
+class BatchError(ValueError):
+    pass
+
+
+def read_jobs(jobs_file: str) -> list[dict]:
+    """
+    Read and check the jobs, giving each an ID (its line number, unless it has one) and a fingerprint of its contents.
+    """
+    jobs = []
+    with open(jobs_file) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise BatchError(f"Line {line_number} of {jobs_file} isn't valid JSON ({e})") from e
+            command = job.get("command")
+            if command not in COMMANDS:
+                raise BatchError(f"Line {line_number} of {jobs_file} has unknown command {command!r}")
+            if "prompt" not in job:
+                raise BatchError(f"Line {line_number} of {jobs_file} has no prompt")
+            unknown = set(job) - {"id", "command", "prompt", "files", "output_dir", *JOB_OPTIONS[command]}
+            if unknown:
+                raise BatchError(f"Line {line_number} of {jobs_file} has unknown options: {', '.join(sorted(unknown))}")
+            job = {"id": str(job.get("id", f"{line_number:04d}")), **job}
+            job["fingerprint"] = hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+            jobs.append(job)
+    ids = [job["id"] for job in jobs]
+    duplicates = sorted({job_id for job_id in ids if ids.count(job_id) > 1})
+    if duplicates:
+        raise BatchError(f"{jobs_file} has duplicate job IDs: {', '.join(duplicates)}")
+    return jobs
+
+
+def expand_files(patterns: list[str]) -> list[str]:
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        files += [match for match in matches if os.path.isfile(match) and match not in files]
+    return files
+
+
+@define
+class BatchStatus:
+    """
+    The status of every job in a batch, saved atomically after each change.
+    """
+
+    path: Path
+    jobs: dict[str, dict] = field(factory=dict)
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    @classmethod
+    def load(cls, path: Path) -> "BatchStatus":
+        if not path.exists():
+            return cls(path=path)
+        return cls(path=path, jobs=json.loads(path.read_text())["jobs"])
+
+    def is_done(self, job: dict) -> bool:
+        status = self.jobs.get(job["id"])
+        return status is not None and status["state"] == "done" and status["fingerprint"] == job["fingerprint"]
+
+    def update(self, job: dict, **status):
+        with self._lock:
+            self.jobs[job["id"]] = {"fingerprint": job["fingerprint"], "command": job["command"], **status}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps({"jobs": self.jobs}, indent=1))
+            os.replace(tmp_path, self.path)
+
+
+def run_job(job: dict, *, output_dir: Path, workers: int) -> dict:
+    """
+    Run a job, returning its outcome (with its API usage) for the status file.
+    """
+    job_output_dir = job.get("output_dir") or str(output_dir / job["id"])
+    options = {option: job[option] for option in JOB_OPTIONS[job["command"]] if option in job}
+    start = time.perf_counter()
+    with track_usage() as usage:
+        try:
+            if job["command"] == "transform":
+                files = expand_files(job.get("files", []))
+                if not files:
+                    raise BatchError(f"No files match {job.get('files', [])}")
+                results = simple_transform_files(
+                    *files,
+                    prompt=job["prompt"],
+                    output_dir=job_output_dir,
+                    yes=True,
+                    workers=workers,
+                    show_diff=False,
+                    **options,
+                )
+                outcome = {"state": "done", "files": len(files), "written": len(results)}
+            else:
+                create(job["prompt"], output_dir=job_output_dir, yes=True, workers=workers, **options)
+                outcome = {"state": "done"}
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            outcome = {"state": "failed", "error": f"{type(e).__name__}: {e}"}
+    return {
+        **outcome,
+        "output_dir": job_output_dir,
+        "seconds": time.perf_counter() - start,
+        **usage.to_json(),
+    }
+
+
+def print_summary(jobs: list[dict], status: BatchStatus):
+    table = Table(title="Batch")
+    for column in ["Job", "Command", "State", "Time (s)", "Requests", "Tokens sent", "Tokens received", "Error"]:
+        table.add_column(column, justify="left" if column in ("Job", "Command", "State", "Error") else "right")
+    totals = {"seconds": 0.0, "requests": 0, "tokens_sent": 0, "tokens_received": 0}
+    for job in jobs:
+        job_status = status.jobs.get(job["id"], {"state": "pending"})
+        for key in totals:
+            totals[key] += job_status.get(key, 0)
+        table.add_row(
+            job["id"],
+            job["command"],
+            job_status["state"],
+            f"{job_status['seconds']:.1f}" if "seconds" in job_status else "",
+            str(job_status.get("requests", "")),
+            str(job_status.get("tokens_sent", "")),
+            str(job_status.get("tokens_received", "")),
+            job_status.get("error", ""),
+        )
+    failed = sum(status.jobs.get(job["id"], {}).get("state") == "failed" for job in jobs)
+    table.add_section()
+    table.add_row(
+        "Total",
+        "",
+        f"{failed} failed" if failed else "ok",
+        f"{totals['seconds']:.1f}",
+        str(totals["requests"]),
+        str(totals["tokens_sent"]),
+        str(totals["tokens_received"]),
+        "",
+    )
+    console.print(table)
+
+
+def run_batch(
+    jobs_file: str,
+    *,
+    output_dir: str = "batch",
+    workers: int = 4,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    segment_workers: int = 4,
+) -> int:
+    """
+    Run the jobs in a JSON lines file, skipping those that finished in a previous run of the same batch.
+
+    :param output_dir: The directory for the status file and for the outputs of jobs that don't set their own
+        `output_dir` (which go in a subdirectory named after the job's ID).
+    :param workers: The most jobs to run at once.
+    :param requests_per_minute: The most API requests to send per minute, across all jobs.
+    :param tokens_per_minute: The most tokens to send per minute, across all jobs.
+    :param segment_workers: The most segments of a large file to transform (or files of a planned `create` to
+        generate) at once, within a job.
+    :return: The number of jobs that failed.
+    """
+    jobs = read_jobs(jobs_file)
+    output_path = Path(output_dir)
+    status = BatchStatus.load(output_path / STATUS_FILE)
+    rate_limit.configure(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    pending = [job for job in jobs if not status.is_done(job)]
+    if len(pending) < len(jobs):
+        logger.warning(f"Skipping {len(jobs) - len(pending)} jobs that finished in a previous run")
+
+    def run(job: dict):
+        status.update(job, state="running")
+        outcome = run_job(job, output_dir=output_path, workers=segment_workers)
+        status.update(job, **outcome)
+        if outcome["state"] == "failed":
+            logger.warning(f"Job {job['id']} failed: {outcome['error']}")
+        else:
+            logger.warning(f"Job {job['id']} finished in {outcome['seconds']:.1f}s")
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            # list() to surface errors in the runner itself (jobs' own errors are recorded in the status)
+            list(pool.map(run, pending))
+    print_summary(jobs, status)
+    return sum(status.jobs[job["id"]]["state"] == "failed" for job in jobs)
@@ -1,8 +1,29 @@
+"""
+Creating files from a prompt, either in one completion that holds every file, or planned and then generated a file at a
+time.
+
+Planning (`plan=True`) asks for the project's files and the interfaces between them first, then generates the files
+concurrently, each with the plan as shared context so they fit together. Each file is written as soon as it's done, and
+a file whose response can't be used is asked for again on its own, so the output isn't limited to one response and the
+time taken follows the largest file rather than the sum of them.
+"""
+import asyncio
+import json
+import pathlib
+import time
 from typing import Optional
 
-from dir2md import md2dir, save_dir
+from attrs import define
+from dir2md import TextFile
+from dir2md import md2dir
+from dir2md import save_dir
 
+from embedit.behaviour.openai_tools import OutOfTokensError
+from embedit.behaviour.openai_tools import acomplete
 from embedit.behaviour.openai_tools import complete
+from embedit.utils.aio import run_sync
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
 
 default_pre_prompt = " ".join(
     [
@@ -31,16 +52,250 @@ default_pre_prompt = "\n".join(
     ]
 )
 
+plan_pre_prompt = "\n".join(
+    [
+        "You are an advanced AI assistant for planning software projects.",
+        "Respond to the user's request with a plan of the files to create, not their contents, as a JSON object:",
+        '{"summary": "What the project does and how its files fit together",'
+        ' "files": [{"path": "relative/path/to/file.py", "purpose": "What the file is for",'
+        ' "interface": "The classes, functions and constants it defines that other files use, with their signatures"}]}',
+        "Respond with the JSON object alone.",
+    ]
+)
+
+# Times a file is asked for again after a response that can't be used
+DEFAULT_FILE_RETRIES = 2
+
+
+class CreateError(ValueError):
+    pass
+
+
+@define(frozen=True)
+class PlannedFile:
+    path: str
+    purpose: str
+    interface: str
+
+
+@define(frozen=True)
+class Plan:
+    summary: str
+    files: list[PlannedFile]
+
+    def to_markdown(self) -> str:
+        parts = ["# Plan", self.summary]
+        for file in self.files:
+            parts += [f"## {file.path}", file.purpose]
+            if file.interface:
+                parts += ["Interface:", file.interface]
+        return "\n".join(parts)
+
+
+def parse_plan(response: str) -> Plan:
+    """
+    Read the plan from the planning response, which should be a JSON object (possibly in a fence).
+    """
+    start, end = response.find("{"), response.rfind("}")
+    try:
+        plan = json.loads(response[start: end + 1]) if start != -1 else None
+    except json.JSONDecodeError as e:
+        raise CreateError(f"Couldn't parse the plan ({e}): {response}") from e
+    if not isinstance(plan, dict) or not isinstance(plan.get("files"), list) or not plan["files"]:
+        raise CreateError(f"The plan doesn't list any files: {response}")
+    files = []
+    for entry in plan["files"]:
+        path = entry.get("path") if isinstance(entry, dict) else None
+        if not isinstance(path, str) or not path.strip():
+            raise CreateError(f"The plan has a file without a path: {entry}")
+        path = pathlib.PurePosixPath(path.strip())
+        # Stay inside the output directory
+        if path.is_absolute() or ".." in path.parts:
+            raise CreateError(f"The plan has a file outside the output directory: {path}")
+        if str(path) in {file.path for file in files}:
+            continue
+        interface = entry.get("interface") or ""
+        files.append(
+            PlannedFile(
+                path=str(path),
+                purpose=str(entry.get("purpose") or ""),
+                interface=interface if isinstance(interface, str) else json.dumps(interface, indent=1),
+            )
+        )
+    return Plan(summary=str(plan.get("summary") or ""), files=files)
+
+
+async def aplan_project(prompt: str, *, model: str = "gpt-3.5-turbo") -> Plan:
+    """
+    Ask for the files of a project and the interfaces between them, without their contents.
+    """
+    with profiler.stage("create.plan"):
+        response = await acomplete("<| No input |>", prompt=prompt, pre_prompt=plan_pre_prompt, model=model)
+    return parse_plan(response)
+
+
+def file_result(response: str, path: str, *, partial: bool = False) -> Optional[TextFile]:
+    # The generated file in a response, if it has exactly one complete file, or one with the expected path
+    results = [result for result in md2dir(response) if not result.partial]
+    if partial or not results:
+        return None
+    matching = [result for result in results if result.path.strip() == path]
+    if matching:
+        return TextFile(text=matching[0].text, path=path, partial=False)
+    if len(results) == 1:
+        return TextFile(text=results[0].text, path=path, partial=False)
+    return None
+
+
+async def agenerate_file(
+    file: PlannedFile,
+    plan: Plan,
+    *,
+    prompt: str,
+    pre_prompt: str,
+    model: str,
+    retries: int = DEFAULT_FILE_RETRIES,
+) -> TextFile:
+    """
+    Generate one of the planned files, with the plan as context, asking again if the response can't be used.
+    """
+    instructions = [
+        prompt,
+        f"The files of the project are planned above. Write {file.path} alone, complete, following the plan so that"
+        " it works with the other files, and respond with it in a single fence preceded by its filename.",
+    ]
+    partial = False
+    for attempt in range(retries + 1):
+        if attempt:
+            # Says what went wrong, and keeps the retry from being answered from the response cache
+            problem = "was cut off, so write it more concisely" if partial else "didn't contain it in a complete fence"
+            instructions.append(f"(Attempt {attempt + 1}: the previous response for {file.path} {problem}.)")
+        partial = False
+        with profiler.stage("create.file"):
+            try:
+                response = await acomplete(
+                    plan.to_markdown(), prompt="\n".join(instructions), pre_prompt=pre_prompt, model=model
+                )
+            except OutOfTokensError as e:
+                response, partial = e.text, True
+        result = file_result(response, file.path, partial=partial)
+        if result is not None:
+            return result
+        logger.warning(f"Couldn't use the response for {file.path}" + (", asking again" if attempt < retries else ""))
+    raise CreateError(f"Couldn't generate {file.path} after {retries + 1} attempts")
+
+
+def confirm_files(paths: list[str], output_dir: str) -> bool:
+    # As dir2md's save_dir asks before writing
+    new_files = [path for path in paths if not pathlib.Path(output_dir, path).exists()]
+    existing_files = [path for path in paths if pathlib.Path(output_dir, path).exists()]
+    if new_files:
+        print("The following files will be created:")
+        for path in new_files:
+            print(f"  {pathlib.Path(output_dir, path)}")
+    if existing_files:
+        print("The following files will be overwritten:")
+        for path in existing_files:
+            print(f"  {pathlib.Path(output_dir, path)}")
+    print("Continue? (y/n)")
+    if input() != "y":
+        print("Aborted.")
+        return False
+    return True
+
+
+async def acreate_planned(
+    prompt: str,
+    *,
+    pre_prompt: str,
+    output_dir: str,
+    yes: bool,
+    model: str,
+    workers: int,
+    retries: int = DEFAULT_FILE_RETRIES,
+) -> list[TextFile]:
+    """
+    Plan the project, then generate its files concurrently (up to `workers` at once), writing each when it's done.
+
+    :raises CreateError: If some files couldn't be generated, after writing the rest.
+    """
+    plan = await aplan_project(prompt, model=model)
+    logger.warning(f"Planned {len(plan.files)} files: {', '.join(file.path for file in plan.files)}")
+    if not yes and not await asyncio.to_thread(confirm_files, [file.path for file in plan.files], output_dir):
+        return []
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def generate(file: PlannedFile) -> tuple[PlannedFile, Optional[TextFile], float]:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await agenerate_file(
+                    file, plan, prompt=prompt, pre_prompt=pre_prompt, model=model, retries=retries
+                )
+            except Exception as e:
+                logger.warning(f"Failed to generate {file.path}: {type(e).__name__}: {e}")
+                result = None
+            return file, result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = []
+    failed = []
+    longest = 0.0
+    for task in asyncio.as_completed([generate(file) for file in plan.files]):
+        file, result, seconds = await task
+        longest = max(longest, seconds)
+        if result is None:
+            failed.append(file.path)
+            continue
+        await asyncio.to_thread(save_dir, [result], output_dir=output_dir, yes=True)
+        results.append(result)
+    profiler.count("create.files", len(results))
+    logger.warning(
+        f"Generated {len(results)} of {len(plan.files)} files in {time.perf_counter() - start:.1f}s"
+        f" (the slowest took {longest:.1f}s)"
+    )
+    if failed:
+        raise CreateError(f"Couldn't generate {len(failed)} files: {', '.join(failed)}")
+    return results
+
 
 def create(
     prompt: str, *, pre_prompt: Optional[str] = None, output_dir: str = "out",
-    yes: bool = False, model: str = "gpt-3.5-turbo"
+    yes: bool = False, model: str = "gpt-3.5-turbo", plan: bool = False, workers: int = 4,
+    retries: int = DEFAULT_FILE_RETRIES,
 ):
+    """
+    Creates files from a prompt.
+    :param prompt: What to create.
+    :param pre_prompt: Instructions to send before the prompt.
+    :param output_dir: The directory to write the files to.
+    :param yes: Don't prompt before creating or overwriting files.
+    :param model: The OpenAI API model to use.
+    :param plan: Plan the files and their interfaces first, then generate each file in its own request, concurrently,
+        writing it as soon as it's done. Otherwise every file is written in a single response.
+    :param workers: With `plan`, the most files to generate at once.
+    :param retries: With `plan`, the times to ask for a file again if its response can't be used.
+    """
     if pre_prompt is None:
         pre_prompt = default_pre_prompt
 
+    if plan:
+        results = run_sync(
+            acreate_planned(
+                prompt,
+                pre_prompt=pre_prompt,
+                output_dir=output_dir,
+                yes=yes,
+                model=model,
+                workers=workers,
+                retries=retries,
+            )
+        )
+        # In the same form as a single response
+        return "\n".join(f"<!-- {result.path} -->\n```\n{result.text}\n```" for result in results)
+
     results = complete(
         "<| No input |>", prompt=prompt, pre_prompt=pre_prompt, model=model
     )
     save_dir(list(md2dir(results)), output_dir=output_dir, yes=yes)
-    return results
\ No newline at end of file
+    return results
@@ -1,7 +1,7 @@
 """
 Create a git commit message.
 """
-import os
+import itertools
 import re
 from typing import Callable
 from typing import Iterator
@@ -9,12 +9,18 @@ from typing import Optional
 
 from git import Repo
 
+from embedit.behaviour.git_diff import generated_paths
+from embedit.behaviour.git_diff import staged_stats
+from embedit.behaviour.git_diff import stream_staged_patches
+from embedit.behaviour.git_diff import summarise
 from embedit.behaviour.openai_tools import Result
 from embedit.behaviour.openai_tools import Task
 from embedit.behaviour.openai_tools import complete
 from embedit.behaviour.openai_tools import tokclip
 from embedit.behaviour.openai_tools import toklen
 from embedit.behaviour.prompts.default import default_pre_prompt
+from embedit.utils.profile import profiled
+from embedit.utils.profile import profiler
 
 musings_on_good_vs_great_commit_messages = """
 A good commit message should:
@@ -47,6 +53,10 @@ The "good" commit message is brief and clearly states the changes made, but it d
 The "great" commit message, on the other hand, not only states the change but also explains the reasoning behind it, provides context, and includes relevant information such as the issue number and testing done. This level of detail makes it easier for others to understand the change and its impact on the codebase.
 """
 
+# A changed line is rarely fewer tokens than this, so files with more changed lines than the diff budget allows for are
+# summarised rather than diffed and clipped
+MIN_TOKENS_PER_LINE = 4
+
 pre_prompt_commit = "\n\n".join(
     [
         default_pre_prompt,
@@ -155,6 +165,7 @@ def rate_commit_message(commit_message: str) -> int:
     return int(rating)
 
 
+@profiled("git.examples")
 def get_examples(
     num_examples, *, path: str = ".", max_log_tokens: int, model: str
 ) -> list[tuple[Task, Result]]:
@@ -171,7 +182,9 @@ def get_examples(
             commit.parents[0] if commit.parents else None, create_patch=True
         )
         diff_str = "\n".join(str(d) for d in diff)
-        this_token_count = toklen(message, model=model) + toklen(diff_str, model=model) + 20
+        # Only for choosing examples, so an estimate will do
+        this_token_count = toklen(message, model=model, estimate=True) + toklen(diff_str, model=model, estimate=True)
+        this_token_count += 20
         if token_count + this_token_count > max_log_tokens:
             continue
         token_count += this_token_count
@@ -182,33 +195,52 @@ def get_examples(
     return examples
 
 
-def get_diffstrs(path: str, max_diff_tokens: int, model: str) -> Iterator[str]:
+def get_diffstrs(path: str, max_diff_tokens: int, model: str, *, context_lines: int = 10) -> Iterator[str]:
     """
     Yield diff strings for staged files in the given paths.
 
     If all the diffs together are within the max_diff_tokens limit, yield them all together. Otherwise, yield them one at a time.
+
+    Binary and generated files, and files with too many changed lines to show, are summarised by how many lines they
+    add and remove instead of being diffed.
     """
     repo = Repo(path)
     # Diff between head and staged
-    diff = list(repo.index.diff(repo.head.commit, create_patch=True, R=True))
-    if len(diff) == 0:
-        raise ValueError("No changes to commit. Have you staged your changes?")
-    diff_chunk = []
-    diff_chunk_size = 0
-    for d in diff:
-        this_diff_size = toklen(str(d), model=model)
-        if this_diff_size > max_diff_tokens:
-            # If a single diff is too large, truncate it and yield it separately
-            yield tokclip(str(d), max_diff_tokens, keep="right", model=model)
-            continue
-        diff_chunk_size += this_diff_size
-        if diff_chunk_size > max_diff_tokens:
+    with profiler.stage("git.diff") as stage:
+        stats = staged_stats(repo)
+        stage.add("files", len(stats))
+        if len(stats) == 0:
+            raise ValueError("No changes to commit. Have you staged your changes?")
+        generated = generated_paths(repo, [stat.path for stat in stats])
+        summaries = []
+        to_diff = []
+        for stat in stats:
+            if stat.binary:
+                summaries.append(summarise(stat, "binary"))
+            elif stat.path in generated:
+                summaries.append(summarise(stat, "generated"))
+            elif stat.changed_lines * MIN_TOKENS_PER_LINE > max_diff_tokens:
+                summaries.append(summarise(stat, "too large"))
+            else:
+                to_diff.append(stat)
+        stage.add("summarised", len(summaries))
+
+        diff_chunk = []
+        diff_chunk_size = 0
+        for diffstr in itertools.chain(stream_staged_patches(repo, to_diff, context_lines=context_lines), summaries):
+            this_diff_size = toklen(diffstr, model=model, estimate=True)
+            if this_diff_size > max_diff_tokens:
+                # If a single diff is too large, truncate it and yield it separately
+                yield tokclip(diffstr, max_diff_tokens, keep="right", model=model)
+                continue
+            diff_chunk_size += this_diff_size
+            if diff_chunk_size > max_diff_tokens:
+                yield "\n".join(diff_chunk)
+                diff_chunk = []
+                diff_chunk_size = this_diff_size
+            diff_chunk.append(diffstr)
+        if len(diff_chunk) > 0:
             yield "\n".join(diff_chunk)
-            diff_chunk = []
-            diff_chunk_size = 0
-        diff_chunk.append(str(d))
-    if len(diff_chunk) > 0:
-        yield "\n".join(diff_chunk)
 
 
 def make_commit_message(
@@ -223,9 +255,9 @@ def make_commit_message(
     num_lines_context: int = 10,
 ) -> str:
     """Return a commit message based on the given diff."""
-    # Set the GIT_DIFF_OPTS environment variable to change the number of lines of context shown in the diff.
-    os.environ["GIT_DIFF_OPTS"] = f"-u{num_lines_context}"
-    diffstrs = list(get_diffstrs(path=path, max_diff_tokens=max_diff_tokens, model=model))
+    diffstrs = list(
+        get_diffstrs(path=path, max_diff_tokens=max_diff_tokens, model=model, context_lines=num_lines_context)
+    )
     if use_builtin_examples:
         examples = make_builtin_examples()
     else:
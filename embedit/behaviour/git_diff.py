@@ -0,0 +1,140 @@
+"""
+Streaming the staged changes from git, a file at a time, for commit messages.
+
+`git diff --cached --numstat` says how many lines each staged file adds and removes, without making any patches. Files
+that are binary, generated (by name, or marked `linguist-generated` in `.gitattributes`) or have too many changed lines
+to show are summarised by those stats, and only the rest are diffed, in batches of paths, with the context set on the
+command line and the patches read from git's output as it's written.
+"""
+import fnmatch
+import subprocess
+from typing import Iterator
+from typing import Optional
+from typing import Sequence
+
+from attrs import define
+from git import Repo
+
+# Lock files, minified bundles and compiled protobufs, whose diffs say little about a change
+GENERATED_PATTERNS = (
+    "*.lock",
+    "package-lock.json",
+    "pnpm-lock.yaml",
+    "*.min.js",
+    "*.min.css",
+    "*.map",
+    "*_pb2.py",
+    "*.pb.go",
+)
+# Paths diffed per git process, to stay well under command line length limits
+DIFF_BATCH_FILES = 256
+# Options that override any diff configuration that would change the output's format
+DIFF_OPTIONS = ("--no-color", "--no-ext-diff", "--no-textconv", "--src-prefix=a/", "--dst-prefix=b/")
+
+
+@define(frozen=True)
+class FileStat:
+    path: str
+    # The path before a rename or copy, if there was one
+    old_path: Optional[str]
+    # None for binary files
+    added: Optional[int]
+    deleted: Optional[int]
+
+    @property
+    def binary(self) -> bool:
+        return self.added is None
+
+    @property
+    def changed_lines(self) -> int:
+        return (self.added or 0) + (self.deleted or 0)
+
+    @property
+    def paths(self) -> list[str]:
+        return [self.old_path, self.path] if self.old_path is not None else [self.path]
+
+
+def staged_stats(repo: Repo) -> list[FileStat]:
+    """
+    The numbers of lines added and removed in each staged file, without diffing their contents.
+    """
+    output = repo.git.diff("--cached", "--numstat", "-z", *DIFF_OPTIONS)
+    # Each file is "added<TAB>deleted<TAB>path<NUL>", or for renames "added<TAB>deleted<TAB><NUL>old<NUL>new<NUL>"
+    fields = output.split("\0")
+    stats = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        added, deleted, path = fields[i].split("\t", 2)
+        old_path = None
+        if not path:
+            old_path, path = fields[i + 1], fields[i + 2]
+            i += 2
+        i += 1
+        stats.append(
+            FileStat(
+                path=path,
+                old_path=old_path,
+                added=None if added == "-" else int(added),
+                deleted=None if deleted == "-" else int(deleted),
+            )
+        )
+    return stats
+
+
+def generated_paths(repo: Repo, paths: Sequence[str]) -> set[str]:
+    """
+    The paths that look generated, by name or by their `linguist-generated` attribute.
+    """
+    generated = {
+        path
+        for path in paths
+        if any(fnmatch.fnmatch(path.rsplit("/", 1)[-1], pattern) for pattern in GENERATED_PATTERNS)
+    }
+    if not paths:
+        return generated
+    process = repo.git.check_attr("--stdin", "-z", "linguist-generated", istream=subprocess.PIPE, as_process=True)
+    stdout, _ = process.proc.communicate("\0".join(paths).encode() + b"\0")
+    # "path<NUL>attribute<NUL>value<NUL>" for each path
+    fields = stdout.decode("utf-8", errors="replace").split("\0")
+    for path, value in zip(fields[0::3], fields[2::3]):
+        if value in ("set", "true"):
+            generated.add(path)
+    return generated
+
+
+def summarise(stat: FileStat, reason: str) -> str:
+    """
+    Describe a file's changes by their stats alone.
+    """
+    path = f"{stat.old_path} -> {stat.path}" if stat.old_path is not None else stat.path
+    if stat.binary:
+        return f"{path}: binary file changed (diff not shown)"
+    return f"{path}: {stat.added} lines added, {stat.deleted} removed ({reason}; diff not shown)"
+
+
+def stream_staged_patches(repo: Repo, stats: Sequence[FileStat], *, context_lines: int) -> Iterator[str]:
+    """
+    Yield the patch of each of the staged files, as git writes it.
+    """
+    for start in range(0, len(stats), DIFF_BATCH_FILES):
+        paths = [path for stat in stats[start:start + DIFF_BATCH_FILES] for path in stat.paths]
+        process = repo.git.diff(
+            "--cached",
+            f"--unified={context_lines}",
+            *DIFF_OPTIONS,
+            "--",
+            *paths,
+            as_process=True,
+            # The paths are file names, not patterns
+            env={"GIT_LITERAL_PATHSPECS": "1"},
+        )
+        patch: list[str] = []
+        for line in process.proc.stdout:
+            line = line.decode("utf-8", errors="replace")
+            if line.startswith("diff --git ") and patch:
+                yield "".join(patch)
+                patch = []
+            patch.append(line)
+        if patch:
+            yield "".join(patch)
+        process.wait()
@@ -1,53 +1,65 @@
+import asyncio
 import gzip
 import logging
 import os
 import pickle
+import threading
 import time
 from dataclasses import dataclass
 from functools import wraps
 from pathlib import Path
+from typing import Any
 from typing import Literal
 from typing import Optional
 import cohere
 
 import openai
-import tiktoken
 from delegatefn import delegate
+from embedit.behaviour import api_client
 from embedit.structures.special_tokens import end_response_token
 from embedit.structures.special_tokens import start_response_token
 from embedit.utils.log import logger
-from tenacity import retry
-from tenacity import stop_after_attempt
-from tenacity import wait_random_exponential
+from embedit.utils.profile import profiled
+from embedit.utils.profile import profiler
+from embedit.utils import rate_limit
+from embedit.utils import resilience
+from embedit.utils.aio import run_sync
+from embedit.utils.tokens import clip_tokens
+from embedit.utils.tokens import count_tokens
+from embedit.utils.usage import record_usage
 from tqdm.auto import tqdm
 
-co = cohere.Client()
 
+def configure_api_base(api_base: Optional[str]):
+    """
+    Send OpenAI and Cohere requests to `api_base` (e.g. a local stub server) instead of the providers' own servers.
+    `OPENAI_API_BASE` and `CO_API_URL` still work for pointing the two clients at different places.
+    """
+    if api_base is None:
+        return
+    api_base = api_base.rstrip("/")
+    openai.api_base = f"{api_base}/v1"
+    os.environ["CO_API_URL"] = api_base
+
+
+configure_api_base(os.environ.get("EMBEDIT_API_BASE"))
 
 
-def toklen(string: str, model: str) -> int:
+def toklen(string: str, model: str, *, estimate: bool = False) -> int:
     """
-    Returns the number of tokens in the given string.
+    Returns the number of tokens in the given string, or a quicker estimate of it if `estimate` is set (for planning,
+    e.g. packing files into requests, rather than for budget checks).
     """
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(string))
+    return count_tokens(string, model, estimate=estimate)
 
 
 def tokclip(string: str, max_tokens: int, keep: Literal["left", "right"], model: str) -> str:
     """
     Returns the given string clipped to the given number of tokens.
     """
-    if toklen(string, model) <= max_tokens:
-        return string
-
-    enc = tiktoken.encoding_for_model(model)
-
-    if keep == "left":
-        return enc.decode(enc.encode(string)[-max_tokens:])
-    elif keep == "right":
-        return enc.decode(enc.encode(string)[:max_tokens])
-    else:
+    if keep not in ("left", "right"):
         raise ValueError(f"Invalid value for keep: {keep}")
+    return clip_tokens(string, max_tokens, model, keep=keep)
 
 
 def get_max_tokens(model: str) -> int:
@@ -61,6 +73,22 @@ def get_max_tokens(model: str) -> int:
         return 4000
 
 
+def is_transient(error: BaseException) -> bool:
+    """
+    Returns True if the given error from an API call might not happen again, so the call is worth retrying (or
+    answering from the cache).
+    """
+    if isinstance(
+        error,
+        (openai.error.InvalidRequestError, openai.error.AuthenticationError, openai.error.PermissionError),
+    ):
+        return False
+    http_status = getattr(error, "http_status", None)
+    if isinstance(error, cohere.error.CohereAPIError) and http_status is not None:
+        return http_status == 429 or http_status >= 500
+    return True
+
+
 def response_did_finished(response: str) -> bool:
     """
     Returns True if the given response contains the token that indicates that the response is finished.
@@ -68,10 +96,16 @@ def response_did_finished(response: str) -> bool:
     return end_response_token in response
 
 
-CACHE_FILE = Path(__file__).parent / "openai_cache.pickle.gz"
+# The embedding model used in each mode (Cohere's is the client's default)
+EMBEDDING_MODELS = {"openai": "text-embedding-ada-002", "cohere": "cohere-embed-default"}
+
+CACHE_FILE = Path(os.environ.get("EMBEDIT_CACHE_FILE", Path(__file__).parent / "openai_cache.pickle.gz"))
 CACHE_DURATION = 86400  # Cache duration in seconds (86400 seconds is 24 hours)
+# Serialises updates to the cache file between threads (e.g. segments of a file transformed concurrently)
+_cache_lock = threading.Lock()
 
 
+@profiled("cache.load")
 def load_cache():
     logger.info("Loading cache")
     if os.path.exists(CACHE_FILE):
@@ -80,10 +114,14 @@ def load_cache():
     else:
         return {}
 
+@profiled("cache.save")
 def save_cache(cache):
     logger.info("Saving cache")
-    with gzip.open(CACHE_FILE, "wb") as f:
+    # Atomically, so that other threads and processes never load a half-written cache
+    tmp_path = CACHE_FILE.with_name(f"{CACHE_FILE.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with gzip.open(tmp_path, "wb") as f:
         pickle.dump(cache, f)
+    os.replace(tmp_path, CACHE_FILE)
     logger.info("Cache saved")
 
 def check_cache_validity(cache, cache_key):
@@ -93,44 +131,129 @@ def check_cache_validity(cache, cache_key):
     return False
 
 
+def store_responses(entries: dict[str, Any]):
+    """
+    Add responses to the cache file, merging them with whatever other threads and processes have saved since it was
+    loaded.
+    """
+    with _cache_lock:
+        cache = load_cache()
+        now = time.time()
+        for cache_key, response in entries.items():
+            cache[cache_key] = {"response": response, "timestamp": now}
+        save_cache(cache)
+
+
 def cache_response(function):
     @wraps(function)
     def wrapper(*args, **kwargs):
         cache = load_cache()
         cache_key = str(args) + str(kwargs)
         if check_cache_validity(cache, cache_key):
-            cache = load_cache()
+            profiler.count("cache.responses.hits")
             return cache[cache_key]["response"]
         else:
-            response = function(*args, **kwargs)
-            cache = load_cache()
-            cache[cache_key] = {"response": response, "timestamp": time.time()}
-            save_cache(cache)
+            profiler.count("cache.responses.misses")
+            try:
+                response = function(*args, **kwargs)
+            except Exception as e:
+                # While the API is unavailable, an expired response is better than none
+                if not is_transient(e) or cache_key not in cache:
+                    raise
+                logger.warning(f"The API is unavailable ({type(e).__name__}). Using an expired cached response.")
+                profiler.count("cache.responses.stale")
+                return cache[cache_key]["response"]
+            store_responses({cache_key: response})
             return response
 
     return wrapper
 
 
-@cache_response
+def acache_response(function):
+    """
+    Like `cache_response`, for coroutine functions, with the same cache keys. The cache is loaded and saved on worker
+    threads, so that its I/O doesn't block the event loop.
+    """
+
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        cache = await asyncio.to_thread(load_cache)
+        cache_key = str(args) + str(kwargs)
+        if check_cache_validity(cache, cache_key):
+            profiler.count("cache.responses.hits")
+            return cache[cache_key]["response"]
+        profiler.count("cache.responses.misses")
+        try:
+            response = await function(*args, **kwargs)
+        except Exception as e:
+            if not is_transient(e) or cache_key not in cache:
+                raise
+            logger.warning(f"The API is unavailable ({type(e).__name__}). Using an expired cached response.")
+            profiler.count("cache.responses.stale")
+            return cache[cache_key]["response"]
+        await asyncio.to_thread(store_responses, {cache_key: response})
+        return response
+
+    return wrapper
+
+
+@acache_response
 @delegate(openai.Completion.create)
-def openai_create_raw(**kwargs) -> str:
+async def aopenai_create_raw(**kwargs) -> str:
     kwargs.setdefault("model", "gpt-3.5-turbo")
     kwargs["messages"] = [{"role": "system", "content": "You are a text completion engine."},
                           {"role": "user", "content": kwargs.pop("prompt")}]
     logger.debug(f"Sending request to OpenAI: {kwargs}")
-    chat_completion = retry(stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=1, max=10))(
-        openai.ChatCompletion.create
-    )
-    response = chat_completion(**kwargs).choices[0].message.content
+
+    def chat_completion(timeout: float):
+        return api_client.openai_request("openai.chat", "/chat/completions", kwargs, timeout=timeout)
+
+    # Providers count the prompt and the most tokens the response may have
+    num_tokens = toklen(kwargs["messages"][-1]["content"], kwargs["model"]) + kwargs.get("max_tokens", 0)
+    with profiler.stage("api.chat") as stage:
+        # Not hedged: a duplicate completion costs as much as the first
+        completion = await resilience.acall(
+            "openai.chat",
+            chat_completion,
+            retry_if=is_transient,
+            before_attempt=lambda: rate_limit.aacquire(
+                "openai.chat", num_tokens, api_key=openai.api_key, model=kwargs["model"]
+            ),
+        )
+        usage = completion["usage"]
+        stage.add("tokens_sent", usage["prompt_tokens"])
+        stage.add("tokens_received", usage["completion_tokens"])
+    record_usage(tokens_sent=usage["prompt_tokens"], tokens_received=usage["completion_tokens"])
+    response = completion["choices"][0]["message"]["content"]
     logger.debug(f"Received response from OpenAI: {response}")
     return response
 
 
 @delegate(openai.Completion.create)
-def openai_create(model: str, **kwargs) -> str:
+def openai_create_raw(**kwargs) -> str:
+    return run_sync(aopenai_create_raw(**kwargs))
+
+
+@delegate(openai.Completion.create)
+async def aopenai_create(model: str, **kwargs) -> str:
     if "engine" in kwargs:
         raise ValueError("The engine argument is not supported. Use the model argument instead.")
-    return openai_create_raw(model=model, **kwargs)
+    return await aopenai_create_raw(model=model, **kwargs)
+
+
+@delegate(openai.Completion.create)
+def openai_create(model: str, **kwargs) -> str:
+    return run_sync(aopenai_create(model, **kwargs))
+
+
+class OutOfTokensError(ValueError):
+    """
+    The response was cut off by the token limit. What the model wrote before that is in `text`.
+    """
+
+    def __init__(self, message: str, text: str):
+        super().__init__(message)
+        self.text = text
 
 
 @dataclass(frozen=True)
@@ -144,7 +267,7 @@ class Result:
     response: str
 
 
-def complete(
+async def acomplete(
     context: str,
     prompt: Optional[str],
     pre_prompt: str,
@@ -204,7 +327,8 @@ def complete(
             start_response_token,
         ]
     )
-    num_input_tokens = toklen(total_prompt, model)
+    with profiler.stage("complete.prompt"):
+        num_input_tokens = toklen(total_prompt, model)
     if max_output_tokens is None:
         max_tokens = get_max_tokens(model)
         max_output_tokens = max_tokens - num_input_tokens
@@ -227,18 +351,49 @@ def complete(
     logger.info(f"Parameters: {request_params}")
     logger.info(f"Prompt: {total_prompt}")
 
-    text = openai_create(**request_params)
+    with profiler.stage("complete", prompt_tokens=num_input_tokens) as stage:
+        text = await aopenai_create(**request_params)
+        num_output_tokens = toklen(text, model)
+        stage.add("output_tokens", num_output_tokens)
     logger.info(f"Response (including end token): {text}")
     # If the response ran out of tokens, raise an exception
-    if toklen(text, model) == max_output_tokens + 1:
-        raise ValueError(
-            "Ran out of tokens. Try setting max_tokens higher."
+    if num_output_tokens == max_output_tokens + 1:
+        raise OutOfTokensError(
+            "Ran out of tokens. Try setting max_tokens higher.", text.replace(end_response_token, "")
         )
     # Remove the end token
     text = text.replace(end_response_token, "")
     return text
 
 
+def complete(
+    context: str,
+    prompt: Optional[str],
+    pre_prompt: str,
+    *,
+    examples: Optional[list[tuple[Task, Result]]] = None,
+    model: str = "gpt-3.5-turbo",
+    min_output_tokens: int = 1,
+    max_output_tokens: Optional[int] = None,
+    mark_examples: bool = False,
+) -> str:
+    """
+    Like `acomplete`, blocking until the response arrives.
+    """
+    return run_sync(
+        acomplete(
+            context,
+            prompt,
+            pre_prompt,
+            examples=examples,
+            model=model,
+            min_output_tokens=min_output_tokens,
+            max_output_tokens=max_output_tokens,
+            mark_examples=mark_examples,
+        )
+    )
+
+
 class TqdmLoggingHandler(logging.Handler):
     def emit(self, record):
         if record.levelno >= logging.ERROR:
@@ -252,103 +407,168 @@ class TqdmLoggingHandler(logging.Handler):
                 self.handleError(record)
 
 
-@cache_response
+# Batches of texts get_embeddings sends at once
+EMBEDDING_CONCURRENCY = 4
+
+
+@acache_response
+async def aget_embedding(text: str, mode: Literal["cohere", "openai"]) -> list[float]:
+    return await afetch_embedding(text, mode)
+
+
 def get_embedding(text: str, mode: Literal["cohere", "openai"]) -> list[float]:
-    if mode == "openai":
-        model = "text-embedding-ada-002"
+    return run_sync(aget_embedding(text, mode=mode))
 
-        # replace newlines, which can negatively affect performance.
-        text = text.replace("\n", " ")
 
-        return openai.Embedding.create(input=[text], model=model)["data"][0]["embedding"]
+async def afetch_embeddings(list_of_text: list[str], mode: Literal["cohere", "openai"]) -> list[list[float]]:
+    """
+    Returns the embeddings of the given texts from the API, bypassing the response cache.
+    """
+    if not list_of_text:
+        return []
+    if mode == "openai":
+        model = EMBEDDING_MODELS["openai"]
+        logger.info(f"Getting embeddings for {len(list_of_text)} texts.")
+        with profiler.stage(
+            "api.embeddings", texts=len(list_of_text), bytes=sum(len(text) for text in list_of_text)
+        ) as stage:
+            # Embeddings are idempotent, so slow requests are hedged
+            response = await resilience.acall(
+                "openai.embeddings",
+                lambda timeout: api_client.openai_request(
+                    "openai.embeddings", "/embeddings", {"input": list_of_text, "model": model}, timeout=timeout
+                ),
+                idempotent=True,
+                retry_if=is_transient,
+                # About four characters per token
+                before_attempt=lambda: rate_limit.aacquire(
+                    "openai.embeddings",
+                    sum(len(text) for text in list_of_text) // 4,
+                    api_key=openai.api_key,
+                    model=model,
+                ),
+            )
+            stage.add("tokens_sent", response["usage"]["prompt_tokens"])
+        data = sorted(response["data"], key=lambda x: x["index"])
+        return [d["embedding"] for d in data]
     elif mode == "cohere":
-        return list(co.embed([text]).embeddings[0])
+        if len(list_of_text) > cohere.COHERE_EMBED_BATCH_SIZE:
+            # Cohere takes fewer texts per request, so larger batches are split (and sent at once, as its client does)
+            batches = await asyncio.gather(
+                *(
+                    afetch_embeddings(list_of_text[start: start + cohere.COHERE_EMBED_BATCH_SIZE], mode)
+                    for start in range(0, len(list_of_text), cohere.COHERE_EMBED_BATCH_SIZE)
+                )
+            )
+            return [embedding for batch in batches for embedding in batch]
+        with profiler.stage(
+            "api.embeddings", texts=len(list_of_text), bytes=sum(len(text) for text in list_of_text)
+        ):
+            response = await resilience.acall(
+                "cohere.embeddings",
+                lambda timeout: api_client.cohere_request(
+                    "cohere.embeddings", "embed", {"texts": list_of_text}, timeout=timeout
+                ),
+                idempotent=True,
+                retry_if=is_transient,
+                before_attempt=lambda: rate_limit.aacquire("cohere.embeddings", api_key=os.environ.get("CO_API_KEY")),
+            )
+            return [list(embedding) for embedding in response["embeddings"]]
     else:
         raise ValueError(f"Invalid mode: {mode}")
 
 
-def get_embeddings(
+async def afetch_embedding(text: str, mode: Literal["cohere", "openai"]) -> list[float]:
+    """
+    Returns the embedding of the given text from the API, bypassing the response cache.
+    """
+    if mode == "openai":
+        # replace newlines, which can negatively affect performance.
+        text = text.replace("\n", " ")
+    return (await afetch_embeddings([text], mode))[0]
+
+
+def fetch_embedding(text: str, mode: Literal["cohere", "openai"]) -> list[float]:
+    """
+    Returns the embedding of the given text from the API, bypassing the response cache.
+    """
+    return run_sync(afetch_embedding(text, mode))
+
+
+async def aget_embeddings(
     list_of_text: list[str], model="text-embedding-ada-002", batch_size: Optional[int] = None, mode: Literal["cohere", "openai"] = "openai"
 ) -> list[list[float]]:
+    """
+    Returns the embeddings of the given texts, from the response cache where it has them. Texts that aren't cached are
+    sent in batches of `batch_size` (all at once if it's None), up to `EMBEDDING_CONCURRENCY` batches at a time, and the
+    cache is loaded and saved on worker threads, so that its I/O doesn't block the event loop.
+    """
     assert 0 < len(list_of_text) < 2048, "Must have between 1 and 2047 texts."
 
     list_of_text = [text.replace("\n", " ") for text in list_of_text]
 
-    cached_embeddings = []
-    uncached_texts = []
-
-
-    cache = load_cache()  # Load cache once
+    cache = await asyncio.to_thread(load_cache)  # Load cache once
 
+    found = {}
     for text in list_of_text:
         cache_key = get_cache_key(text=text, model=model, mode=mode)
         if check_cache_validity(cache, cache_key):
-            cached_embeddings.append(cache[cache_key]["response"])
-        else:
-            uncached_texts.append(text)
-
-    logger.info(f"{len(cached_embeddings)} embeddings in cache, {len(uncached_texts)} not in cache.")
-
-    def _get_embeddings(list_of_text: list[str]) -> list[list[float]]:
-        if len(list_of_text) == 0:
-            return []
-
-        if mode == "openai":
-            model = "text-embedding-ada-002"
-
-            create = retry(
-                wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3)
-            )(openai.Embedding.create)
-
-            logger.info(f"Getting embeddings for {len(list_of_text)} texts.")
-            response = create(input=list_of_text, model=model)
-            data = sorted(response.data, key=lambda x: x["index"])
-            return [d["embedding"] for d in data]
-        elif mode == "cohere":
-            return [list(embedding) for embedding in co.embed(list_of_text).embeddings]
-        else:
-            raise ValueError(f"Invalid mode: {mode}")
-
-
-    if batch_size is None:
-        uncached_embeddings = _get_embeddings(uncached_texts)
+            found[text] = cache[cache_key]["response"]
+    uncached_texts = [text for text in dict.fromkeys(list_of_text) if text not in found]
+
+    logger.info(f"{len(found)} embeddings in cache, {len(uncached_texts)} not in cache.")
+    profiler.count("cache.embeddings.hits", len(list_of_text) - len(uncached_texts))
+    profiler.count("cache.embeddings.misses", len(uncached_texts))
+
+    # Cache keys of expired embeddings used because the API was unavailable, which keep their old timestamps
+    stale_keys = set()
+
+    async def get_embeddings_or_stale(list_of_text: list[str]) -> list[list[float]]:
+        try:
+            return await afetch_embeddings(list_of_text, mode)
+        except Exception as e:
+            # While the API is unavailable, expired cached embeddings are better than none
+            keys = [get_cache_key(text=text, model=model, mode=mode) for text in list_of_text]
+            if not is_transient(e) or not all(key in cache for key in keys):
+                raise
+            logger.warning(f"The API is unavailable ({type(e).__name__}). Using {len(keys)} expired cached embeddings.")
+            profiler.count("cache.embeddings.stale", len(keys))
+            stale_keys.update(keys)
+            return [cache[key]["response"] for key in keys]
+
+    if uncached_texts:
+        step = batch_size or len(uncached_texts)
+        batches = [uncached_texts[i: i + step] for i in range(0, len(uncached_texts), step)]
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        pbar = tqdm(total=len(uncached_texts), desc="Getting embeddings", disable=batch_size is None)
+
+        async def get_batch(batch: list[str]) -> list[list[float]]:
+            async with semaphore:
+                batch_embeddings = await get_embeddings_or_stale(batch)
+            pbar.update(len(batch))
+            return batch_embeddings
+
+        uncached_embeddings = [
+            embedding for batch_embeddings in await asyncio.gather(*map(get_batch, batches))
+            for embedding in batch_embeddings
+        ]
+        pbar.close()
+        found.update(zip(uncached_texts, uncached_embeddings))
 
+        new_entries = {}
         for text, embedding in zip(uncached_texts, uncached_embeddings):
             cache_key = get_cache_key(text=text, model=model, mode=mode)
-            cache[cache_key] = {"response": embedding, "timestamp": time.time()}
-    else:
-        uncached_embeddings = []
-
-        pbar = tqdm(total=len(list_of_text), desc="Getting embeddings")
-
-        for i in range(0, len(uncached_texts), batch_size):
-            batch = uncached_texts[i: i + batch_size]
-            batch_embeddings = _get_embeddings(batch)
-            uncached_embeddings.extend(batch_embeddings)
+            if cache_key not in stale_keys:
+                new_entries[cache_key] = embedding
+        await asyncio.to_thread(store_responses, new_entries)  # Save cache once
 
-            for text, embedding in zip(batch, batch_embeddings):
-                cache_key = get_cache_key(text=text, model=model, mode=mode)
-                cache[cache_key] = {"response": embedding, "timestamp": time.time()}
+    return [found[text] for text in list_of_text]
 
-            pbar.update(batch_size)
-            pbar.set_description(f"Processing {i + batch_size}/{len(list_of_text)} texts")
-            pbar.refresh()
 
-        pbar.close()
-
-    save_cache(cache)  # Save cache once
-
-    embeddings = []
-    embedding_index = 0
-    for text in list_of_text:
-        cache_key = get_cache_key(text=text, model=model, mode=mode)
-        if check_cache_validity(cache, cache_key):
-            embeddings.append(cache[cache_key]["response"])
-        else:
-            embeddings.append(uncached_embeddings[embedding_index])
-            embedding_index += 1
-
-    return embeddings
+def get_embeddings(
+    list_of_text: list[str], model="text-embedding-ada-002", batch_size: Optional[int] = None, mode: Literal["cohere", "openai"] = "openai"
+) -> list[list[float]]:
+    return run_sync(aget_embeddings(list_of_text, model=model, batch_size=batch_size, mode=mode))
 
 
 def get_cache_key(text: str, model: str, mode: Literal["cohere", "openai"]) -> str:
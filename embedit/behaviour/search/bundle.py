@@ -0,0 +1,278 @@
+"""
+Portable index bundles, for building an index once (e.g. in CI) and sharing it.
+
+A bundle is an uncompressed zip (so an `.npz`) of the fragment columns and embeddings as `.npy` members, plus a
+`manifest.json` with the format version, the embedding model, the chunking parameters, the files (by path relative to
+a root, with their content digests) and a SHA-256 checksum of every member. Members are stored aligned, so they're
+memory-mapped straight out of the bundle rather than unpacked. On import, only files whose contents match the bundle
+take its embeddings; the rest are re-embedded.
+"""
+import hashlib
+import io
+import json
+import os
+import struct
+import zipfile
+from pathlib import Path
+from typing import Literal
+from typing import Optional
+
+import numpy as np
+from attrs import define
+
+from embedit.behaviour.openai_tools import EMBEDDING_MODELS
+from embedit.behaviour.search.index import DEFAULT_INDEX_DIR
+from embedit.behaviour.search.index import IndexEntry
+from embedit.behaviour.search.index import SearchIndex
+from embedit.behaviour.search.index import content_digest
+from embedit.behaviour.search.index import file_stat
+from embedit.structures.fragment_table import FragmentTable
+from embedit.utils.log import logger
+from embedit.utils.profile import profiled
+from embedit.utils.profile import profiler
+
+# Bumped whenever the layout of bundles changes
+BUNDLE_FORMAT = 1
+MANIFEST = "manifest.json"
+COLUMNS = ("byte_starts", "byte_ends", "start_lines", "end_lines")
+# Members' data starts on a multiple of this many bytes, so that memory-mapped arrays are aligned
+ALIGNMENT = 64
+# Zip extra field ID for alignment padding (the one zipalign uses)
+PADDING_EXTRA_ID = 0xD935
+HASH_CHUNK_BYTES = 1 << 24
+
+
+class BundleError(ValueError):
+    pass
+
+
+def npy_header(array: np.ndarray) -> bytes:
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(array))
+    return header.getvalue()
+
+
+def write_member(zf: zipfile.ZipFile, name: str, array: np.ndarray) -> str:
+    """
+    Write an array as an aligned, uncompressed `.npy` member and return the SHA-256 of its bytes.
+    """
+    array = np.ascontiguousarray(array)
+    header = npy_header(array)
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = len(header) + array.nbytes
+    # As ZipFile sets them when opening the member for writing, so that the local header is the length it'll be
+    info.compress_size, info.CRC = 0, 0
+    zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    offset = zf.fp.tell()
+    padding = -(offset + len(info.FileHeader(zip64)) + 4 + len(header)) % ALIGNMENT
+    info.extra = struct.pack("<HH", PADDING_EXTRA_ID, padding) + b"\0" * padding
+    digest = hashlib.sha256()
+    with zf.open(info, "w") as f:
+        for chunk in [header, memoryview(array).cast("B")]:
+            for start in range(0, len(chunk), HASH_CHUNK_BYTES):
+                f.write(chunk[start: start + HASH_CHUNK_BYTES])
+                digest.update(chunk[start: start + HASH_CHUNK_BYTES])
+    return digest.hexdigest()
+
+
+def member_offset(path: Path, info: zipfile.ZipInfo) -> int:
+    # The data of a member starts after its local header, whose name and extra fields can differ from the central
+    # directory's
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def map_member(path: Path, info: zipfile.ZipInfo) -> np.ndarray:
+    """
+    Memory-map an uncompressed `.npy` member of a zip.
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise BundleError(f"{info.filename} in {path} is compressed, so it can't be memory-mapped")
+    with open(path, "rb") as f:
+        f.seek(member_offset(path, info))
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not np.prod(shape):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+
+def member_digest(path: Path, info: zipfile.ZipInfo) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(member_offset(path, info))
+        remaining = info.file_size
+        while remaining:
+            chunk = f.read(min(remaining, HASH_CHUNK_BYTES))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+@define(frozen=True)
+class Bundle:
+    path: Path
+    manifest: dict
+    columns: dict[str, np.ndarray]
+    embeddings: np.ndarray
+
+    @classmethod
+    @profiled("bundle.open")
+    def open(cls, path: str, *, verify: bool = True) -> "Bundle":
+        """
+        Open a bundle, memory-mapping its arrays.
+
+        :param verify: Check every member against the checksums in the manifest first.
+        :raises BundleError: If the bundle is unreadable, of an unsupported format, or corrupt.
+        """
+        path = Path(path)
+        try:
+            with zipfile.ZipFile(path) as zf:
+                manifest = json.loads(zf.read(MANIFEST))
+                infos = {info.filename: info for info in zf.infolist()}
+        except (zipfile.BadZipFile, KeyError, json.JSONDecodeError) as e:
+            raise BundleError(f"{path} isn't an index bundle ({e})") from e
+        if manifest.get("format") != BUNDLE_FORMAT:
+            raise BundleError(f"{path} has unsupported bundle format {manifest.get('format')}")
+        for name, checksum in manifest["members"].items():
+            if name not in infos:
+                raise BundleError(f"{path} is missing {name}")
+            if verify and member_digest(path, infos[name]) != checksum:
+                raise BundleError(f"{name} in {path} doesn't match its checksum")
+        columns = {column: map_member(path, infos[f"{column}.npy"]) for column in COLUMNS}
+        embeddings = map_member(path, infos["embeddings.npy"])
+        rows = sum(file["rows"] for file in manifest["files"])
+        if any(len(column) != rows for column in columns.values()) or (rows and len(embeddings) != rows):
+            raise BundleError(f"{path} has {rows} fragments in its manifest but arrays of other lengths")
+        return cls(path=path, manifest=manifest, columns=columns, embeddings=embeddings)
+
+
+@profiled("bundle.export")
+def export_index(bundle_path: str, *, index_dir: str = DEFAULT_INDEX_DIR, root: str = ".") -> int:
+    """
+    Write the index saved in `index_dir` to a bundle, with paths relative to `root`. Files outside `root` are left out.
+
+    :return: The number of files exported.
+    """
+    index = SearchIndex.load(index_dir)
+    if index is None:
+        raise BundleError(f"There's no index in {index_dir}. Build one with `embedit index` first.")
+    root_path = Path(root).resolve()
+    snapshot = index.snapshot
+    files = []
+    path_ids = []
+    for path_id, path in enumerate(snapshot.paths):
+        try:
+            relative = path.relative_to(root_path)
+        except ValueError:
+            logger.warning(f"Not exporting {path}, which is outside {root_path}")
+            continue
+        entry = index.entries[path]
+        files.append({"path": relative.as_posix(), "digest": entry.digest, "rows": len(entry.table)})
+        path_ids.append(path_id)
+    table = snapshot.select(np.isin(snapshot.path_ids, path_ids))
+    embeddings = table.embedding_matrix() if table.embeddings is not None else np.empty((0, 0), np.float32)
+    bundle_path = Path(bundle_path)
+    tmp_path = bundle_path.with_name(f".{bundle_path.name}.{os.getpid()}.tmp")
+    with profiler.stage("bundle.write", rows=len(table), bytes=embeddings.nbytes):
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as zf:
+            members = {f"{column}.npy": write_member(zf, f"{column}.npy", getattr(table, column)) for column in COLUMNS}
+            members["embeddings.npy"] = write_member(zf, "embeddings.npy", embeddings)
+            manifest = {
+                "format": BUNDLE_FORMAT,
+                "model": EMBEDDING_MODELS[index.mode],
+                "mode": index.mode,
+                "dimensions": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+                "fragment_lines": index.fragment_lines,
+                "min_fragment_lines": index.min_fragment_lines,
+                "chunking": index.chunking,
+                "files": files,
+                "members": members,
+            }
+            zf.writestr(MANIFEST, json.dumps(manifest, indent=1))
+        os.replace(tmp_path, bundle_path)
+    logger.warning(f"Exported {len(files)} files ({len(table)} fragments) to {bundle_path}")
+    return len(files)
+
+
+@profiled("bundle.import")
+def import_index(
+    bundle_path: str,
+    *,
+    index_dir: str = DEFAULT_INDEX_DIR,
+    root: str = ".",
+    mode: Optional[Literal["openai", "cohere"]] = None,
+    verify: bool = True,
+) -> SearchIndex:
+    """
+    Build the index in `index_dir` from a bundle, checked against the files under `root`: files whose contents match
+    take their fragments and embeddings from the bundle, files that differ are re-split and re-embedded, and files that
+    don't exist locally are dropped.
+
+    :param mode: If given, refuse bundles embedded in another mode.
+    :param verify: Check the bundle against its checksums first.
+    :raises BundleError: If the bundle is corrupt, was embedded with another model, or has files outside `root`.
+    """
+    bundle = Bundle.open(bundle_path, verify=verify)
+    manifest = bundle.manifest
+    if mode is not None and manifest["mode"] != mode:
+        raise BundleError(f"{bundle_path} was embedded with {manifest['model']}, not in {mode} mode")
+    if manifest["model"] != EMBEDDING_MODELS.get(manifest["mode"]):
+        raise BundleError(f"{bundle_path} was embedded with {manifest['model']}, which this version doesn't use")
+    root_path = Path(root).resolve()
+    # Checked before any file is read, so that a crafted bundle can't have files outside the root sent to be embedded
+    for file in manifest["files"]:
+        relative = Path(file["path"])
+        if relative.is_absolute() or not (root_path / relative).resolve().is_relative_to(root_path):
+            raise BundleError(f"{bundle_path} has a file outside {root_path}: {file['path']}")
+    entries = {}
+    changed = []
+    missing = 0
+    offset = 0
+    with profiler.stage("bundle.validate", files=len(manifest["files"])) as stage:
+        for file in manifest["files"]:
+            rows = slice(offset, offset + file["rows"])
+            offset += file["rows"]
+            path = (root_path / file["path"]).resolve()
+            try:
+                stat = file_stat(path)
+                buffer = path.read_bytes()
+            except FileNotFoundError:
+                missing += 1
+                continue
+            if content_digest(buffer) != file["digest"]:
+                changed.append(str(path))
+                continue
+            table = FragmentTable.from_columns(
+                paths=[path],
+                buffers=[buffer],
+                path_ids=np.zeros(file["rows"], dtype=np.int32),
+                **{column: bundle.columns[column][rows] for column in COLUMNS},
+            ).with_embeddings(bundle.embeddings[rows])
+            entries[path] = IndexEntry(path=path, stat=stat, digest=file["digest"], table=table)
+        stage.add("matched", len(entries))
+        stage.add("changed", len(changed))
+    index = SearchIndex.from_entries(
+        entries,
+        fragment_lines=manifest["fragment_lines"],
+        min_fragment_lines=manifest["min_fragment_lines"],
+        mode=manifest["mode"],
+        chunking=manifest.get("chunking", "fixed"),
+    )
+    logger.warning(
+        f"Imported {len(entries)} files from {bundle_path}; re-embedding {len(changed)} changed files"
+        + (f" ({missing} files in the bundle don't exist here)" if missing else "")
+    )
+    index.update(changed)
+    index.save(index_dir)
+    return index
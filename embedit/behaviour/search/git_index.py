@@ -0,0 +1,308 @@
+"""
+Index and search any revision of a git repository straight from its object database, without a checkout.
+
+Fragments and embeddings are keyed by blob SHA rather than by path and mtime, so a version of a file is split and
+embedded once, whichever revisions, branches or paths it turns up in. Switching branches or searching an old release
+only embeds the blobs that have never been seen before.
+"""
+import fnmatch
+import os
+import time
+from pathlib import Path
+from pathlib import PurePosixPath
+from typing import Literal
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from attrs import define
+from attrs import field
+from git import Blob
+from git import Repo
+
+from embedit.behaviour.search import query_cache
+from embedit.behaviour.search.pipeline_components.a02_split import Chunking
+from embedit.behaviour.search.pipeline_components.a02_split import split_buffers
+from embedit.behaviour.search.pipeline_components.a03_process.search import embed_table
+from embedit.behaviour.search.pipeline_components.a03_process.search import log_similarity_stats
+from embedit.behaviour.search.pipeline_components.a03_process.search import top_rows
+from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.fragment_table import FragmentTable
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+SYMLINK_MODE = 0o120000
+# Blobs with a NUL byte in this many leading bytes are treated as binary and not indexed
+BINARY_SNIFF_BYTES = 8000
+
+
+@define
+class Segment:
+    shas: np.ndarray
+    row_starts: np.ndarray
+    columns: dict[str, np.ndarray]
+    embeddings: np.ndarray
+
+
+@define
+class BlobStore:
+    """
+    Split and embedded blobs, keyed by SHA.
+
+    The store is a directory of append-only segments: each `save` writes the blobs added since the last one as a new
+    segment (`<name>.npy` for the embeddings, then `<name>.npz` for the fragment columns, which marks the segment as
+    complete). Embeddings are memory-mapped when loaded. Blobs without fragments (empty, binary or too short) are
+    recorded too, so they aren't read again.
+    """
+
+    store_dir: Path
+    mode: Literal["openai", "cohere"] = "openai"
+    segments: list[Segment] = field(factory=list)
+    blobs: dict[str, tuple[int, int, int]] = field(factory=dict)
+    pending: list[tuple[str, FragmentTable]] = field(factory=list)
+
+    @classmethod
+    def open(cls, store_dir: Path, *, mode: Literal["openai", "cohere"] = "openai") -> "BlobStore":
+        store = cls(store_dir=Path(store_dir), mode=mode)
+        if store.store_dir.is_dir():
+            for path in sorted(store.store_dir.glob("*.npz")):
+                with np.load(path) as segment:
+                    columns = {key: segment[key] for key in segment.files}
+                embeddings = np.load(path.with_suffix(".npy"), mmap_mode="r")
+                store._add_segment(columns.pop("shas"), columns.pop("rows"), columns, embeddings)
+        return store
+
+    def _add_segment(self, shas: np.ndarray, rows: np.ndarray, columns: dict[str, np.ndarray], embeddings: np.ndarray):
+        row_starts = np.concatenate([[0], np.cumsum(rows)]).astype(np.int64)
+        segment_id = len(self.segments)
+        self.segments.append(Segment(shas=shas, row_starts=row_starts, columns=columns, embeddings=embeddings))
+        for i, sha in enumerate(shas):
+            self.blobs[str(sha)] = (segment_id, int(row_starts[i]), int(row_starts[i + 1]))
+
+    def __contains__(self, sha: str) -> bool:
+        return sha in self.blobs
+
+    def add(self, sha: str, table: FragmentTable):
+        """
+        Add an embedded blob, to be written by the next `save`.
+        """
+        self.pending.append((sha, table))
+
+    def save(self):
+        if not self.pending:
+            return
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        shas = np.array([sha for sha, _ in self.pending])
+        rows = np.array([len(table) for _, table in self.pending], dtype=np.int64)
+        table = FragmentTable.concat([table for _, table in self.pending])
+        columns = {
+            "byte_starts": table.byte_starts,
+            "byte_ends": table.byte_ends,
+            "start_lines": table.start_lines,
+            "end_lines": table.end_lines,
+        }
+        embeddings = table.embedding_matrix() if table.embeddings is not None else np.empty((0, 0), np.float32)
+        # Unique, and ordered by creation time
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        with open(self.store_dir / f"{name}.npy.tmp", "wb") as f:
+            np.save(f, embeddings)
+        os.replace(self.store_dir / f"{name}.npy.tmp", self.store_dir / f"{name}.npy")
+        with open(self.store_dir / f"{name}.npz.tmp", "wb") as f:
+            np.savez(f, shas=shas, rows=rows, **columns)
+        os.replace(self.store_dir / f"{name}.npz.tmp", self.store_dir / f"{name}.npz")
+        self._add_segment(shas, rows, columns, embeddings)
+        self.pending = []
+
+    def rows(self, sha: str) -> tuple[int, int, int]:
+        """
+        Return the segment and the range of rows in it that hold the fragments of a blob.
+        """
+        return self.blobs[sha]
+
+
+@define(frozen=True)
+class RevisionFile:
+    path: str
+    blob: Blob
+
+
+def default_store_dir(
+    repo: Repo, *, fragment_lines: int, min_fragment_lines: int, mode: str, chunking: Chunking = "fixed"
+) -> Path:
+    # Inside the git directory, where checkouts don't touch it
+    suffix = "" if chunking == "fixed" else f"-{chunking}"
+    return Path(repo.git_dir) / "embedit" / f"blobs-{fragment_lines}-{min_fragment_lines}-{mode}{suffix}"
+
+
+def revision_files(
+    repo: Repo, rev: str, *paths: str, include: Optional[Sequence[str]] = None
+) -> list[RevisionFile]:
+    """
+    List the regular files in the tree of a revision.
+
+    :param paths: If given, only list files at or under these paths (relative to the root of the repository).
+    :param include: If given, only list files whose names match one of these glob patterns.
+    """
+    prefixes = [PurePosixPath(path).as_posix().strip("/") for path in paths]
+    prefixes = [prefix for prefix in prefixes if prefix not in ("", ".")]
+    files = []
+    with profiler.stage("git.tree") as stage:
+        for item in repo.commit(rev).tree.traverse(predicate=lambda item, depth: item.type == "blob"):
+            if item.mode == SYMLINK_MODE:
+                continue
+            if prefixes and not any(item.path == prefix or item.path.startswith(prefix + "/") for prefix in prefixes):
+                continue
+            if include and not any(fnmatch.fnmatch(item.name, pattern) for pattern in include):
+                continue
+            files.append(RevisionFile(path=item.path, blob=item))
+        stage.add("files", len(files))
+    return files
+
+
+def read_blob(blob: Blob) -> bytes:
+    return blob.data_stream.read()
+
+
+def update_blob_store(
+    store: BlobStore,
+    files: Sequence[RevisionFile],
+    *,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    chunking: Chunking = "fixed",
+) -> int:
+    """
+    Split and embed the blobs of the given files that aren't in the store yet, and save them to it.
+
+    :return: The number of blobs that were added.
+    """
+    unseen = {file.blob.hexsha: file for file in files if file.blob.hexsha not in store}
+    if not unseen:
+        return 0
+    with profiler.stage("git.blobs", blobs=len(unseen)) as stage:
+        tables = []
+        for sha, file in unseen.items():
+            buffer = read_blob(file.blob)
+            stage.add("bytes", len(buffer))
+            if b"\0" in buffer[:BINARY_SNIFF_BYTES]:
+                buffer = b""
+            table = split_buffers([Path(file.path)], [buffer], fragment_lines=fragment_lines, chunking=chunking)
+            tables.append(table.select(table.line_counts >= min_fragment_lines))
+    logger.info(f"Embedding {sum(map(len, tables))} fragments from {len(unseen)} new blobs")
+    embedded = embed_table(FragmentTable.concat(tables), mode=store.mode)
+    offset = 0
+    for sha, table in zip(unseen, tables):
+        if embedded.embeddings is not None:
+            table = table.with_embeddings(embedded.embeddings[offset: offset + len(table)])
+        offset += len(table)
+        store.add(sha, table)
+    store.save()
+    return len(unseen)
+
+
+def open_repo(repo_path: str = ".") -> Repo:
+    return Repo(repo_path, search_parent_directories=True)
+
+
+def repo_relative_paths(repo: Repo, paths: Sequence[str]) -> list[str]:
+    # Make paths relative to the working directory (as on the command line) relative to the root of the repository
+    if repo.working_tree_dir is None:
+        return list(paths)
+    return [os.path.relpath(os.path.abspath(path), repo.working_tree_dir) for path in paths]
+
+
+def index_revision(
+    rev: str = "HEAD",
+    *paths: str,
+    repo_path: str = ".",
+    include: Optional[Sequence[str]] = None,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    store_dir: Optional[str] = None,
+) -> BlobStore:
+    """
+    Make sure every blob in a revision (or under the given paths in it, relative to the root of the repository) is
+    split and embedded.
+    """
+    repo = open_repo(repo_path)
+    if store_dir is None:
+        store_dir = default_store_dir(
+            repo, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+        )
+    store = BlobStore.open(Path(store_dir), mode=mode)
+    files = revision_files(repo, rev, *paths, include=include)
+    added = update_blob_store(
+        store, files, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, chunking=chunking
+    )
+    logger.warning(f"Indexed {len(files)} files at {rev} ({added} new blobs)")
+    return store
+
+
+def search_revision(
+    query: str,
+    rev: str = "HEAD",
+    *paths: str,
+    repo_path: str = ".",
+    include: Optional[Sequence[str]] = None,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    store_dir: Optional[str] = None,
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Return the fragments of the files in a revision (or under the given paths in it, relative to the root of the
+    repository) that are similar to the query, embedding any blobs the store hasn't seen first. Results are named
+    `<rev>:<path>`, as in `git show`.
+    """
+    repo = open_repo(repo_path)
+    if store_dir is None:
+        store_dir = default_store_dir(
+            repo, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+        )
+    store = BlobStore.open(Path(store_dir), mode=mode)
+    files = revision_files(repo, rev, *paths, include=include)
+    update_blob_store(
+        store, files, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, chunking=chunking
+    )
+    # Embed the query
+    logger.info(f"Embedding the query")
+    embedding = query_cache.embed_query(query, mode=mode)
+    with profiler.stage("similarity"):
+        # Score every segment that holds fragments of the revision
+        placements = [store.rows(file.blob.hexsha) for file in files]
+        scores = {}
+        for segment_id in {segment_id for segment_id, start, stop in placements if start < stop}:
+            matrix = store.segments[segment_id].embeddings
+            scores[segment_id] = matrix @ embedding / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(embedding))
+        # Gather the scores of the revision's fragments, in file order
+        lengths = np.array([stop - start for _, start, stop in placements], dtype=np.int64)
+        if not lengths.sum():
+            return []
+        similarities = np.concatenate(
+            [scores[segment_id][start:stop] for segment_id, start, stop in placements if start < stop]
+        )
+        log_similarity_stats(similarities)
+    owners = np.repeat(np.arange(len(files)), lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    results = []
+    for i in top_rows(similarities, top_n=top_n, threshold=threshold):
+        owner = owners[i]
+        segment_id, start, _ = placements[owner]
+        segment = store.segments[segment_id]
+        row = start + int(i - offsets[owner])
+        table = FragmentTable.from_columns(
+            paths=[Path(f"{rev}:{files[owner].path}")],
+            buffers=[read_blob(files[owner].blob)],
+            path_ids=[0],
+            byte_starts=segment.columns["byte_starts"][row: row + 1],
+            byte_ends=segment.columns["byte_ends"][row: row + 1],
+            start_lines=segment.columns["start_lines"][row: row + 1],
+            end_lines=segment.columns["end_lines"][row: row + 1],
+        ).with_embeddings(segment.embeddings[row: row + 1])
+        results.append(table.similarity_result(0, similarities[i]))
+    return results
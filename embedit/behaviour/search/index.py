@@ -0,0 +1,601 @@
+"""
+A resident search index that only re-splits and re-embeds files whose contents have changed.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Iterator
+from typing import Literal
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+import tiktoken
+from attrs import define
+from attrs import field
+
+from embedit.behaviour.search.pipeline_components.a01_gather import expand_paths
+from embedit.behaviour.search.pipeline_components.a01_gather import path_filter
+from embedit.behaviour.search.pipeline_components.a02_split import Chunking
+from embedit.behaviour.search.pipeline_components.a02_split import split_buffers
+from embedit.behaviour.search.pipeline_components.a03_process.search import MAX_TEXTS_PER_CALL
+from embedit.behaviour.search.pipeline_components.a03_process.search import embed_texts
+from embedit.structures.fragment_table import FragmentTable
+from embedit.utils.log import logger
+from embedit.utils.profile import profiled
+from embedit.utils.profile import profiler
+from embedit.utils.tokens import clip_tokens
+from embedit.utils.tokens import encoding_name
+from embedit.utils.tokens import estimate_tokens
+from embedit.utils.tokens import get_encoding
+from embedit.utils.watch import watch as watch_changes
+
+# Bumped whenever the on-disk layout changes
+INDEX_FORMAT = 1
+DEFAULT_INDEX_DIR = ".embedit/index"
+# Fragments are clipped to this many tokens before they're embedded (the embedding model's input limit)
+MAX_EMBEDDING_TOKENS = 8191
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Files prepared per task in the pool, and the fewest changed files worth starting a pool for
+PREPARE_CHUNK_FILES = 64
+PARALLEL_MIN_FILES = 512
+
+
+def file_stat(path: Path) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def content_digest(buffer: bytes) -> str:
+    return hashlib.sha1(buffer).hexdigest()
+
+
+def text_digests(texts: Sequence[str]) -> np.ndarray:
+    """
+    A 64-bit digest of each fragment's text, as it's normalised for embedding (before clipping), to recognise fragments
+    whose embeddings can be reused after their file changes.
+    """
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(text.replace("\n", " ").encode(), digest_size=8).digest(), "little")
+            for text in texts
+        ],
+        dtype=np.uint64,
+    )
+
+
+def files_table(snapshot: FragmentTable, files: Optional[Sequence[str]] = None) -> FragmentTable:
+    """
+    Select the fragments of the given files (or of every file) from a snapshot, e.g. one taken with its version from
+    `SearchIndex.current`, so that the rows match the version even if the index is updated meanwhile.
+    """
+    if files is None:
+        return snapshot
+    wanted = {Path(file).resolve() for file in files}
+    path_ids = [path_id for path_id, path in enumerate(snapshot.paths) if path in wanted]
+    return snapshot.select(np.isin(snapshot.path_ids, path_ids))
+
+
+@define(frozen=True)
+class IndexEntry:
+    path: Path
+    stat: tuple[int, int]
+    digest: str
+    table: FragmentTable
+    # The digests of the fragments' texts, computed from the table if not given
+    text_digests: Optional[np.ndarray] = field(default=None, eq=False, repr=False)
+
+    def fragment_digests(self) -> np.ndarray:
+        if self.text_digests is not None:
+            return self.text_digests
+        return text_digests(self.table.texts())
+
+
+def embedding_encoding() -> Optional[tiktoken.Encoding]:
+    # The encoding of text-embedding-ada-002 (None if its data can't be loaded)
+    return get_encoding(encoding_name(EMBEDDING_MODEL))
+
+
+@define(frozen=True)
+class PreparedFile:
+    """
+    A file read, split and ready to embed: the texts are its fragments as they're sent to the API.
+    """
+
+    path: Path
+    stat: tuple[int, int]
+    digest: str
+    table: FragmentTable
+    texts: list[str]
+    text_digests: np.ndarray
+    tokens: int
+
+
+def prepare_file(
+    path: Path, *, fragment_lines: int = 20, min_fragment_lines: int = 0, chunking: Chunking = "fixed"
+) -> Optional[PreparedFile]:
+    """
+    Read and split a file, and normalise, count and clip the tokens of its fragments for embedding.
+
+    :return: The prepared file, or None if it doesn't exist.
+    """
+    try:
+        stat = file_stat(path)
+        buffer = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    table = split_buffers([path], [buffer], fragment_lines=fragment_lines, chunking=chunking)
+    table = table.select(table.line_counts >= min_fragment_lines)
+    encoding = embedding_encoding()
+    raw_texts = table.texts()
+    texts = []
+    tokens = 0
+    for text in raw_texts:
+        # As get_embeddings does
+        text = text.replace("\n", " ")
+        if encoding is None:
+            text = clip_tokens(text, MAX_EMBEDDING_TOKENS, EMBEDDING_MODEL)
+            texts.append(text)
+            tokens += estimate_tokens(text, EMBEDDING_MODEL)
+            continue
+        token_ids = encoding.encode(text, disallowed_special=())
+        if len(token_ids) > MAX_EMBEDDING_TOKENS:
+            token_ids = token_ids[:MAX_EMBEDDING_TOKENS]
+            text = encoding.decode(token_ids)
+        texts.append(text)
+        tokens += len(token_ids)
+    return PreparedFile(
+        path=path,
+        stat=stat,
+        digest=content_digest(buffer),
+        table=table,
+        texts=texts,
+        text_digests=text_digests(raw_texts),
+        tokens=tokens,
+    )
+
+
+def previous_embeddings(entry: Optional[IndexEntry]) -> dict[int, np.ndarray]:
+    """
+    The embeddings of an entry's fragments, by the digests of their texts.
+    """
+    if entry is None or not len(entry.table) or entry.table.embeddings is None:
+        return {}
+    return dict(zip(entry.fragment_digests().tolist(), entry.table.embedding_matrix()))
+
+
+def _prepare_chunk(
+    paths: list[Path], fragment_lines: int, min_fragment_lines: int, chunking: Chunking
+) -> list[Optional[PreparedFile]]:
+    return [
+        prepare_file(path, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, chunking=chunking)
+        for path in paths
+    ]
+
+
+def prepare_files(
+    paths: Sequence[Path],
+    *,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    chunking: Chunking = "fixed",
+    workers: Optional[int] = None,
+) -> Iterator[Optional[PreparedFile]]:
+    """
+    Prepare files (see `prepare_file`), yielding them in order as they're ready. Many files are spread over a pool of
+    processes, which keep working ahead while the caller handles (e.g. embeds) the files already yielded.
+
+    :param workers: The number of processes (default: one per CPU). 0 prepares the files in this process.
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if workers <= 1 or len(paths) < PARALLEL_MIN_FILES:
+        for path in paths:
+            yield prepare_file(
+                path, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, chunking=chunking
+            )
+        return
+    chunks = [list(paths[start: start + PREPARE_CHUNK_FILES]) for start in range(0, len(paths), PREPARE_CHUNK_FILES)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for prepared in pool.map(
+            _prepare_chunk, chunks, repeat(fragment_lines), repeat(min_fragment_lines), repeat(chunking)
+        ):
+            yield from prepared
+
+
+@define
+class SearchIndex:
+    """
+    Embedded fragments for a set of files, kept up to date by `update`.
+
+    Files are identified by their resolved path. A file is re-read only when its mtime or size changes, and re-split
+    and re-embedded only when its contents have. The snapshot and its version are published in one assignment, so
+    readers never see a half-updated index.
+    """
+
+    fragment_lines: int = 20
+    min_fragment_lines: int = 0
+    mode: Literal["openai", "cohere"] = "openai"
+    chunking: Chunking = "fixed"
+    entries: dict[Path, IndexEntry] = field(factory=dict)
+    # The embeddings of files that changed since the index was saved, by the digests of their fragments' texts, so that
+    # `update` re-embeds only the fragments that changed
+    stale: dict[Path, dict[int, np.ndarray]] = field(factory=dict, repr=False)
+    _state: tuple[str, FragmentTable] = field(factory=lambda: ("", FragmentTable.concat([])), repr=False)
+    _lock: threading.Lock = field(factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_entries(
+        cls,
+        entries: dict[Path, IndexEntry],
+        *,
+        fragment_lines: int = 20,
+        min_fragment_lines: int = 0,
+        mode: Literal["openai", "cohere"] = "openai",
+        chunking: Chunking = "fixed",
+    ) -> "SearchIndex":
+        """
+        Make an index of entries that are already split and embedded, e.g. loaded from disk.
+        """
+        index = cls(fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking)
+        index._publish(entries)
+        return index
+
+    def update(self, files: Sequence[str], *, prune: bool = False, workers: Optional[int] = None) -> bool:
+        """
+        Bring the entries for the given files up to date. Changed files are read and split by a pool of processes if
+        there are many of them, and their fragments are embedded in batches as they arrive.
+
+        :param files: The files to index.
+        :param prune: Whether to drop entries for files that weren't given.
+        :param workers: The number of processes to prepare changed files with (default: one per CPU, 0 for none).
+        :return: Whether the index changed.
+        """
+        with self._lock, profiler.stage("index.update") as profile_stage:
+            entries = dict(self.entries)
+            changed = False
+            candidates = []
+            paths = [Path(file).resolve() for file in files]
+            for path in paths:
+                try:
+                    stat = file_stat(path)
+                except FileNotFoundError:
+                    changed |= entries.pop(path, None) is not None
+                    continue
+                entry = entries.get(path)
+                if entry is not None and entry.stat == stat:
+                    continue
+                candidates.append(path)
+            if prune:
+                wanted = set(paths)
+                for path in [path for path in entries if path not in wanted]:
+                    changed = True
+                    del entries[path]
+            batch: list[PreparedFile] = []
+
+            def embed_batch():
+                # Fragments whose text is unchanged keep their embeddings, so only new fragments are embedded
+                reused = [
+                    previous_embeddings(entries.get(prepared.path)) or self.stale.get(prepared.path, {})
+                    for prepared in batch
+                ]
+                texts = [
+                    text
+                    for prepared, previous in zip(batch, reused)
+                    for text, digest in zip(prepared.texts, prepared.text_digests.tolist())
+                    if digest not in previous
+                ]
+                num_reused = sum(len(prepared.texts) for prepared in batch) - len(texts)
+                logger.info(
+                    f"Embedding {len(texts)} fragments from {len(batch)} changed files"
+                    f" ({num_reused} unchanged fragments reused)"
+                )
+                profile_stage.add("fragments", len(texts) + num_reused)
+                profile_stage.add("reused_fragments", num_reused)
+                embeddings = iter(embed_texts(texts, mode=self.mode))
+                for prepared, previous in zip(batch, reused):
+                    rows = [
+                        previous[digest] if digest in previous else next(embeddings)
+                        for digest in prepared.text_digests.tolist()
+                    ]
+                    matrix = np.array(rows, dtype=np.float32) if rows else np.zeros((0, 0), dtype=np.float32)
+                    table = prepared.table.with_embeddings(matrix)
+                    entries[prepared.path] = IndexEntry(
+                        path=prepared.path,
+                        stat=prepared.stat,
+                        digest=prepared.digest,
+                        table=table,
+                        text_digests=prepared.text_digests,
+                    )
+                    self.stale.pop(prepared.path, None)
+                batch.clear()
+
+            num_stale = 0
+            num_texts = 0
+            for path, prepared in zip(
+                candidates,
+                prepare_files(
+                    candidates,
+                    fragment_lines=self.fragment_lines,
+                    min_fragment_lines=self.min_fragment_lines,
+                    chunking=self.chunking,
+                    workers=workers,
+                ),
+            ):
+                entry = entries.get(path)
+                if prepared is None:
+                    self.stale.pop(path, None)
+                    changed |= entries.pop(path, None) is not None
+                    continue
+                if entry is not None and entry.digest == prepared.digest:
+                    # Only the metadata changed (e.g. the file was touched)
+                    entries[path] = IndexEntry(
+                        path=path,
+                        stat=prepared.stat,
+                        digest=prepared.digest,
+                        table=entry.table,
+                        text_digests=entry.text_digests,
+                    )
+                    continue
+                changed = True
+                num_stale += 1
+                profile_stage.add("tokens", prepared.tokens)
+                batch.append(prepared)
+                num_texts += len(prepared.texts)
+                if num_texts >= MAX_TEXTS_PER_CALL:
+                    # Embed what's ready while the pool prepares the rest
+                    embed_batch()
+                    num_texts = 0
+            if batch:
+                embed_batch()
+            profile_stage.add("files", len(paths))
+            profile_stage.add("changed_files", num_stale)
+            if changed or not self.version:
+                self._publish(entries)
+            else:
+                self.entries = entries
+            return changed
+
+    def _publish(self, entries: dict[Path, IndexEntry]):
+        version = hashlib.sha1(repr((self.fragment_lines, self.min_fragment_lines, self.mode, self.chunking)).encode())
+        for path, entry in entries.items():
+            version.update(f"{path}\0{entry.digest}\0".encode())
+        snapshot = FragmentTable.concat([entry.table for entry in entries.values()])
+        # Publish the new state
+        self.entries = entries
+        self._state = (version.hexdigest(), snapshot)
+
+    @property
+    def version(self) -> str:
+        """
+        A digest of the indexing parameters and of the contents of every indexed file.
+        """
+        return self._state[0]
+
+    @property
+    def snapshot(self) -> FragmentTable:
+        return self._state[1]
+
+    def current(self) -> tuple[str, FragmentTable]:
+        return self._state
+
+    def table(self, files: Optional[Sequence[str]] = None) -> FragmentTable:
+        """
+        Return the embedded fragments of the given files (or of every indexed file).
+        """
+        return files_table(self.snapshot, files)
+
+    @profiled("index.save")
+    def save(self, index_dir: str):
+        """
+        Write the index to a new version directory under `index_dir` and then atomically point `CURRENT` at it, so
+        that readers see either the old index or the new one, never a mixture.
+        """
+        index_dir = Path(index_dir)
+        version, snapshot = self.current()
+        if read_current(index_dir) == version:
+            return
+        index_dir.mkdir(parents=True, exist_ok=True)
+        entries = [self.entries[path] for path in snapshot.paths]
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=index_dir))
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(
+                {
+                    "format": INDEX_FORMAT,
+                    "fragment_lines": self.fragment_lines,
+                    "min_fragment_lines": self.min_fragment_lines,
+                    "mode": self.mode,
+                    "chunking": self.chunking,
+                    "files": [
+                        {"path": str(entry.path), "stat": list(entry.stat), "digest": entry.digest, "rows": len(entry.table)}
+                        for entry in entries
+                    ],
+                },
+                f,
+            )
+        np.savez(
+            tmp_dir / "table.npz",
+            byte_starts=snapshot.byte_starts,
+            byte_ends=snapshot.byte_ends,
+            start_lines=snapshot.start_lines,
+            end_lines=snapshot.end_lines,
+            text_digests=np.concatenate([entry.fragment_digests() for entry in entries] or [np.empty(0, np.uint64)]),
+        )
+        embeddings = snapshot.embedding_matrix() if snapshot.embeddings is not None else np.empty((0, 0), np.float32)
+        np.save(tmp_dir / "embeddings.npy", embeddings)
+        version_dir = index_dir / version
+        if version_dir.exists():
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, version_dir)
+        # Publish the new version
+        current_tmp = index_dir / f".CURRENT-{os.getpid()}"
+        current_tmp.write_text(version)
+        os.replace(current_tmp, index_dir / "CURRENT")
+        logger.info(f"Saved index version {version} to {index_dir}")
+        remove_old_versions(index_dir, keep={version})
+
+    @classmethod
+    @profiled("index.load")
+    def load(cls, index_dir: str) -> Optional["SearchIndex"]:
+        """
+        Load the current version of the index saved in `index_dir`, dropping the entries of files that have changed
+        or disappeared since it was saved. Embeddings are memory-mapped.
+
+        :return: The index, or None if there is no (readable) index in `index_dir`.
+        """
+        index_dir = Path(index_dir)
+        version = read_current(index_dir)
+        if version is None:
+            return None
+        version_dir = index_dir / version
+        try:
+            with open(version_dir / "meta.json") as f:
+                meta = json.load(f)
+            columns = np.load(version_dir / "table.npz")
+            embeddings = np.load(version_dir / "embeddings.npy", mmap_mode="r")
+        except FileNotFoundError:
+            # Superseded and cleaned up between reading CURRENT and opening the files
+            return cls.load(index_dir) if read_current(index_dir) != version else None
+        if meta["format"] != INDEX_FORMAT:
+            logger.warning(f"Ignoring index in {index_dir} with unsupported format {meta['format']}")
+            return None
+        # Indexes saved before the digests were kept don't have them
+        digests = columns["text_digests"] if "text_digests" in columns.files else None
+        entries = {}
+        stale = {}
+        offset = 0
+        for file in meta["files"]:
+            rows = slice(offset, offset + file["rows"])
+            offset += file["rows"]
+            path = Path(file["path"])
+            try:
+                stat = file_stat(path)
+                buffer = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            if stat != tuple(file["stat"]) and content_digest(buffer) != file["digest"]:
+                # Changed since the index was saved, so leave it for `update` to re-embed, keeping the embeddings of
+                # its fragments in case some of them haven't changed
+                if digests is not None:
+                    stale[path] = dict(zip(digests[rows].tolist(), embeddings[rows]))
+                continue
+            table = FragmentTable.from_columns(
+                paths=[path],
+                buffers=[buffer],
+                path_ids=np.zeros(file["rows"], dtype=np.int32),
+                byte_starts=columns["byte_starts"][rows],
+                byte_ends=columns["byte_ends"][rows],
+                start_lines=columns["start_lines"][rows],
+                end_lines=columns["end_lines"][rows],
+            ).with_embeddings(embeddings[rows])
+            entries[path] = IndexEntry(
+                path=path,
+                stat=stat,
+                digest=file["digest"],
+                table=table,
+                text_digests=digests[rows] if digests is not None else None,
+            )
+        index = cls.from_entries(
+            entries,
+            fragment_lines=meta["fragment_lines"],
+            min_fragment_lines=meta["min_fragment_lines"],
+            mode=meta["mode"],
+            # Indexes saved before content-defined chunking was added split by line counts
+            chunking=meta.get("chunking", "fixed"),
+        )
+        index.stale = stale
+        return index
+
+
+def read_current(index_dir: Path) -> Optional[str]:
+    try:
+        return (Path(index_dir) / "CURRENT").read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def remove_old_versions(index_dir: Path, keep: set[str]):
+    # Keep the previous version around too, since a reader may have just read CURRENT before it was replaced
+    versions = sorted(
+        (path for path in index_dir.iterdir() if path.is_dir() and not path.name.startswith(".")),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    for path in [path for path in versions if path.name not in keep][1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def open_index(
+    index_dir: str,
+    *,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+) -> SearchIndex:
+    """
+    Load the index saved in `index_dir` if it was built with the same parameters, otherwise start a new one.
+    """
+    index = SearchIndex.load(index_dir)
+    if index is None or (index.fragment_lines, index.min_fragment_lines, index.mode, index.chunking) != (
+        fragment_lines, min_fragment_lines, mode, chunking
+    ):
+        index = SearchIndex(
+            fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+        )
+    return index
+
+
+def build_index(
+    *paths: str,
+    index_dir: str = DEFAULT_INDEX_DIR,
+    include: Optional[Sequence[str]] = None,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    watch: bool = False,
+    debounce: float = 0.5,
+    poll: bool = False,
+    workers: Optional[int] = None,
+) -> SearchIndex:
+    """
+    Index the given files and directories into `index_dir`, and optionally keep re-indexing them as they change.
+
+    While watching, each burst of changes is debounced and only the changed files are re-split and re-embedded. Every
+    update is published atomically, so searches never see a half-written index.
+
+    :param chunking: How files are split into fragments: "fixed" runs of `fragment_lines` lines, or "content"-defined
+        fragments that mostly keep their text (and so their cached embeddings) when lines are added or removed above
+        them.
+    :param workers: The number of processes to read and split changed files with (default: one per CPU, 0 for none).
+    """
+    index = open_index(
+        index_dir, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+    )
+    files = expand_paths(*paths, include=include)
+    index.update(files, prune=True, workers=workers)
+    index.save(index_dir)
+    logger.warning(f"Indexed {len(index.entries)} files ({len(index.snapshot)} fragments)")
+    if not watch:
+        return index
+    roots = [path for path in paths if os.path.isdir(path)]
+    # Files given directly are watched through their parent directories
+    roots += sorted({os.path.dirname(os.path.abspath(path)) for path in paths if not os.path.isdir(path)})
+    wanted = path_filter(*paths, include=include)
+    logger.warning(f"Watching {', '.join(roots)} for changes")
+    for changes in watch_changes(roots, debounce=debounce, poll=poll):
+        if changes is None:
+            changed = index.update(expand_paths(*paths, include=include), prune=True, workers=workers)
+        else:
+            changed = index.update([str(path) for path in changes if wanted(path)], workers=workers)
+        if changed:
+            index.save(index_dir)
+            logger.warning(f"Re-indexed: {len(index.entries)} files ({len(index.snapshot)} fragments)")
+    return index
@@ -0,0 +1,369 @@
+"""
+Semantic search over a repository's history: commit messages and the hunks of each commit's diff.
+
+The index lives in the git directory as append-only segments keyed by commit SHA. Each update only walks the commits
+that aren't reachable from a tip indexed before (and skips any it already has, e.g. after an interrupted run), so
+keeping it up to date costs one `git log` over the new commits. Embeddings are stored normalised and memory-mapped,
+and the text of a record is only read back if it's a result.
+"""
+import mmap
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import Iterable
+from typing import Iterator
+from typing import Literal
+from typing import Optional
+
+import numpy as np
+from attrs import define
+from attrs import field
+from git import Repo
+
+from embedit.behaviour.search import query_cache
+from embedit.behaviour.search.git_index import open_repo
+from embedit.behaviour.search.pipeline_components.a03_process.search import embed_texts
+from embedit.behaviour.search.pipeline_components.a03_process.search import log_similarity_stats
+from embedit.behaviour.search.pipeline_components.a03_process.search import top_rows
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+MESSAGE = 0
+HUNK = 1
+KINDS = {MESSAGE: "message", HUNK: "hunk"}
+# Record texts are clipped to this many characters before they're embedded
+MAX_RECORD_CHARS = 4000
+# Records are embedded and written out in segments of about this many, so an interrupted update keeps its progress
+SEGMENT_RECORDS = 4096
+# Each commit starts with a record separator, and its message ends with a unit separator
+COMMIT_START = "\x1e"
+MESSAGE_END = "\x1f"
+LOG_FORMAT = f"{COMMIT_START}%H%n%B{MESSAGE_END}"
+# The indexed tips that aren't reachable from each other, one per line. Indexes written before it was kept have their
+# tips in their segments.
+TIPS_FILE = "tips.txt"
+
+
+@define(frozen=True)
+class LogRecord:
+    commit: str
+    kind: int
+    path: str
+    text: str
+
+
+@define(frozen=True)
+class LogSearchResult:
+    commit: str
+    kind: Literal["message", "hunk"]
+    path: str
+    text: str
+    similarity: float
+
+
+def parse_log(lines: Iterable[str]) -> Iterator[tuple[str, list[LogRecord]]]:
+    """
+    Parse the output of `git log --patch --format=LOG_FORMAT` into each commit's SHA and records: its message, and
+    the hunks of its diff (each prefixed with the path of its file).
+    """
+    commit: Optional[str] = None
+    records: list[LogRecord] = []
+    message: Optional[list[str]] = None
+    path = ""
+    in_header = False
+    hunk: Optional[list[str]] = None
+
+    def hunk_record() -> Optional[LogRecord]:
+        if hunk is None:
+            return None
+        return LogRecord(commit=commit, kind=HUNK, path=path, text="\n".join([path, *hunk])[:MAX_RECORD_CHARS])
+
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith(COMMIT_START):
+            if hunk_record() is not None:
+                records.append(hunk_record())
+            if commit is not None:
+                yield commit, records
+            commit, records, message, path, in_header, hunk = line[1:].strip(), [], [], "", False, None
+            continue
+        if message is not None:
+            # Still in the message
+            if line.endswith(MESSAGE_END):
+                text = "\n".join([*message, line[:-1]]).strip()
+                if text:
+                    records.append(LogRecord(commit=commit, kind=MESSAGE, path="", text=text[:MAX_RECORD_CHARS]))
+                message = None
+            else:
+                message.append(line)
+            continue
+        if line.startswith("diff --git "):
+            if hunk_record() is not None:
+                records.append(hunk_record())
+            hunk, in_header = None, True
+            # Until the +++ line says otherwise (it's missing for binary files)
+            path = line.rsplit(" b/", 1)[-1]
+        elif in_header and line.startswith("+++ "):
+            if line[4:] != "/dev/null":
+                path = line[4:].removeprefix("b/")
+        elif in_header and line.startswith("--- "):
+            if line[4:] != "/dev/null":
+                path = line[4:].removeprefix("a/")
+        elif line.startswith("@@"):
+            if hunk_record() is not None:
+                records.append(hunk_record())
+            hunk, in_header = [line], False
+        elif hunk is not None and line[:1] in (" ", "+", "-", "\\"):
+            hunk.append(line)
+    if hunk_record() is not None:
+        records.append(hunk_record())
+    if commit is not None:
+        yield commit, records
+
+
+@define
+class LogSegment:
+    commits: np.ndarray
+    kinds: np.ndarray
+    paths: np.ndarray
+    text_offsets: np.ndarray
+    texts: bytes
+    embeddings: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.commits)
+
+    def text(self, i: int) -> str:
+        return self.texts[self.text_offsets[i]: self.text_offsets[i + 1]].decode("utf-8", errors="replace")
+
+
+def default_log_index_dir(repo: Repo, *, mode: str) -> Path:
+    return Path(repo.git_dir) / "embedit" / f"log-{mode}"
+
+
+@define
+class LogIndex:
+    """
+    Embedded commit messages and diff hunks, stored as segments of `<name>.txt` (the texts), `<name>.npy` (the
+    normalised embeddings) and `<name>.npz` (the commit, kind, path and text offsets of each record, plus the commits
+    the segment covers), written in that order so that an `.npz` marks a complete segment. The tips indexed so far are
+    kept in `tips.txt`, pruned to those that aren't reachable from another.
+    """
+
+    index_dir: Path
+    mode: Literal["openai", "cohere"] = "openai"
+    segments: list[LogSegment] = field(factory=list)
+    commits: set[str] = field(factory=set)
+    tips: set[str] = field(factory=set)
+
+    @classmethod
+    def open(cls, index_dir: Path, *, mode: Literal["openai", "cohere"] = "openai") -> "LogIndex":
+        index = cls(index_dir=Path(index_dir), mode=mode)
+        if not index.index_dir.is_dir():
+            return index
+        with profiler.stage("log.load") as stage:
+            for path in sorted(index.index_dir.glob("*.npz")):
+                with np.load(path) as segment:
+                    columns = {key: segment[key] for key in segment.files}
+                with open(path.with_suffix(".txt"), "rb") as f:
+                    texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b""
+                index.segments.append(
+                    LogSegment(
+                        commits=columns["commits"],
+                        kinds=columns["kinds"],
+                        paths=columns["paths"],
+                        text_offsets=columns["text_offsets"],
+                        texts=texts,
+                        embeddings=np.load(path.with_suffix(".npy"), mmap_mode="r"),
+                    )
+                )
+                index.commits.update(columns["indexed"].tolist())
+                index.tips.update(columns["tips"].tolist())
+            tips_path = index.index_dir / TIPS_FILE
+            if tips_path.exists():
+                index.tips = set(tips_path.read_text().split())
+            stage.add("segments", len(index.segments))
+            stage.add("records", sum(map(len, index.segments)))
+        return index
+
+    def _write_segment(self, records: list[LogRecord], indexed: list[str]):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        if records:
+            embeddings = embed_texts([record.text for record in records], mode=self.mode)
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        else:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+        encoded = [record.text.encode() for record in records]
+        text_offsets = np.concatenate([[0], np.cumsum([len(text) for text in encoded])]).astype(np.int64)
+        # Unique, and ordered by creation time
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        for suffix, write in [
+            (".txt", lambda f: f.write(b"".join(encoded))),
+            (".npy", lambda f: np.save(f, embeddings)),
+            (
+                ".npz",
+                lambda f: np.savez(
+                    f,
+                    commits=np.array([record.commit for record in records], dtype="U40"),
+                    kinds=np.array([record.kind for record in records], dtype=np.uint8),
+                    paths=np.array([record.path for record in records], dtype=str),
+                    text_offsets=text_offsets,
+                    indexed=np.array(indexed, dtype="U40"),
+                    tips=np.array([], dtype="U40"),
+                ),
+            ),
+        ]:
+            with open(self.index_dir / f"{name}{suffix}.tmp", "wb") as f:
+                write(f)
+            os.replace(self.index_dir / f"{name}{suffix}.tmp", self.index_dir / f"{name}{suffix}")
+        self.segments.append(
+            LogSegment(
+                commits=np.array([record.commit for record in records], dtype="U40"),
+                kinds=np.array([record.kind for record in records], dtype=np.uint8),
+                paths=np.array([record.path for record in records], dtype=str),
+                text_offsets=text_offsets,
+                texts=b"".join(encoded),
+                embeddings=embeddings,
+            )
+        )
+        self.commits.update(indexed)
+
+    def _known_tips(self, repo: Repo) -> list[str]:
+        # Tips can disappear, e.g. when a rebased branch's old commits are garbage collected
+        if not self.tips:
+            return []
+        tips = sorted(self.tips)
+        process = repo.git.cat_file("--batch-check", istream=subprocess.PIPE, as_process=True)
+        stdout, _ = process.proc.communicate("".join(f"{tip}\n" for tip in tips).encode())
+        # "<sha> <type> <size>" for each object, or "<sha> missing"
+        return [tip for tip, line in zip(tips, stdout.decode().splitlines()) if line.split()[1:2] == ["commit"]]
+
+    def _record_tips(self, repo: Repo, tips: list[str]):
+        # Keeps only the tips that aren't reachable from another, so that the tips stay few however often they move
+        tips = sorted(repo.git.merge_base("--independent", *tips).split())
+        if set(tips) == self.tips:
+            return
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_dir / f"{TIPS_FILE}.{os.getpid()}.tmp"
+        tmp_path.write_text("".join(f"{tip}\n" for tip in tips))
+        os.replace(tmp_path, self.index_dir / TIPS_FILE)
+        self.tips = set(tips)
+
+    def update(self, repo: Repo, rev: str = "HEAD") -> int:
+        """
+        Index the commits reachable from `rev` that haven't been indexed yet.
+
+        :return: The number of commits indexed.
+        """
+        tip = repo.commit(rev).hexsha
+        if tip in self.tips:
+            return 0
+        known_tips = self._known_tips(repo)
+        process = repo.git.log(
+            tip,
+            "--not",
+            *known_tips,
+            "--",
+            format=LOG_FORMAT,
+            patch=True,
+            no_color=True,
+            no_ext_diff=True,
+            as_process=True,
+        )
+        lines = (line.decode("utf-8", errors="replace") for line in process.proc.stdout)
+        records: list[LogRecord] = []
+        indexed: list[str] = []
+        num_commits = 0
+        with profiler.stage("log.update") as stage:
+            for commit, commit_records in parse_log(lines):
+                if commit in self.commits:
+                    continue
+                records.extend(commit_records)
+                indexed.append(commit)
+                num_commits += 1
+                if len(records) >= SEGMENT_RECORDS:
+                    logger.info(f"Embedding {len(records)} records from {len(indexed)} commits")
+                    self._write_segment(records, indexed)
+                    stage.add("records", len(records))
+                    records, indexed = [], []
+            process.wait()
+            if indexed:
+                logger.info(f"Embedding {len(records)} records from {len(indexed)} commits")
+                self._write_segment(records, indexed)
+                stage.add("records", len(records))
+            # After its commits, and without a segment if it has no new ones (e.g. an older commit is checked out)
+            self._record_tips(repo, [*known_tips, tip])
+            stage.add("commits", num_commits)
+        return num_commits
+
+    def search(
+        self,
+        query: str,
+        *,
+        top_n: Optional[int] = 10,
+        threshold: float = 0.0,
+        kind: Optional[Literal["message", "hunk"]] = None,
+    ) -> list[LogSearchResult]:
+        """
+        Return the commit messages and diff hunks most similar to the query, most similar first.
+
+        :param kind: Only return messages or only hunks.
+        """
+        segments = [segment for segment in self.segments if len(segment)]
+        if not segments:
+            return []
+        # Embed the query
+        embedding = query_cache.embed_query(query, mode=self.mode)
+        embedding = embedding / np.linalg.norm(embedding)
+        with profiler.stage("similarity", rows=sum(map(len, segments))):
+            # The stored embeddings are normalised, so this is the cosine similarity
+            similarities = np.concatenate([segment.embeddings @ embedding for segment in segments])
+            if kind is not None:
+                wanted = MESSAGE if kind == "message" else HUNK
+                kinds = np.concatenate([segment.kinds for segment in segments])
+                similarities = np.where(kinds == wanted, similarities, -np.inf)
+            if np.isfinite(similarities).any():
+                log_similarity_stats(similarities[np.isfinite(similarities)])
+            rows = top_rows(similarities, top_n=top_n, threshold=threshold)
+        segment_starts = np.cumsum([0] + [len(segment) for segment in segments])
+        results = []
+        for row in rows:
+            segment_id = int(np.searchsorted(segment_starts, row, side="right")) - 1
+            segment = segments[segment_id]
+            i = int(row - segment_starts[segment_id])
+            results.append(
+                LogSearchResult(
+                    commit=str(segment.commits[i]),
+                    kind=KINDS[int(segment.kinds[i])],
+                    path=str(segment.paths[i]),
+                    text=segment.text(i),
+                    similarity=float(similarities[row]),
+                )
+            )
+        return results
+
+
+def log_search(
+    query: str,
+    *,
+    repo_path: str = ".",
+    rev: str = "HEAD",
+    top_n: Optional[int] = 10,
+    threshold: float = 0.0,
+    kind: Optional[Literal["message", "hunk"]] = None,
+    mode: Literal["openai", "cohere"] = "openai",
+    index_dir: Optional[str] = None,
+    update: bool = True,
+) -> list[LogSearchResult]:
+    """
+    Search the commit messages and diff hunks of a repository's history, first indexing any commits reachable from
+    `rev` that haven't been indexed yet (unless `update` is False).
+    """
+    repo = open_repo(repo_path)
+    index = LogIndex.open(Path(index_dir) if index_dir is not None else default_log_index_dir(repo, mode=mode), mode=mode)
+    if update:
+        num_commits = index.update(repo, rev)
+        if num_commits:
+            logger.warning(f"Indexed {num_commits} new commits")
+    return index.search(query, top_n=top_n, threshold=threshold, kind=kind)
@@ -1,6 +1,17 @@
+import fnmatch
+import mmap
+import os
 import pathlib
+from typing import Callable
+from typing import Optional
+from typing import Sequence
 
+from embedit.structures.fragment_table import Buffer
 from embedit.structures.text_file import TextFile
+from embedit.utils.profile import profiler
+
+# Files at least this large are memory-mapped rather than read into memory
+MMAP_THRESHOLD = 1 << 20
 
 
 def gather(*files: str, ignore_empty: bool = True) -> list[TextFile]:
@@ -9,3 +20,76 @@ def gather(*files: str, ignore_empty: bool = True) -> list[TextFile]:
     if ignore_empty:
         results = [result for result in results if result.contents]
     return results
+
+
+def read_buffer(path: pathlib.Path, *, mmap_threshold: int = MMAP_THRESHOLD) -> Buffer:
+    with open(path, "rb") as f:
+        size = f.seek(0, 2)
+        if 0 < size and mmap_threshold <= size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.seek(0)
+        return f.read()
+
+
+def gather_buffers(
+    *files: str, ignore_empty: bool = True, mmap_threshold: int = MMAP_THRESHOLD
+) -> tuple[list[pathlib.Path], list[Buffer]]:
+    # Gather the raw bytes of each file without decoding them
+    with profiler.stage("gather") as stage:
+        paths = [pathlib.Path(file) for file in files]
+        buffers = [read_buffer(path, mmap_threshold=mmap_threshold) for path in paths]
+        stage.add("files", len(paths))
+        stage.add("bytes", sum(len(buffer) for buffer in buffers))
+    if ignore_empty:
+        keep = [i for i, buffer in enumerate(buffers) if len(buffer)]
+        paths = [paths[i] for i in keep]
+        buffers = [buffers[i] for i in keep]
+    return paths, buffers
+
+
+def expand_paths(*paths: str, include: Optional[Sequence[str]] = None) -> list[str]:
+    """
+    Expand directories into the files beneath them, skipping hidden files and directories.
+
+    :param paths: Files and directories.
+    :param include: If given, only keep files found in directories whose names match one of these glob patterns.
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith("."))
+            for filename in sorted(filenames):
+                if filename.startswith("."):
+                    continue
+                if include is not None and not any(fnmatch.fnmatch(filename, pattern) for pattern in include):
+                    continue
+                files.append(os.path.join(root, filename))
+    return files
+
+
+def path_filter(*paths: str, include: Optional[Sequence[str]] = None) -> Callable[[pathlib.Path], bool]:
+    """
+    Return a predicate for whether a path would be among the files that `expand_paths` finds, even if it doesn't
+    exist (yet).
+    """
+    files = {pathlib.Path(path).resolve() for path in paths if not os.path.isdir(path)}
+    directories = [pathlib.Path(path).resolve() for path in paths if os.path.isdir(path)]
+
+    def predicate(path: pathlib.Path) -> bool:
+        path = pathlib.Path(path).resolve()
+        if path in files:
+            return True
+        for directory in directories:
+            try:
+                relative = path.relative_to(directory)
+            except ValueError:
+                continue
+            if any(part.startswith(".") for part in relative.parts):
+                return False
+            return include is None or any(fnmatch.fnmatch(path.name, pattern) for pattern in include)
+        return False
+
+    return predicate
@@ -1,17 +1,177 @@
+"""
+Splitting files into fragments to embed, either into runs of `fragment_lines` lines counted from the top of the file
+("fixed"), or at boundaries chosen by the content ("content").
+
+Content-defined chunking ends a fragment after a line where a rolling hash of the last `CDC_WINDOW_LINES` lines hits a
+target value, within bounds on the fragment's length, so that fragments average `fragment_lines` lines. A boundary only
+depends on the lines just before it, so an edit changes the fragments around it and the rest keep their text, and with
+it their cached embeddings, instead of every later fragment shifting by the lines inserted or removed.
+"""
+import pathlib
+from typing import Literal
+
+import numpy as np
+
+from embedit.structures.fragment_table import Buffer
+from embedit.structures.fragment_table import FragmentTable
 from embedit.structures.text_file import TextFile, TextFileFragment
+from embedit.utils.profile import profiler
+
 
+Chunking = Literal["fixed", "content"]
+CHUNKING_MODES = ("fixed", "content")
+# Lines hashed together to decide whether a fragment ends after the last of them
+CDC_WINDOW_LINES = 4
+# A random 64-bit value for each pair of bytes. A line's hash is the sum of those of its byte pairs (including the
+# newline before it), so it doesn't depend on where the line is in the file, and can be computed for every line at once.
+_PAIR_HASHES = np.random.default_rng(0x6D62).integers(0, 2 ** 63, size=1 << 16, dtype=np.uint64)
 
-def split_file(file: TextFile, *, fragment_lines: int = 10, ignore_empty: bool = True) -> list[TextFileFragment]:
+
+def split_file(
+    file: TextFile, *, fragment_lines: int = 10, ignore_empty: bool = True, chunking: Chunking = "fixed"
+) -> list[TextFileFragment]:
     # Split the file into fragments
     contents = file.contents.splitlines()
+    if chunking == "content":
+        _, _, start_lines, end_lines = split_buffer(
+            "\n".join(contents).encode(), fragment_lines=fragment_lines, ignore_empty=False, chunking=chunking
+        )
+        bounds = zip(start_lines.tolist(), (end_lines + 1).tolist())
+    else:
+        bounds = ((i, i + fragment_lines) for i in range(0, len(contents), fragment_lines))
     fragments = [
         TextFileFragment(
             path=file.path,
-            contents="\n".join(contents[i: i + fragment_lines]),
-            start_line=i,
+            contents="\n".join(contents[start: end]),
+            start_line=start,
         )
-        for i in range(0, len(contents), fragment_lines)
+        for start, end in bounds
     ]
     if ignore_empty:
         fragments = [fragment for fragment in fragments if fragment.contents]
-    return fragments
\ No newline at end of file
+    return fragments
+
+
+def line_offsets(buffer: Buffer) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the byte offsets at which each line of the buffer starts and ends (excluding the newline).
+    """
+    newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord("\n"))
+    starts = np.concatenate([[0], newlines + 1])
+    ends = np.concatenate([newlines, [len(buffer)]])
+    if starts[-1] == len(buffer):
+        # The buffer ends with a newline (or is empty), which doesn't start another line
+        starts, ends = starts[:-1], ends[:-1]
+    return starts, ends
+
+
+def line_hashes(buffer: Buffer, line_starts: np.ndarray, line_ends: np.ndarray) -> np.ndarray:
+    """
+    Hash each line of the buffer by its contents alone (so the same line hashes the same anywhere in any file).
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if len(data) < 2:
+        return np.zeros(len(line_starts), dtype=np.uint64)
+    pairs = (data[:-1].astype(np.uint32) << 8) | data[1:]
+    # Sums wrap around, which is fine for hashes
+    prefix = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(_PAIR_HASHES[pairs], dtype=np.uint64)])
+    # The pairs from the newline before the line to the newline after it
+    return prefix[np.minimum(line_ends, len(pairs))] - prefix[np.maximum(line_starts - 1, 0)]
+
+
+def content_bounds(fragment_lines: int) -> tuple[int, int]:
+    """
+    The fewest and most lines in a content-defined fragment, for fragments of `fragment_lines` lines on average.
+    """
+    return max(1, fragment_lines // 2), max(1, fragment_lines * 2)
+
+
+def content_defined_end_lines(hashes: np.ndarray, *, fragment_lines: int) -> np.ndarray:
+    """
+    Choose where content-defined fragments end, given the hash of each line.
+
+    :return: The (inclusive) end line of each fragment.
+    """
+    num_lines = len(hashes)
+    min_lines, max_lines = content_bounds(fragment_lines)
+    # Past the minimum, a fragment ends after each line with probability 1 / divisor, so it has fragment_lines lines
+    # on average
+    divisor = max(1, fragment_lines - min_lines + 1)
+    window_sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(hashes, dtype=np.uint64)])
+    windows = window_sums[1:] - window_sums[np.maximum(np.arange(1, num_lines + 1) - CDC_WINDOW_LINES, 0)]
+    candidates = np.flatnonzero(windows % np.uint64(divisor) == 0)
+    end_lines = []
+    start = 0
+    while start < num_lines:
+        i = np.searchsorted(candidates, start + min_lines - 1)
+        end = int(candidates[i]) if i < len(candidates) else num_lines - 1
+        end = min(end, start + max_lines - 1, num_lines - 1)
+        end_lines.append(end)
+        start = end + 1
+    return np.asarray(end_lines, dtype=np.int64)
+
+
+def split_buffer(
+    buffer: Buffer, *, fragment_lines: int = 10, ignore_empty: bool = True, chunking: Chunking = "fixed"
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split a buffer into fragments without copying it: runs of `fragment_lines` lines, or with `chunking="content"`,
+    fragments of about that many lines that end where the content says (see the module's docstring).
+
+    :return: The byte starts, byte ends, start lines and (inclusive) end lines of each fragment.
+    """
+    if chunking not in CHUNKING_MODES:
+        raise ValueError(f"Invalid chunking: {chunking}. Choose from: {', '.join(CHUNKING_MODES)}")
+    line_starts, line_ends = line_offsets(buffer)
+    num_lines = len(line_starts)
+    if chunking == "content":
+        end_lines = content_defined_end_lines(
+            line_hashes(buffer, line_starts, line_ends), fragment_lines=fragment_lines
+        )
+        start_lines = end_lines - np.diff(end_lines, prepend=-1) + 1
+    else:
+        start_lines = np.arange(0, num_lines, fragment_lines)
+        end_lines = np.minimum(start_lines + fragment_lines, num_lines) - 1
+    byte_starts = line_starts[start_lines]
+    byte_ends = line_ends[end_lines]
+    if ignore_empty:
+        keep = byte_starts < byte_ends
+        start_lines, end_lines, byte_starts, byte_ends = (
+            start_lines[keep], end_lines[keep], byte_starts[keep], byte_ends[keep]
+        )
+    return byte_starts, byte_ends, start_lines, end_lines
+
+
+def split_buffers(
+    paths: list[pathlib.Path],
+    buffers: list[Buffer],
+    *,
+    fragment_lines: int = 10,
+    ignore_empty: bool = True,
+    chunking: Chunking = "fixed",
+) -> FragmentTable:
+    # Split every buffer and lay the fragments out as columns
+    with profiler.stage("split") as stage:
+        columns = [
+            split_buffer(buffer, fragment_lines=fragment_lines, ignore_empty=ignore_empty, chunking=chunking)
+            for buffer in buffers
+        ]
+        stage.add("files", len(buffers))
+        stage.add("fragments", sum(len(byte_starts) for byte_starts, *_ in columns))
+    path_ids = [np.full(len(byte_starts), path_id) for path_id, (byte_starts, *_) in enumerate(columns)]
+    byte_starts, byte_ends, start_lines, end_lines = (
+        [column[i] for column in columns] for i in range(4)
+    )
+
+    def concat(arrays: list[np.ndarray]) -> np.ndarray:
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+
+    return FragmentTable.from_columns(
+        paths=paths,
+        buffers=buffers,
+        path_ids=concat(path_ids),
+        byte_starts=concat(byte_starts),
+        byte_ends=concat(byte_ends),
+        start_lines=concat(start_lines),
+        end_lines=concat(end_lines),
+    )
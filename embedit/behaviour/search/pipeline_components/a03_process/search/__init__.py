@@ -1,14 +1,20 @@
+import asyncio
 from typing import Literal
+from typing import Optional
 
 import numpy as np
 
+from embedit.behaviour.openai_tools import aget_embeddings
 from embedit.behaviour.openai_tools import get_embedding
 from embedit.behaviour.openai_tools import get_embeddings
 from embedit.structures.embedding import EmbeddedText
 from embedit.structures.embedding import EmbeddedTextFileFragment
 from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.fragment_table import FragmentTable
 from embedit.structures.text_file import TextFileFragment
+from embedit.utils.aio import run_sync
 from embedit.utils.log import logger
+from embedit.utils.profile import profiled
 
 
 def cosine_similarity(a, b):
@@ -23,6 +29,35 @@ def embed_fragments(fragments: list[TextFileFragment], mode: Literal["openai", "
             zip(fragments, embeddings)]
 
 
+# The most texts get_embeddings accepts in one call
+MAX_TEXTS_PER_CALL = 2047
+
+
+async def aembed_texts(texts: list[str], mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    # Get the embeddings for the texts in as few calls as possible, made at once, stored as a single matrix
+    calls = await asyncio.gather(
+        *(
+            aget_embeddings(texts[start: start + MAX_TEXTS_PER_CALL], mode=mode)
+            for start in range(0, len(texts), MAX_TEXTS_PER_CALL)
+        )
+    )
+    return np.asarray([embedding for embeddings in calls for embedding in embeddings], dtype=np.float32)
+
+
+def embed_texts(texts: list[str], mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    return run_sync(aembed_texts(texts, mode=mode))
+
+
+async def aembed_table(table: FragmentTable, mode: Literal["openai", "cohere"] = "openai") -> FragmentTable:
+    # Get the embeddings for the rows of the table
+    return table.with_embeddings(await aembed_texts(table.texts(), mode=mode))
+
+
+def embed_table(table: FragmentTable, mode: Literal["openai", "cohere"] = "openai") -> FragmentTable:
+    # Get the embeddings for the rows of the table
+    return table.with_embeddings(embed_texts(table.texts(), mode=mode))
+
+
 def embed_text(text: str, mode: Literal["openai", "cohere"] = "openai") -> EmbeddedText:
     # Return the embedded text
     return EmbeddedText(text=text, embedding=get_embedding(text, mode=mode))
@@ -39,10 +74,49 @@ def get_similarities_for_fragments(
     embedding = embedded_text.embedding
     # Find the most similar fragments
     similarities = [cosine_similarity(embedding, fragment.embedding) for fragment in embedded_fragments]
-    logger.info(
-        f"Similarity statistics: min={min(similarities):.3f}, max={max(similarities):.3f}, mean={np.mean(similarities):.3f}, median={np.median(similarities):.3f}, std={np.std(similarities):.3f}"
-    )
+    log_similarity_stats(np.asarray(similarities))
     # Return the most similar fragments
     return [EmbeddedTextFileFragmentSimilarityResult(embedded_fragment=fragment, similarity=similarity) for
             fragment, similarity in
             zip(embedded_fragments, similarities) if similarity >= threshold]
+
+
+def log_similarity_stats(similarities: np.ndarray):
+    logger.info(
+        f"Similarity statistics: min={np.min(similarities):.3f}, max={np.max(similarities):.3f}, mean={np.mean(similarities):.3f}, median={np.median(similarities):.3f}, std={np.std(similarities):.3f}"
+    )
+
+
+@profiled("similarity")
+def get_similarities_for_table(embedding: list[float], table: FragmentTable) -> np.ndarray:
+    logger.info(f"Finding similar fragments from a table of {len(table)} fragments.")
+    # Score every row with a single matrix-vector product
+    matrix = table.embedding_matrix()
+    query = np.asarray(embedding, dtype=matrix.dtype)
+    similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    log_similarity_stats(similarities)
+    return similarities
+
+
+@profiled("similarity")
+def get_similarities_for_queries(embeddings: np.ndarray, table: FragmentTable) -> np.ndarray:
+    logger.info(f"Finding similar fragments for {len(embeddings)} queries from a table of {len(table)} fragments.")
+    # Score every row for every query with a single matrix-matrix product
+    matrix = table.embedding_matrix()
+    queries = np.asarray(embeddings, dtype=matrix.dtype)
+    similarities = queries @ matrix.T
+    similarities /= np.outer(np.linalg.norm(queries, axis=1), np.linalg.norm(matrix, axis=1))
+    return similarities
+
+
+def top_rows(similarities: np.ndarray, *, top_n: Optional[int] = None, threshold: float = 0.0) -> np.ndarray:
+    """
+    Return the indices of the rows at or above the threshold. If top_n is given, return at most top_n of them, most
+    similar first; otherwise, return them in row order.
+    """
+    rows = np.flatnonzero(similarities >= threshold)
+    if top_n is None:
+        return rows
+    if top_n < len(rows):
+        rows = rows[np.argpartition(-similarities[rows], top_n)[:top_n]]
+    return rows[np.argsort(-similarities[rows], kind="stable")]
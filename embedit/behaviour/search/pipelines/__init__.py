@@ -1,36 +1,314 @@
+import asyncio
+from pathlib import Path
+from typing import Awaitable
+from typing import Callable
 from typing import Literal
+from typing import Optional
+from typing import Sequence
 
-from delegatefn import delegate
+import numpy as np
 
-from embedit.behaviour.search.pipeline_components.a01_gather import gather
-from embedit.behaviour.search.pipeline_components.a02_split import split_file
-from embedit.behaviour.search.pipeline_components.a03_process.search import embed_fragments
-from embedit.behaviour.search.pipeline_components.a03_process.search import embed_text
-from embedit.behaviour.search.pipeline_components.a03_process.search import get_similarities_for_fragments
+from embedit.behaviour.search import query_cache
+from embedit.behaviour.search.index import files_table
+from embedit.behaviour.search.index import open_index
+from embedit.behaviour.search.pipeline_components.a01_gather import gather_buffers
+from embedit.behaviour.search.pipeline_components.a02_split import Chunking
+from embedit.behaviour.search.pipeline_components.a02_split import split_buffers
+from embedit.behaviour.search.pipeline_components.a03_process.search import aembed_table
+from embedit.behaviour.search.pipeline_components.a03_process.search import embed_table
+from embedit.behaviour.search.pipeline_components.a03_process.search import get_similarities_for_queries
+from embedit.behaviour.search.pipeline_components.a03_process.search import get_similarities_for_table
+from embedit.behaviour.search.pipeline_components.a03_process.search import top_rows
 from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.fragment_table import FragmentTable
+from embedit.utils.aio import run_sync
 from embedit.utils.log import logger
 
+# The most similarity scores to hold at once when scoring many queries (256 MiB of float32)
+MAX_SCORES_PER_BLOCK = 1 << 26
+
+
+async def asemantic_search(
+    query: str,
+    *files: str,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+    index_dir: Optional[str] = None,
+) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Return the fragments of the given files that are similar to the query. If top_n is given, only the top_n most
+    similar fragments are returned (most similar first), and only those are materialised as result objects.
+
+    If index_dir is given, fragments are looked up in (and saved back to) the index there, so only files that have
+    changed since it was last updated are embedded. With chunking="content", fragments end where the content says
+    rather than every fragment_lines lines, so an edit to a file only changes (and re-embeds) the fragments around it.
+
+    The query and the fragments are embedded at the same time, with async requests. Reading the files, updating the
+    index and scoring happen on worker threads, so none of it blocks the event loop.
+    """
+    assert len(files) > 0, "No files were provided"
+    if index_dir is not None:
+        version, table = await asyncio.to_thread(
+            indexed_table,
+            *files,
+            fragment_lines=fragment_lines,
+            min_fragment_lines=min_fragment_lines,
+            mode=mode,
+            chunking=chunking,
+            index_dir=index_dir,
+        )
+        scope = query_cache.result_scope(
+            index_dir=str(Path(index_dir).resolve()), files=sorted(str(Path(file).resolve()) for file in files)
+        )
+        return await arank_table_cached(
+            query, table, scope=scope, version=version, mode=mode, top_n=top_n, threshold=threshold
+        )
+    # Embed the fragments and the query
+    logger.info(f"Embedding the query")
+    table, embedding = await asyncio.gather(
+        aembedded_table(
+            *files, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+        ),
+        query_cache.aembed_query(query, mode=mode),
+    )
+    # Find the most similar fragments
+    return await asyncio.to_thread(rank_table, embedding, table, top_n=top_n, threshold=threshold)
+
 
-@delegate(get_similarities_for_fragments, ignore={"embedded_text", "embedded_fragments"})
 def semantic_search(
     query: str,
     *files: str,
     fragment_lines: int = 20,
     min_fragment_lines: int = 0,
     mode: Literal["openai", "cohere"] = "openai",
-    **kwargs
+    chunking: Chunking = "fixed",
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+    index_dir: Optional[str] = None,
 ) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Like `asemantic_search`, blocking until the results are ready.
+    """
+    return run_sync(
+        asemantic_search(
+            query,
+            *files,
+            fragment_lines=fragment_lines,
+            min_fragment_lines=min_fragment_lines,
+            mode=mode,
+            chunking=chunking,
+            top_n=top_n,
+            threshold=threshold,
+            index_dir=index_dir,
+        )
+    )
+
+
+def semantic_search_many(
+    queries: Sequence[str],
+    *files: str,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+    index_dir: Optional[str] = None,
+) -> dict[str, list[EmbeddedTextFileFragmentSimilarityResult]]:
+    """
+    Run several searches over the same files at once: like `semantic_search`, but the files are gathered, split and
+    embedded once, the queries are embedded together, and they're all scored with one matrix-matrix product (per
+    block of queries, for very large tables).
+
+    Return the results for each distinct query, in the order they were given.
+    """
     assert len(files) > 0, "No files were provided"
+    table = embedded_table(
+        *files,
+        fragment_lines=fragment_lines,
+        min_fragment_lines=min_fragment_lines,
+        mode=mode,
+        chunking=chunking,
+        index_dir=index_dir,
+    )
+    queries = list(dict.fromkeys(queries))
+    if not queries:
+        return {}
+    if len(table) == 0:
+        return {query: [] for query in queries}
+    # Embed the queries
+    logger.info(f"Embedding {len(queries)} queries")
+    embedded_queries = query_cache.embed_queries(queries, mode=mode)
+    # Find the most similar fragments for each query
+    results = {}
+    block_size = max(1, MAX_SCORES_PER_BLOCK // len(table))
+    for start in range(0, len(queries), block_size):
+        block = queries[start: start + block_size]
+        similarities = get_similarities_for_queries(embedded_queries[start: start + block_size], table)
+        for query, query_similarities in zip(block, similarities):
+            rows = top_rows(query_similarities, top_n=top_n, threshold=threshold)
+            results[query] = [table.similarity_result(i, query_similarities[i]) for i in rows]
+    return results
+
+
+def embedded_table(
+    *files: str,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    index_dir: Optional[str] = None,
+) -> FragmentTable:
+    """
+    Return the embedded fragments of the given files, from (and saved back to) the index in index_dir if it's given.
+    """
+    if index_dir is not None:
+        _, table = indexed_table(
+            *files,
+            fragment_lines=fragment_lines,
+            min_fragment_lines=min_fragment_lines,
+            mode=mode,
+            chunking=chunking,
+            index_dir=index_dir,
+        )
+        return table
+    # Gather the files
+    paths, buffers = gather_buffers(*files)
+    # Split the files
+    table = split_buffers(paths, buffers, fragment_lines=fragment_lines, chunking=chunking)
+    table = table.select(table.line_counts >= min_fragment_lines)
+    # Embed the fragments
+    logger.info(f"Embedding {len(table)} fragments")
+    return embed_table(table, mode=mode)
+
+
+async def aembedded_table(
+    *files: str,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    index_dir: Optional[str] = None,
+) -> FragmentTable:
+    """
+    Like `embedded_table`, without blocking the event loop.
+    """
+    if index_dir is not None:
+        _, table = await asyncio.to_thread(
+            indexed_table,
+            *files,
+            fragment_lines=fragment_lines,
+            min_fragment_lines=min_fragment_lines,
+            mode=mode,
+            chunking=chunking,
+            index_dir=index_dir,
+        )
+        return table
     # Gather the files
-    files = gather(*files)
+    paths, buffers = await asyncio.to_thread(gather_buffers, *files)
     # Split the files
-    fragments = [fragment for file in files for fragment in split_file(file, fragment_lines=fragment_lines)]
-    fragments = [fragment for fragment in fragments if len(fragment.contents.splitlines()) >= min_fragment_lines]
+    table = await asyncio.to_thread(split_buffers, paths, buffers, fragment_lines=fragment_lines, chunking=chunking)
+    table = table.select(table.line_counts >= min_fragment_lines)
     # Embed the fragments
-    logger.info(f"Embedding {len(fragments)} fragments")
-    embedded_fragments = embed_fragments(fragments, mode=mode)
+    logger.info(f"Embedding {len(table)} fragments")
+    return await aembed_table(table, mode=mode)
+
+
+def indexed_table(
+    *files: str,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Chunking = "fixed",
+    index_dir: str,
+) -> tuple[str, FragmentTable]:
+    """
+    Bring the index in index_dir up to date for the given files, and return its version and their embedded fragments.
+    """
+    index = open_index(
+        index_dir, fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+    )
+    if index.update(files):
+        index.save(index_dir)
+    # The version and the snapshot are read together, so the rows are the version's even if the index changes meanwhile
+    version, snapshot = index.current()
+    return version, files_table(snapshot, files)
+
+
+def rank_table(
+    embedding: list[float], table: FragmentTable, *, top_n: Optional[int] = None, threshold: float = 0.0
+) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    if len(table) == 0:
+        return []
+    similarities = get_similarities_for_table(embedding, table)
+    rows = top_rows(similarities, top_n=top_n, threshold=threshold)
+    return [table.similarity_result(i, similarities[i]) for i in rows]
+
+
+def rank_table_cached(
+    query: str,
+    table: FragmentTable,
+    *,
+    scope: str,
+    version: str,
+    mode: Literal["openai", "cohere"] = "openai",
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+    embed_query: Callable[[str, str], np.ndarray] = query_cache.embed_query,
+) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Like `rank_table`, but for a query rather than its embedding, and answered from the result cache if the same search
+    has been run on this version of the table before. `scope` identifies the table apart from its version (see
+    `query_cache.result_scope`).
+
+    :param embed_query: Called with the query and the mode to embed the query on a cache miss.
+    """
+    key = query_cache.result_key(query, scope=scope, version=version, top_n=top_n, threshold=threshold)
+    cached = query_cache.get_results(key)
+    if cached is not None:
+        return [table.similarity_result(i, similarity) for i, similarity in zip(*cached)]
+    if len(table) == 0:
+        return []
     # Embed the query
     logger.info(f"Embedding the query")
-    embedded_query = embed_text(query, mode=mode)
-    # Find the most similar fragments
-    return get_similarities_for_fragments(embedded_query, embedded_fragments, **kwargs)
+    similarities = get_similarities_for_table(embed_query(query, mode), table)
+    rows = top_rows(similarities, top_n=top_n, threshold=threshold)
+    query_cache.put_results(key, scope=scope, version=version, rows=rows, similarities=similarities[rows])
+    return [table.similarity_result(i, similarities[i]) for i in rows]
+
+
+async def arank_table_cached(
+    query: str,
+    table: FragmentTable,
+    *,
+    scope: str,
+    version: str,
+    mode: Literal["openai", "cohere"] = "openai",
+    top_n: Optional[int] = None,
+    threshold: float = 0.0,
+    embed_query: Callable[[str, str], Awaitable[np.ndarray]] = query_cache.aembed_query,
+) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Like `rank_table_cached`, without blocking the event loop: the result cache is read and written, and the table
+    scored, on worker threads.
+
+    :param embed_query: Awaited with the query and the mode to embed the query on a cache miss.
+    """
+    key = query_cache.result_key(query, scope=scope, version=version, top_n=top_n, threshold=threshold)
+    cached = await asyncio.to_thread(query_cache.get_results, key)
+    if cached is not None:
+        return [table.similarity_result(i, similarity) for i, similarity in zip(*cached)]
+    if len(table) == 0:
+        return []
+    # Embed the query
+    logger.info(f"Embedding the query")
+    similarities = await asyncio.to_thread(get_similarities_for_table, await embed_query(query, mode), table)
+    rows = top_rows(similarities, top_n=top_n, threshold=threshold)
+    await asyncio.to_thread(
+        query_cache.put_results, key, scope=scope, version=version, rows=rows, similarities=similarities[rows]
+    )
+    return [table.similarity_result(i, similarities[i]) for i in rows]
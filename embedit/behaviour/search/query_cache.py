@@ -0,0 +1,209 @@
+"""
+Caches for repeated searches, in a small SQLite database next to the response cache.
+
+Query embeddings are keyed by the normalised query text and the embedding model, so looking one up doesn't load the
+response cache. Results are keyed by the query, the version of the index they were ranked in, and every parameter that
+affects them (top_n, threshold, which files), and are stored as the rows of the index's table, so that a hit skips
+embedding the query and scoring the table. A new version of the index means new keys, and the results for older
+versions are dropped the next time results are stored for the same index.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import closing
+from pathlib import Path
+from typing import Literal
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+from embedit.behaviour.openai_tools import CACHE_FILE
+from embedit.behaviour.openai_tools import EMBEDDING_MODELS
+from embedit.behaviour.openai_tools import afetch_embedding
+from embedit.behaviour.search.pipeline_components.a03_process.search import aembed_texts
+from embedit.utils.aio import run_sync
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+# Set EMBEDIT_QUERY_CACHE to "off" to disable both caches
+QUERY_CACHE_FILE = os.environ.get("EMBEDIT_QUERY_CACHE", str(CACHE_FILE.with_name("query_cache.sqlite3")))
+# The most query embeddings to keep, least recently used first out
+MAX_QUERIES = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    model TEXT NOT NULL,
+    query TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (model, query)
+);
+CREATE INDEX IF NOT EXISTS queries_used ON queries (used);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    scope TEXT NOT NULL,
+    version TEXT NOT NULL,
+    rows BLOB NOT NULL,
+    similarities BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_scope ON results (scope);
+"""
+
+_initialised: set[str] = set()
+_initialised_lock = threading.Lock()
+
+
+def normalise_query(query: str) -> str:
+    # The embedding APIs ignore newlines anyway
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+def enabled() -> bool:
+    return QUERY_CACHE_FILE.lower() not in ("", "off", "none")
+
+
+def connect() -> sqlite3.Connection:
+    # A connection per use, so that the server's threads don't share one
+    connection = sqlite3.connect(QUERY_CACHE_FILE, timeout=10)
+    with _initialised_lock:
+        if QUERY_CACHE_FILE not in _initialised:
+            Path(QUERY_CACHE_FILE).parent.mkdir(parents=True, exist_ok=True)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            _initialised.add(QUERY_CACHE_FILE)
+    return connection
+
+
+def _store_queries(model: str, queries: Sequence[str], embeddings: np.ndarray):
+    now = time.time()
+    with closing(connect()) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO queries (model, query, embedding, used) VALUES (?, ?, ?, ?)",
+            [(model, query, embedding.astype(np.float32).tobytes(), now) for query, embedding in zip(queries, embeddings)],
+        )
+        connection.execute(
+            "DELETE FROM queries WHERE rowid IN (SELECT rowid FROM queries ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (MAX_QUERIES,),
+        )
+
+
+def _lookup_queries(model: str, queries: Sequence[str]) -> dict[str, np.ndarray]:
+    found: dict[str, np.ndarray] = {}
+    with closing(connect()) as connection, connection:
+        for query in queries:
+            row = connection.execute(
+                "SELECT embedding FROM queries WHERE model = ? AND query = ?", (model, query)
+            ).fetchone()
+            if row is not None:
+                found[query] = np.frombuffer(row[0], dtype=np.float32)
+        connection.executemany(
+            "UPDATE queries SET used = ? WHERE model = ? AND query = ?",
+            [(time.time(), model, query) for query in found],
+        )
+    return found
+
+
+async def aembed_queries(queries: Sequence[str], mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    """
+    Return the embeddings of the given queries as a matrix, embedding only the ones that aren't in the query cache. The
+    cache is read and written on worker threads, so that it doesn't block the event loop.
+    """
+    if not enabled():
+        return await aembed_texts([normalise_query(query) for query in queries], mode=mode)
+    model = f"{mode}:{EMBEDDING_MODELS[mode]}"
+    normalised = [normalise_query(query) for query in queries]
+    with profiler.stage("cache.queries", queries=len(normalised)) as stage:
+        found = await asyncio.to_thread(_lookup_queries, model, list(dict.fromkeys(normalised)))
+        stage.add("hits", len(found))
+    missing = [query for query in dict.fromkeys(normalised) if query not in found]
+    if missing:
+        if len(missing) == 1:
+            # Straight to the API: one query isn't worth loading the response cache for
+            embeddings = np.asarray([await afetch_embedding(missing[0], mode)], dtype=np.float32)
+        else:
+            embeddings = await aembed_texts(missing, mode=mode)
+        await asyncio.to_thread(_store_queries, model, missing, embeddings)
+        found.update(zip(missing, embeddings))
+    profiler.count("cache.queries.hits", len(normalised) - len(missing))
+    profiler.count("cache.queries.misses", len(missing))
+    return np.stack([found[query] for query in normalised])
+
+
+def embed_queries(queries: Sequence[str], mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    """
+    Return the embeddings of the given queries as a matrix, embedding only the ones that aren't in the query cache.
+    """
+    return run_sync(aembed_queries(queries, mode=mode))
+
+
+async def aembed_query(query: str, mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    """
+    Return the embedding of the query, from the query cache if it's there.
+    """
+    return (await aembed_queries([query], mode=mode))[0]
+
+
+def embed_query(query: str, mode: Literal["openai", "cohere"] = "openai") -> np.ndarray:
+    """
+    Return the embedding of the query, from the query cache if it's there.
+    """
+    return embed_queries([query], mode=mode)[0]
+
+
+def result_scope(**params) -> str:
+    """
+    Identify what a search ran against (e.g. the index directory, its parameters and the files searched), apart from
+    the version of its contents.
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def result_key(query: str, *, scope: str, version: str, top_n: Optional[int], threshold: float) -> str:
+    return result_scope(
+        query=normalise_query(query), scope=scope, version=version, top_n=top_n, threshold=float(threshold)
+    )
+
+
+def get_results(key: str) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """
+    Return the rows and similarities of the results stored under the key, or None.
+    """
+    if not enabled():
+        return None
+    with closing(connect()) as connection:
+        row = connection.execute("SELECT rows, similarities FROM results WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        profiler.count("cache.results.misses")
+        return None
+    profiler.count("cache.results.hits")
+    return np.frombuffer(row[0], dtype=np.int64), np.frombuffer(row[1], dtype=np.float32)
+
+
+def put_results(key: str, *, scope: str, version: str, rows: np.ndarray, similarities: np.ndarray):
+    """
+    Store the rows and similarities of a search's results, dropping any stored for older versions of the same scope.
+    """
+    if not enabled():
+        return
+    with closing(connect()) as connection, connection:
+        removed = connection.execute(
+            "DELETE FROM results WHERE scope = ? AND version != ?", (scope, version)
+        ).rowcount
+        connection.execute(
+            "INSERT OR REPLACE INTO results (key, scope, version, rows, similarities) VALUES (?, ?, ?, ?, ?)",
+            (
+                key,
+                scope,
+                version,
+                np.asarray(rows, dtype=np.int64).tobytes(),
+                np.asarray(similarities, dtype=np.float32).tobytes(),
+            ),
+        )
+    if removed:
+        logger.info(f"Dropped {removed} cached results for older versions of the index")
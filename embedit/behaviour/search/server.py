@@ -0,0 +1,344 @@
+"""
+A long-running search server that keeps indexes, embeddings and API clients resident between requests.
+
+Requests and responses are JSON objects. Over a Unix socket, each is sent on a line of its own; over HTTP, requests
+are POSTed to `/search` with the server's token as a bearer token. The socket is only accessible to the user who started
+the server, and so is the token, which is kept in a file in their home directory.
+"""
+import getpass
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+from typing import Union
+
+import numpy as np
+from attrs import define
+from attrs import field
+
+from embedit.behaviour.search import query_cache
+from embedit.behaviour.search.index import SearchIndex
+from embedit.behaviour.search.index import files_table
+from embedit.behaviour.search.index import open_index
+from embedit.behaviour.search.index import read_current
+from embedit.behaviour.search.pipelines import rank_table_cached
+from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.text_file import TextFileFragment
+from embedit.utils.log import logger
+
+DEFAULT_HOST = "127.0.0.1"
+TOKEN_FILE = Path.home() / ".cache" / "embedit" / "server-token"
+
+
+class SearchServerError(RuntimeError):
+    """
+    The server couldn't handle a request (e.g. it rejected the token or the search failed).
+    """
+
+
+def default_socket_path() -> Path:
+    if "EMBEDIT_SOCKET" in os.environ:
+        return Path(os.environ["EMBEDIT_SOCKET"])
+    return Path(tempfile.gettempdir()) / f"embedit-{getpass.getuser()}.sock"
+
+
+def server_token() -> Optional[str]:
+    """
+    The token for HTTP requests: $EMBEDIT_SERVER_TOKEN, or the one the last HTTP server wrote to `TOKEN_FILE`.
+    """
+    if os.environ.get("EMBEDIT_SERVER_TOKEN"):
+        return os.environ["EMBEDIT_SERVER_TOKEN"]
+    try:
+        return TOKEN_FILE.read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_token(token: str):
+    # Readable by this user alone, from the moment it's created
+    TOKEN_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = TOKEN_FILE.with_name(f".{TOKEN_FILE.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.replace(tmp_path, TOKEN_FILE)
+
+
+class InFlight:
+    """
+    Coalesces concurrent calls that share a key, so that only the first one does the work and the rest wait for its
+    result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, function: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if leader:
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return future.result()
+
+
+def result_to_json(result: EmbeddedTextFileFragmentSimilarityResult) -> dict:
+    fragment = result.embedded_fragment.fragment
+    return {
+        "path": str(fragment.path),
+        "start_line": fragment.start_line,
+        "contents": fragment.contents,
+        "similarity": result.similarity,
+    }
+
+
+def result_from_json(result: dict) -> tuple[TextFileFragment, float]:
+    fragment = TextFileFragment(path=result["path"], contents=result["contents"], start_line=result["start_line"])
+    return fragment, result["similarity"]
+
+
+@define
+class SearchService:
+    """
+    Answers search requests from resident indexes, one per set of indexing parameters (and index directory).
+
+    Indexes loaded from an index directory are reloaded whenever a new version is published there, e.g. by
+    `embedit index --watch`.
+    """
+
+    indexes: dict[tuple, SearchIndex] = field(factory=dict)
+    loaded_versions: dict[tuple, Optional[str]] = field(factory=dict)
+    in_flight: InFlight = field(factory=InFlight)
+    _lock: threading.Lock = field(factory=threading.Lock, repr=False)
+
+    def index(
+        self,
+        *,
+        fragment_lines: int,
+        min_fragment_lines: int,
+        mode: str,
+        chunking: str = "fixed",
+        index_dir: Optional[str] = None,
+    ) -> SearchIndex:
+        key = (fragment_lines, min_fragment_lines, mode, chunking, index_dir)
+        with self._lock:
+            if index_dir is not None:
+                version = read_current(Path(index_dir))
+                if key not in self.indexes or self.loaded_versions[key] != version:
+                    self.indexes[key] = open_index(
+                        index_dir,
+                        fragment_lines=fragment_lines,
+                        min_fragment_lines=min_fragment_lines,
+                        mode=mode,
+                        chunking=chunking,
+                    )
+                    self.loaded_versions[key] = version
+            elif key not in self.indexes:
+                self.indexes[key] = SearchIndex(
+                    fragment_lines=fragment_lines, min_fragment_lines=min_fragment_lines, mode=mode, chunking=chunking
+                )
+            return self.indexes[key]
+
+    def embed_query(self, query: str, mode: str) -> np.ndarray:
+        return self.in_flight.do(("query", query, mode), query_cache.embed_query, query, mode=mode)
+
+    def search(self, request: dict) -> dict:
+        files = request["files"]
+        assert len(files) > 0, "No files were provided"
+        mode = request.get("mode", "openai")
+        index = self.index(
+            fragment_lines=request.get("fragment_lines", 20),
+            min_fragment_lines=request.get("min_fragment_lines", 0),
+            mode=mode,
+            chunking=request.get("chunking", "fixed"),
+            index_dir=request.get("index_dir"),
+        )
+        index.update(files)
+        # Read together, as another request's update can publish a new snapshot at any time, and rows ranked on one
+        # snapshot must not be cached under another's version
+        version, snapshot = index.current()
+        scope = query_cache.result_scope(
+            server=True,
+            index_dir=request.get("index_dir"),
+            fragment_lines=index.fragment_lines,
+            min_fragment_lines=index.min_fragment_lines,
+            mode=mode,
+            chunking=index.chunking,
+            files=sorted(files),
+        )
+        results = rank_table_cached(
+            request["query"],
+            files_table(snapshot, files),
+            scope=scope,
+            version=version,
+            mode=mode,
+            top_n=request.get("top_n"),
+            threshold=request.get("threshold", 0.0),
+            embed_query=self.embed_query,
+        )
+        return {"version": version, "results": [result_to_json(result) for result in results]}
+
+    def handle(self, payload: bytes) -> dict:
+        try:
+            return self.search(json.loads(payload))
+        except Exception as e:
+            logger.exception("Failed to handle request")
+            return {"error": f"{type(e).__name__}: {e}"}
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.service.handle(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip("/") != "/search":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        payload = self.rfile.read(length)
+        authorization = self.headers.get("Authorization", "")
+        if hmac.compare_digest(authorization.encode(), f"Bearer {self.server.token}".encode()):
+            response = self.server.service.handle(payload)
+            status = 500 if "error" in response else 200
+        else:
+            response = {"error": "Missing or wrong token. Set EMBEDIT_SERVER_TOKEN to the server's token."}
+            status = 401
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.info(format % args)
+
+
+def serve(
+    *,
+    socket_path: Optional[str] = None,
+    host: str = DEFAULT_HOST,
+    port: Optional[int] = None,
+    token: Optional[str] = None,
+):
+    """
+    Serve search requests until interrupted, over HTTP if a port is given and over a Unix socket otherwise.
+
+    :param token: The token HTTP requests must carry (default: $EMBEDIT_SERVER_TOKEN, or a new random one). It's
+        written to `TOKEN_FILE`, where `request_search` finds it.
+    """
+    service = SearchService()
+    if port is not None:
+        token = token or os.environ.get("EMBEDIT_SERVER_TOKEN") or secrets.token_urlsafe(32)
+        write_token(token)
+        server = ThreadingHTTPServer((host, port), _HTTPHandler)
+        server.token = token
+        logger.warning(f"Serving on http://{host}:{server.server_address[1]} (token in {TOKEN_FILE})")
+        path = None
+    else:
+        path = Path(socket_path) if socket_path is not None else default_socket_path()
+        if path.exists():
+            if is_listening(path):
+                raise RuntimeError(f"A server is already listening on {path}")
+            # Left behind by a server that didn't shut down cleanly
+            path.unlink()
+        # Create the socket accessible to this user alone, rather than restricting it after it's bound
+        umask = os.umask(0o177)
+        try:
+            server = _UnixServer(str(path), _UnixHandler)
+        finally:
+            os.umask(umask)
+        logger.warning(f"Serving on {path}")
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if path is not None and path.exists():
+            path.unlink()
+
+
+def is_listening(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            return False
+    return True
+
+
+def request_search(
+    request: dict, *, server: Union[str, Path, None] = None, timeout: float = 120
+) -> list[tuple[TextFileFragment, float]]:
+    """
+    Send a search request to a running server.
+
+    :param request: The request, with the same keys as `semantic_search`'s arguments. Paths must be absolute.
+    :param server: An `http://` URL or the path of a Unix socket. Defaults to `default_socket_path()`.
+    :param timeout: Seconds to wait for a response.
+    :return: Fragments and their similarities, most similar first if `top_n` was given.
+    :raises OSError: If the server can't be reached.
+    :raises SearchServerError: If the server couldn't handle the request.
+    """
+    address = str(server) if server is not None else str(default_socket_path())
+    data = json.dumps(request).encode()
+    if address.startswith(("http://", "https://")):
+        headers = {"Content-Type": "application/json"}
+        token = server_token()
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+        http_request = urllib.request.Request(address.rstrip("/") + "/search", data=data, headers=headers)
+        try:
+            with urllib.request.urlopen(http_request, timeout=timeout) as response:
+                payload = json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                payload = json.load(e)
+            except ValueError:
+                raise e
+    else:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(address)
+            sock.sendall(data + b"\n")
+            with sock.makefile("rb") as f:
+                payload = json.loads(f.readline())
+    if "error" in payload:
+        raise SearchServerError(f"Search server error: {payload['error']}")
+    return [result_from_json(result) for result in payload["results"]]
@@ -0,0 +1,192 @@
+"""
+Search several saved indexes at once, e.g. one per repository.
+
+Each index directory is a shard. Queries fan out to a process pool whose workers memory-map the shards' embedding
+matrices, so the pages are shared between the workers (and with the OS page cache) rather than copied into each. Each
+worker scores a block of rows and sends back only its top rows, which are merged into one global ranking, and only the
+winning fragments are read from disk. Adding a repository just means indexing it and adding its index directory.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+from attrs import define
+
+from embedit.behaviour.search import query_cache
+from embedit.behaviour.search.index import INDEX_FORMAT
+from embedit.behaviour.search.index import content_digest
+from embedit.behaviour.search.index import file_stat
+from embedit.behaviour.search.index import read_current
+from embedit.behaviour.search.pipeline_components.a03_process.search import top_rows
+from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.fragment_table import FragmentTable
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+# The most rows one task scores. Larger shards are split between several workers.
+ROWS_PER_TASK = 1 << 18
+
+
+@lru_cache(maxsize=64)
+def open_matrix(path: str) -> np.ndarray:
+    # Memory-mapped, so that every process scoring the shard shares the same pages
+    return np.load(path, mmap_mode="r")
+
+
+@define(frozen=True)
+class Shard:
+    """
+    The current version of an index saved by `SearchIndex.save`, opened without reading the indexed files.
+    """
+
+    index_dir: Path
+    version_dir: Path
+    mode: str
+    files: list[dict]
+    row_ends: np.ndarray
+    columns: dict[str, np.ndarray]
+
+    @classmethod
+    def open(cls, index_dir: str) -> "Shard":
+        index_dir = Path(index_dir)
+        version = read_current(index_dir)
+        if version is None:
+            raise FileNotFoundError(f"There is no index in {index_dir}. Create one with `embedit index`.")
+        version_dir = index_dir / version
+        with open(version_dir / "meta.json") as f:
+            meta = json.load(f)
+        if meta["format"] != INDEX_FORMAT:
+            raise ValueError(f"The index in {index_dir} has an unsupported format ({meta['format']})")
+        with np.load(version_dir / "table.npz") as table:
+            columns = {key: table[key] for key in table.files}
+        return cls(
+            index_dir=index_dir,
+            version_dir=version_dir,
+            mode=meta["mode"],
+            files=meta["files"],
+            row_ends=np.cumsum([file["rows"] for file in meta["files"]], dtype=np.int64),
+            columns=columns,
+        )
+
+    @property
+    def embeddings_path(self) -> str:
+        return str(self.version_dir / "embeddings.npy")
+
+    def __len__(self) -> int:
+        return int(self.row_ends[-1]) if len(self.row_ends) else 0
+
+    def result(self, row: int, similarity: float) -> Optional[EmbeddedTextFileFragmentSimilarityResult]:
+        """
+        Read the fragment in the given row from its file. Return None if the file has changed since it was indexed.
+        """
+        file = self.files[int(np.searchsorted(self.row_ends, row, side="right"))]
+        path = Path(file["path"])
+        try:
+            stat = file_stat(path)
+            buffer = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if stat != tuple(file["stat"]) and content_digest(buffer) != file["digest"]:
+            return None
+        table = FragmentTable.from_columns(
+            paths=[path],
+            buffers=[buffer],
+            path_ids=[0],
+            byte_starts=self.columns["byte_starts"][row: row + 1],
+            byte_ends=self.columns["byte_ends"][row: row + 1],
+            start_lines=self.columns["start_lines"][row: row + 1],
+            end_lines=self.columns["end_lines"][row: row + 1],
+        ).with_embeddings(open_matrix(self.embeddings_path)[row: row + 1])
+        return table.similarity_result(0, similarity)
+
+
+def score_rows(
+    embeddings_path: str, start: int, stop: int, queries: np.ndarray, top_n: Optional[int], threshold: float
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Score rows [start, stop) of a shard for every query.
+
+    :return: The rows (of the shard) and similarities of each query's top rows.
+    """
+    matrix = open_matrix(embeddings_path)[start:stop]
+    similarities = queries @ matrix.T
+    similarities /= np.outer(np.linalg.norm(queries, axis=1), np.linalg.norm(matrix, axis=1))
+    results = []
+    for query_similarities in similarities:
+        rows = top_rows(query_similarities, top_n=top_n, threshold=threshold)
+        results.append((rows + start, query_similarities[rows]))
+    return results
+
+
+def search_shards_many(
+    queries: Sequence[str],
+    *index_dirs: str,
+    top_n: Optional[int] = 10,
+    threshold: float = 0.0,
+    workers: Optional[int] = None,
+    rows_per_task: int = ROWS_PER_TASK,
+) -> dict[str, list[EmbeddedTextFileFragmentSimilarityResult]]:
+    """
+    Search the indexes in the given directories for each query, and merge the results into one ranking per query.
+
+    :param queries: The queries.
+    :param index_dirs: The index directories (shards), all embedded with the same mode.
+    :param top_n: The most results to return per query.
+    :param threshold: The minimum similarity of a result.
+    :param workers: The number of processes to score with (default: one per CPU). 0 scores in this process.
+    :param rows_per_task: The most rows one process scores at a time.
+    :return: The results for each distinct query, most similar first. Fragments of files that have changed since they
+        were indexed are left out.
+    """
+    assert len(index_dirs) > 0, "No indexes were provided"
+    shards = [Shard.open(index_dir) for index_dir in index_dirs]
+    modes = {shard.mode for shard in shards if len(shard)}
+    if len(modes) > 1:
+        raise ValueError(f"Can't search indexes embedded with different modes together ({', '.join(sorted(modes))})")
+    queries = list(dict.fromkeys(queries))
+    tasks = [
+        (shard_id, start, min(start + rows_per_task, len(shard)))
+        for shard_id, shard in enumerate(shards)
+        for start in range(0, len(shard), rows_per_task)
+    ]
+    if not queries or not tasks:
+        return {query: [] for query in queries}
+    # Embed the queries
+    logger.info(f"Embedding {len(queries)} queries")
+    embedded_queries = query_cache.embed_queries(queries, mode=modes.pop())
+    # Score every block of every shard
+    with profiler.stage("shards.score", shards=len(shards), tasks=len(tasks), rows=sum(map(len, shards))):
+        arguments = [
+            (shards[shard_id].embeddings_path, start, stop, embedded_queries, top_n, threshold)
+            for shard_id, start, stop in tasks
+        ]
+        if workers == 0 or len(tasks) == 1:
+            scored = [score_rows(*task_arguments) for task_arguments in arguments]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as pool:
+                scored = list(pool.map(score_rows, *zip(*arguments)))
+    # Merge the top rows of every block into one ranking per query
+    results = {}
+    for q, query in enumerate(queries):
+        shard_ids = np.concatenate([np.full(len(task[q][0]), shard_id) for (shard_id, *_), task in zip(tasks, scored)])
+        rows = np.concatenate([task[q][0] for task in scored])
+        similarities = np.concatenate([task[q][1] for task in scored])
+        best = top_rows(similarities, top_n=top_n, threshold=threshold)
+        hits = [shards[shard_ids[i]].result(int(rows[i]), similarities[i]) for i in best]
+        stale = sum(hit is None for hit in hits)
+        if stale:
+            logger.warning(f"Left out {stale} results from files that changed since they were indexed")
+        results[query] = [hit for hit in hits if hit is not None]
+    return results
+
+
+def search_shards(query: str, *index_dirs: str, **kwargs) -> list[EmbeddedTextFileFragmentSimilarityResult]:
+    """
+    Search the indexes in the given directories for the query. See `search_shards_many`.
+    """
+    return search_shards_many([query], *index_dirs, **kwargs)[query]
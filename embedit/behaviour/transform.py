@@ -1,10 +1,10 @@
+import os
 import pathlib
 from functools import partial
 from typing import Callable
 from typing import Optional
 from typing import Sequence
 
-import tiktoken
 from dir2md import TextFile
 from dir2md import dir2md
 from dir2md import md2dir
@@ -12,13 +12,18 @@ from dir2md import save_dir
 from rich import print
 from rich.panel import Panel
 
+from embedit.behaviour.openai_tools import OutOfTokensError
 from embedit.behaviour.openai_tools import complete
 from embedit.behaviour.openai_tools import toklen
 from embedit.behaviour.prompts.transform import default_transform_pre_prompt
-from embedit.utils.diff import get_diff_stats
+from embedit.behaviour.transform_manifest import TransformManifest
+from embedit.behaviour.transform_manifest import input_key
+from embedit.behaviour.transform_segments import segment_budget
+from embedit.behaviour.transform_segments import transform_large_file
+from embedit.utils.diff import compute_diff
 from embedit.utils.diff import pretty_diff
-
-enc = tiktoken.get_encoding("gpt2")
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
 
 
 def simple_transform_files(
@@ -29,81 +34,174 @@ def simple_transform_files(
     max_chunk_len: Optional[int] = 1600,
     yes: bool = False,
     model: str = "gpt-3.5-turbo",
+    force: bool = False,
+    split_large_files: bool = True,
+    workers: int = 4,
+    show_diff: bool = True,
 ):
     """
     Transform the given files by passing their markdown representation with the given prompt to the OpenAI API.
+
+    Files that were transformed into `output_dir` before with the same contents, prompt, pre-prompt and model reuse
+    their outputs from the transform manifest there, unless `force` is set; only the rest are sent.
+
+    If `split_large_files` is set, files too large for a single request are split into segments, which are transformed
+    concurrently (up to `workers` at once) and stitched back together.
+
+    Returns the transformed files (including any reused from the manifest that weren't saved yet).
     """
     if pre_prompt is None:
         pre_prompt = default_transform_pre_prompt
 
-    if max_chunk_len is None:
-        chunks = [files]
+    manifest = TransformManifest.load(output_dir)
+    keys = {file: input_key(file, prompt=prompt, pre_prompt=pre_prompt, model=model) for file in files}
+    results = []
+    changed_files = []
+    for file in files:
+        outputs = None if force else manifest.outputs(file, keys[file])
+        if outputs is None:
+            changed_files.append(file)
+        else:
+            # Only show and write the outputs that aren't in the output directory already
+            results.extend(output for output in outputs if not manifest.is_saved(output))
+    profiler.count("transform.manifest.hits", len(files) - len(changed_files))
+    profiler.count("transform.manifest.misses", len(changed_files))
+    if len(changed_files) < len(files):
+        logger.warning(f"Skipping {len(files) - len(changed_files)} files that haven't changed since the last run")
+
+    if split_large_files and changed_files:
+        budget = segment_budget(model, prompt=prompt, pre_prompt=pre_prompt)
+        if max_chunk_len is not None:
+            budget = min(budget, max_chunk_len)
+        large_files = [
+            file for file in changed_files if toklen("\n".join(dir2md(file)), model, estimate=True) > budget
+        ]
+        for file in large_files:
+            result = [
+                transform_large_file(
+                    file, model=model, pre_prompt=pre_prompt, prompt=prompt, max_tokens=budget, workers=workers
+                )
+            ]
+            results.extend(result)
+            manifest.record([file], keys, result)
+            manifest.save()
+        changed_files = [file for file in changed_files if file not in large_files]
+
+    if not changed_files:
+        chunks = []
+    elif max_chunk_len is None:
+        chunks = [changed_files]
     else:
-        chunks = simple_transform_files_get_chunks(files, max_chunk_len, partial(toklen, model=model))
+        chunks = simple_transform_files_get_chunks(
+            changed_files, max_chunk_len, partial(toklen, model=model, estimate=True)
+        )
 
-    results = []
     for chunk_files in chunks:
         result = simple_transform_files_execute_chunk(
             model, chunk_files, pre_prompt, prompt
         )
         results.extend(result)
+        # After each chunk, so that an interrupted run doesn't send it again
+        manifest.record(chunk_files, keys, result)
+        manifest.save()
 
-    wrapup(results, output_dir, yes)
+    wrapup(results, output_dir, yes, show_diff=show_diff)
+    return results
 
 
 def simple_transform_files_get_chunks(files: Sequence[str], max_chunk_len: int, toklen: Callable[[str], int]) -> list[list[str]]:
     # Add as many files as possible while keeping the total length of the markdown representation below
     # max_chunk_len tokens
-    chunk_strings = []
+    chunk_len = 0
     chunk_files = []
     for file in files:
-        file_string = "\n".join(dir2md(file))
-        if (
-                sum(toklen(string) for string in chunk_strings) + toklen(file_string)
-                > max_chunk_len
-        ):
+        file_len = toklen("\n".join(dir2md(file)))
+        if chunk_len + file_len > max_chunk_len and chunk_files:
             # The current chunk plus the new file would exceed max_chunk_len, so transform the current chunk
             yield chunk_files
             # Start a new chunk
-            chunk_strings = []
+            chunk_len = 0
             chunk_files = []
         # Add the file to the current chunk
-        chunk_strings.append(file_string)
+        chunk_len += file_len
         chunk_files.append(file)
     # Recurse with the last chunk
-    yield chunk_files
+    if chunk_files:
+        yield chunk_files
 
 
-def simple_transform_files_execute_chunk(
+def simple_transform_files_request(
     model: str, files: Sequence[TextFile], pre_prompt: str, prompt: str
 ) -> list[TextFile]:
     # Transform all files at once
     markdown = "\n".join(dir2md(*files))
-    result_markdown: str = complete(
-        context=markdown,
-        prompt=prompt,
-        pre_prompt=pre_prompt,
-        model=model,
-    )
+    try:
+        result_markdown: str = complete(
+            context=markdown,
+            prompt=prompt,
+            pre_prompt=pre_prompt,
+            model=model,
+        )
+    except OutOfTokensError as e:
+        # Keep the files that were finished before the response was cut off
+        logger.warning(f"The response for {len(files)} files was cut off")
+        result_markdown = e.text
     result_files: list[TextFile] = list(md2dir(result_markdown))
     return result_files
 
 
-def wrapup(result_files: list[TextFile], output_dir: str, yes: bool):
+def simple_transform_files_execute_chunk(
+    model: str, files: Sequence[TextFile], pre_prompt: str, prompt: str, *, max_retries: int = 2
+) -> list[TextFile]:
+    """
+    Transform a chunk of files, checking the response against them: files that are missing from it or were cut off
+    are requested again in a smaller follow-up chunk, up to `max_retries` times, and the results are merged.
+    """
+    wanted = [os.path.normpath(file) for file in files]
+    results: dict[str, TextFile] = {}
+    # Files the model added, e.g. new modules
+    extra_results: list[TextFile] = []
+    pending = list(files)
+    for attempt in range(max_retries + 1):
+        for result in simple_transform_files_request(model, pending, pre_prompt, prompt):
+            if result.partial:
+                continue
+            path = os.path.normpath(result.path)
+            if path in wanted:
+                results[path] = result
+            else:
+                extra_results.append(result)
+        missing = [file for file in files if os.path.normpath(file) not in results]
+        if not missing:
+            break
+        if len(missing) == len(pending) or attempt == max_retries:
+            # Asking again for the same files would get the same (cached) response
+            logger.warning(f"Giving up on {len(missing)} files missing from the response: {', '.join(missing)}")
+            profiler.count("transform.dropped_files", len(missing))
+            break
+        logger.warning(f"{len(missing)} of {len(pending)} files were missing or cut off; requesting them again")
+        profiler.count("transform.retried_files", len(missing))
+        pending = missing
+    return [results[path] for path in wanted if path in results] + extra_results
+
+
+def wrapup(result_files: list[TextFile], output_dir: str, yes: bool, *, show_diff: bool = True):
     # Print the diff of each file
-    for result in result_files:
+    for result in result_files if show_diff else []:
         original = (
             pathlib.Path(result.path).read_text()
             if pathlib.Path(result.path).is_file()
             else ""
         )
-        diff = pretty_diff(original, result.text)
-        diff_stats = get_diff_stats(original, result.text)
-        print(
-            Panel(
-                diff,
-                title=result.path,
-                subtitle=f"{diff_stats.added} lines added, {diff_stats.removed} lines removed",
+        with profiler.stage("render.diff", lines=result.text.count("\n") + 1):
+            # Diff once, for both the rendering and the stats
+            diff = compute_diff(original, result.text)
+            diff_stats = diff.stats
+            print(
+                Panel(
+                    pretty_diff(original, result.text, diff=diff),
+                    title=result.path,
+                    subtitle=f"{diff_stats.added} lines added, {diff_stats.removed} lines removed",
+                )
             )
-        )
     save_dir(result_files, output_dir=output_dir, yes=yes)
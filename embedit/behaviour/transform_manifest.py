@@ -0,0 +1,105 @@
+"""
+A manifest of what `transform` produced, kept in the output directory, so that re-running it only sends the files whose
+inputs changed.
+
+Each input file is recorded under its path with a key (a hash of its contents, the prompt, the pre-prompt and the
+model) and the output files its chunk produced for it. On a re-run, files with the same key reuse their outputs instead
+of being sent to the model again, and only the rest are packed into chunks.
+"""
+import hashlib
+import json
+import os
+import pathlib
+from typing import Optional
+
+from attrs import define
+from attrs import field
+from dir2md import TextFile
+
+from embedit.utils.log import logger
+
+MANIFEST_FILE = ".embedit-transform.json"
+# Bumped whenever the layout of the manifest changes
+MANIFEST_FORMAT = 1
+
+
+def input_key(path: str, *, prompt: str, pre_prompt: str, model: str) -> str:
+    """
+    Hash everything that determines what the model is asked to do with the file.
+    """
+    digest = hashlib.sha256()
+    for part in [pathlib.Path(path).read_bytes(), prompt.encode(), pre_prompt.encode(), model.encode()]:
+        # Length-prefixed, so that moving bytes between parts changes the key
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+@define
+class TransformManifest:
+    output_dir: pathlib.Path
+    # Input path -> {"key": ..., "outputs": [{"path": ..., "text": ...}, ...]}
+    entries: dict[str, dict] = field(factory=dict)
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.output_dir / MANIFEST_FILE
+
+    @classmethod
+    def load(cls, output_dir: str) -> "TransformManifest":
+        manifest = cls(output_dir=pathlib.Path(output_dir))
+        try:
+            data = json.loads(manifest.path.read_text())
+        except FileNotFoundError:
+            return manifest
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable transform manifest {manifest.path} ({e})")
+            return manifest
+        if data.get("format") != MANIFEST_FORMAT:
+            logger.warning(f"Ignoring transform manifest {manifest.path} of format {data.get('format')}")
+            return manifest
+        manifest.entries = data["files"]
+        return manifest
+
+    def save(self):
+        # Atomically, so that an interrupted run leaves the previous manifest
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"format": MANIFEST_FORMAT, "files": self.entries}, indent=1))
+        os.replace(tmp_path, self.path)
+
+    def outputs(self, file: str, key: str) -> Optional[list[TextFile]]:
+        """
+        Return what the file's last transformation produced, if it was transformed with the same key.
+        """
+        entry = self.entries.get(os.path.normpath(file))
+        if entry is None or entry["key"] != key:
+            return None
+        return [TextFile(path=output["path"], text=output["text"], partial=False) for output in entry["outputs"]]
+
+    def record(self, files: list[str], keys: dict[str, str], results: list[TextFile]):
+        """
+        Record the results of transforming a chunk. Each result is attributed to the input with the same path, and any
+        others (e.g. new files) to the chunk's first input. Inputs the model didn't return are left out, so that they're
+        sent again next time.
+        """
+        by_input: dict[str, list[TextFile]] = {os.path.normpath(file): [] for file in files}
+        for result in results:
+            path = os.path.normpath(result.path)
+            by_input[path if path in by_input else os.path.normpath(files[0])].append(result)
+        for file in files:
+            path = os.path.normpath(file)
+            if not any(os.path.normpath(result.path) == path for result in by_input[path]):
+                self.entries.pop(path, None)
+                continue
+            self.entries[path] = {
+                "key": keys[file],
+                "outputs": [{"path": result.path, "text": result.text} for result in by_input[path]],
+            }
+
+    def is_saved(self, result: TextFile) -> bool:
+        # Whether the output directory already holds this output, so there's nothing to show or write
+        try:
+            return (self.output_dir / result.path).read_text() == result.text
+        except (OSError, UnicodeDecodeError):
+            return False
@@ -0,0 +1,197 @@
+"""
+Transforming files too large for one request: split into segments, transform them concurrently, and stitch them back.
+
+Segments end on line boundaries, preferably where a top-level block (e.g. a function or class) starts, and are kept
+under a token budget that leaves room for the prompt, the shared context and the response. Every request after the first
+also gets the start of the file (imports, module docstrings) as read-only context, and is told which lines of which file
+it's transforming.
+"""
+import contextvars
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable
+from typing import Optional
+
+from attrs import define
+from dir2md import TextFile
+from dir2md import dir2md
+from dir2md import md2dir
+
+from embedit.behaviour.openai_tools import OutOfTokensError
+from embedit.behaviour.openai_tools import complete
+from embedit.behaviour.openai_tools import get_max_tokens
+from embedit.behaviour.openai_tools import toklen
+from embedit.behaviour.search.pipeline_components.a04_combine import combine_fragments
+from embedit.structures.text_file import TextFileFragment
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+# Tokens of the start of the file given to every segment as shared context
+DEFAULT_CONTEXT_TOKENS = 256
+# Tokens set aside for the markdown fences and the segment's instructions
+OVERHEAD_TOKENS = 200
+# Room for the response, relative to the segment's length (transformations often add text, e.g. docstrings)
+RESPONSE_GROWTH = 1.5
+# A segment is cut at a block boundary if there's one in its last half, and wherever the budget runs out otherwise
+MIN_SEGMENT_FRACTION = 0.5
+
+
+@define(frozen=True)
+class Segment:
+    path: str
+    index: int
+    start_line: int
+    contents: str
+
+
+def segment_budget(model: str, *, prompt: str, pre_prompt: str, context_tokens: int = DEFAULT_CONTEXT_TOKENS) -> int:
+    """
+    The most tokens of a file that fit in one request with room for the response.
+    """
+    fixed = toklen(pre_prompt, model) + toklen(prompt, model) + context_tokens + OVERHEAD_TOKENS
+    return max(int((get_max_tokens(model) - fixed) / (1 + RESPONSE_GROWTH)), 1)
+
+
+def is_block_start(lines: list[str], i: int) -> bool:
+    # An unindented line after a blank one, e.g. the start of a top-level function or class
+    return i > 0 and not lines[i - 1].strip() and bool(lines[i].strip()) and not lines[i][0].isspace()
+
+
+def split_segments(path: str, text: str, max_tokens: int, toklen: Callable[[str], int]) -> list[Segment]:
+    """
+    Split a file into segments of at most `max_tokens` tokens (unless a single line is longer), on line boundaries,
+    preferring the starts of top-level blocks, then blank lines.
+    """
+    lines = text.splitlines(keepends=True)
+    line_tokens = [toklen(line) for line in lines]
+    segments = []
+    start = 0
+    while start < len(lines):
+        end = start
+        tokens = 0
+        while end < len(lines) and (end == start or tokens + line_tokens[end] <= max_tokens):
+            tokens += line_tokens[end]
+            end += 1
+        if end < len(lines):
+            # Back up to the best boundary in the last part of the segment
+            earliest = start + max(int((end - start) * MIN_SEGMENT_FRACTION), 1)
+            candidates = range(end, earliest - 1, -1)
+            cut = next((i for i in candidates if is_block_start(lines, i)), None)
+            if cut is None:
+                cut = next((i for i in candidates if not lines[i - 1].strip()), end)
+            end = cut
+        segments.append(Segment(path=path, index=len(segments), start_line=start, contents="".join(lines[start:end])))
+        start = end
+    return segments
+
+
+def shared_context(text: str, max_tokens: int, toklen: Callable[[str], int]) -> str:
+    # The first lines of the file, up to max_tokens
+    context = []
+    tokens = 0
+    for line in text.splitlines(keepends=True):
+        tokens += toklen(line)
+        if tokens > max_tokens:
+            break
+        context.append(line)
+    return "".join(context)
+
+
+def file_markdown(path: str, contents: str) -> str:
+    """
+    Format text as dir2md formats a file on disk (as `transform` sends whole files), under the given path.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, "segment")
+        with open(tmp_path, "w") as f:
+            f.write(contents)
+        lines = list(dir2md(tmp_path))
+    # The first line names the file
+    lines[0] = lines[0].replace(tmp_path, path)
+    return "\n".join(lines)
+
+
+def transform_segment(
+    segment: Segment, *, num_segments: int, context: str, model: str, pre_prompt: str, prompt: str
+) -> str:
+    end_line = segment.start_line + segment.contents.count("\n")
+    instructions = [
+        prompt,
+        f"{segment.path} is too long to transform at once, so this is part {segment.index + 1} of {num_segments}:"
+        f" lines {segment.start_line + 1} to {end_line}. Transform only these lines, and respond with them alone,"
+        " under the same filename, as if they were the whole file.",
+    ]
+    if context and segment.index > 0:
+        instructions += [
+            "For reference (don't include it in your response), the file starts with:", "```", context, "```"
+        ]
+    markdown = file_markdown(segment.path, segment.contents.rstrip("\n"))
+    with profiler.stage("transform.segment", lines=segment.contents.count("\n")):
+        try:
+            result_markdown = complete(
+                context=markdown, prompt="\n".join(instructions), pre_prompt=pre_prompt, model=model
+            )
+        except OutOfTokensError as e:
+            result_markdown = e.text
+    results = [result for result in md2dir(result_markdown) if not result.partial]
+    if not results:
+        logger.warning(
+            f"Couldn't parse the response for lines {segment.start_line + 1} to {end_line} of {segment.path}, so"
+            " they're left unchanged"
+        )
+        return segment.contents
+    # The fences lose the segment's surrounding blank lines, so put them back for the segments to join up
+    stripped = segment.contents.strip("\n")
+    if not stripped:
+        return segment.contents
+    leading = segment.contents[: segment.contents.index(stripped)]
+    trailing = segment.contents[len(leading) + len(stripped):]
+    return leading + results[0].text.strip("\n") + trailing
+
+
+def transform_large_file(
+    path: str,
+    *,
+    model: str,
+    pre_prompt: str,
+    prompt: str,
+    max_tokens: Optional[int] = None,
+    context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    workers: int = 4,
+) -> TextFile:
+    """
+    Transform a file that's too large for one request, segment by segment and concurrently.
+
+    :param max_tokens: The most tokens in each segment (default: as many as fit in the model's context window).
+    :param context_tokens: The most tokens of the start of the file to give every segment as shared context.
+    :param workers: The most segments to transform at once.
+    """
+    with open(path) as f:
+        text = f.read()
+    budget = segment_budget(model, prompt=prompt, pre_prompt=pre_prompt, context_tokens=context_tokens)
+    if max_tokens is not None:
+        budget = min(budget, max_tokens)
+    count_tokens = partial(toklen, model=model, estimate=True)
+    segments = split_segments(path, text, budget, count_tokens)
+    context = shared_context(text, context_tokens, count_tokens)
+    logger.warning(f"Transforming {path} in {len(segments)} segments")
+    profiler.count("transform.segments", len(segments))
+
+    def transform(segment: Segment) -> str:
+        return transform_segment(
+            segment, num_segments=len(segments), context=context, model=model, pre_prompt=pre_prompt, prompt=prompt
+        )
+
+    # Each segment runs in a copy of this context, so that its API usage is counted where the file's is
+    contexts = [contextvars.copy_context() for _ in segments]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(segments)))) as pool:
+        contents = list(pool.map(lambda context, segment: context.run(transform, segment), contexts, segments))
+    combined = combine_fragments(
+        [
+            TextFileFragment(path=path, contents=segment_contents, start_line=segment.start_line)
+            for segment, segment_contents in zip(segments, contents)
+        ]
+    )
+    return TextFile(path=str(combined.path), text=combined.contents, partial=False)
@@ -1,24 +1,50 @@
+import contextlib
+import json
 import logging
 import os
 import pathlib
 import subprocess
+import sys
 from typing import Literal
 from typing import Optional
+from typing import Union
 
 import fire
 from delegatefn import delegate
 from rich.console import Console
 from rich.syntax import Syntax
 
-from embedit.behaviour.create import create
+from embedit.behaviour.batch import run_batch
+from embedit.behaviour.create import DEFAULT_FILE_RETRIES
+from embedit.behaviour.create import create as create_files
 from embedit.behaviour.git import make_commit_message
 from embedit.behaviour.transform import simple_transform_files
 from embedit.structures.embedding import EmbeddedTextFileFragmentSimilarityResult
+from embedit.structures.text_file import TextFileFragment
 from embedit.utils.log import logger
+from embedit.utils.stub_server import StubConfig
+from embedit.utils.stub_server import make_stub_server
+from embedit.utils.profile import profile_run
+from embedit.utils.profile import profiler
+from embedit.utils.tokens import DEFAULT_ENCODING
+from embedit.utils.tokens import seed_tokenizer_data
 
 console = Console()
 
 from embedit.behaviour.search.pipelines import semantic_search
+from embedit.behaviour.search.pipelines import semantic_search_many
+from embedit.behaviour.search import server as search_server
+from embedit.behaviour.search.bundle import export_index
+from embedit.behaviour.search.bundle import import_index
+from embedit.behaviour.search.index import DEFAULT_INDEX_DIR
+from embedit.behaviour.search.git_index import index_revision
+from embedit.behaviour.search.git_index import open_repo
+from embedit.behaviour.search.git_index import repo_relative_paths
+from embedit.behaviour.search.git_index import search_revision
+from embedit.behaviour.search.index import build_index
+from embedit.behaviour.search.log_index import log_search as search_log
+from embedit.behaviour.search.shards import search_shards
+from embedit.behaviour.search.shards import search_shards_many
 
 
 def center_pad(text: str, width: int, *, fillchar: str = " ") -> str:
@@ -41,14 +67,56 @@ def resolve_model(model: Optional[str], engine: Optional[str]) -> str:
     return model
 
 
-@delegate(semantic_search, ignore={"query", "files", "mode"})
+def print_results(results: list[tuple[TextFileFragment, float]], order: Literal["ascending", "descending"]):
+    # Enumerate and sort the results
+    results = sorted(results, key=lambda result: result[1], reverse=True)
+    enumerated_results = enumerate(results, start=1)
+    if order == "ascending":
+        enumerated_results = reversed(list(enumerated_results))
+    # Print the results
+    console.print(f"Found {len(results)} results")
+    for i, (fragment, similarity) in enumerated_results:
+        header = f"Result {i}"
+        # Pad the result header with hyphens
+        header = center_pad(header, width=80, fillchar="-")
+        print(header)
+        # Print result info
+        console.print(f"Similarity: {similarity:.2f}")
+        console.print(f"Path: {fragment.path}")
+        # Print the result contents with appropriate highlighting
+        lexer: str = Syntax.guess_lexer(
+            fragment.path,
+            fragment.contents,
+        )
+        console.print(
+            Syntax(
+                fragment.contents,
+                lexer,
+                theme="monokai",
+                line_numbers=True,
+                start_line=fragment.start_line,
+            )
+        )
+        console.print()
+
+
+@delegate(semantic_search, ignore={"query", "files", "mode", "top_n"})
 def search(
-    query: str,
+    query: Optional[str] = None,
     *files: str,
     order: Literal["ascending", "descending"] = "ascending",
     top_n: Optional[int] = 3,
     mode: Literal["openai", "cohere"] = "openai",
     verbose: bool = False,
+    server: Union[bool, str] = False,
+    queries_file: Optional[str] = None,
+    output: Optional[str] = None,
+    shards: Optional[Union[str, tuple[str, ...]]] = None,
+    workers: Optional[int] = None,
+    rev: Optional[str] = None,
+    repo: str = ".",
+    include: Optional[Union[str, tuple[str, ...]]] = None,
+    profile: Union[bool, str] = False,
     **kwargs,
 ):
     """a command line tool for semantic file search
@@ -61,9 +129,27 @@ def search(
     :param verbose: Whether to print verbose output.
     :param fragment_lines: The number of lines to include in each search result fragment.
     :param min_fragment_lines: The minimum number of lines that must match the search query for a result to be included.
+    :param chunking: Where fragments end: every `fragment_lines` lines ('fixed'), or at boundaries found in the text
+        ('content'), so that an edit only changes the fragments around it and the rest keep their cached embeddings.
     :param threshold: A float indicating the minimum similarity score a result must have to be included.
     :param mode: The embedding mode to use. Can be 'openai' or 'cohere'.
     :param top_n: An integer indicating the maximum number of search results to return.
+    :param server: Send the search to a running `embedit serve`, falling back to searching in-process if it can't be
+        reached. Pass a socket path or an `http://` URL to use a server other than the default.
+    :param queries_file: Run every query in this file (one per line) in one pass instead of a single query, and write
+        the results as JSON lines, one `{"query": ..., "results": [...]}` object per query. All positional arguments
+        are then files to search.
+    :param output: Where to write the JSON lines of a `--queries-file` search (default: stdout).
+    :param shards: Search these index directories (e.g. one per repository, built with `embedit index`) instead of
+        files, merging their results into one ranking.
+    :param workers: The number of processes that score `--shards` (default: one per CPU, 0 for none).
+    :param rev: Search the files at this git revision (e.g. `main~50` or a tag), read from the object database
+        without a checkout. Only blobs that have never been embedded before are embedded. The files are then paths in
+        the repository to limit the search to (default: all of it).
+    :param repo: The git repository for `--rev`.
+    :param include: Glob pattern(s) that file names must match with `--rev`, e.g. "*.py".
+    :param profile: Print a profile of where the time went. Pass a path to also write it as JSON (or as a Chrome trace
+        if the path ends in `.trace` or `.trace.json`).
     :return: A list of search results, ranked by their similarity to the query.
     :raises: ValueError - If the ``--order`` argument is not 'ascending' or 'descending'.
     """
@@ -71,6 +157,44 @@ def search(
     if verbose:
         logger.setLevel(logging.INFO)
 
+    if isinstance(shards, str):
+        shards = tuple(shards.split(","))
+    if queries_file is not None:
+        # There's no query argument, so it's the first file
+        files = (query, *files) if query is not None else files
+        if server:
+            logger.warning("The search server doesn't take --queries-file. Searching in-process instead.")
+        with profile_run(profile):
+            search_many(
+                queries_file, *files, top_n=top_n, mode=mode, output=output, shards=shards, workers=workers, **kwargs
+            )
+        return
+    assert query is not None, "No query was provided"
+    if isinstance(include, str):
+        include = (include,)
+    if rev is not None:
+        console.print(f"Searching for '{query}' at {rev}")
+        kwargs.pop("index_dir", None)
+        with profile_run(profile):
+            files = repo_relative_paths(open_repo(repo), files)
+            similarity_results = search_revision(
+                query, rev, *files, repo_path=repo, include=include, mode=mode, top_n=top_n, **kwargs
+            )
+            results = [(result.embedded_fragment.fragment, result.similarity) for result in similarity_results]
+            with profiler.stage("render", results=len(results)):
+                print_results(results, order)
+        return
+    if shards:
+        console.print(f"Searching for '{query}' in {len(shards)} indexes")
+        with profile_run(profile):
+            similarity_results = search_shards(
+                query, *shards, top_n=top_n, threshold=kwargs.get("threshold", 0.0), workers=workers
+            )
+            results = [(result.embedded_fragment.fragment, result.similarity) for result in similarity_results]
+            with profiler.stage("render", results=len(results)):
+                print_results(results, order)
+        return
+
     directories = [file for file in files if pathlib.Path(file).is_dir()]
     if directories:
         console.print(f"Ignoring directories: {', '.join(directories)}")
@@ -78,42 +202,222 @@ def search(
     assert len(files) > 0, "No files were provided"
     # Filter out directories
     console.print(f"Searching for '{query}' in {len(files)} files")
-    # Search for the query
-    results: list[EmbeddedTextFileFragmentSimilarityResult] = semantic_search(
-        query, *files, mode=mode, **kwargs
-    )
-    # Enumerate and sort the results
-    results = sorted(results, key=lambda result: result.similarity, reverse=True)
-    if top_n is not None:
-        results = results[:top_n]
-    enumerated_results = enumerate(results, start=1)
-    if order == "ascending":
-        enumerated_results = reversed(list(enumerated_results))
-    # Print the results
-    console.print(f"Found {len(results)} results")
-    for i, result in enumerated_results:
-        header = f"Result {i}"
-        # Pad the result header with hyphens
-        header = center_pad(header, width=80, fillchar="-")
-        print(header)
-        # Print result info
-        console.print(f"Similarity: {result.similarity:.2f}")
-        console.print(f"Path: {result.embedded_fragment.fragment.path}")
-        # Print the result contents with appropriate highlighting
-        lexer: str = Syntax.guess_lexer(
-            result.embedded_fragment.fragment.path,
-            result.embedded_fragment.fragment.contents,
+    with profile_run(profile):
+        # Search for the query
+        results: Optional[list[tuple[TextFileFragment, float]]] = None
+        if server:
+            request = dict(
+                query=query, files=[str(pathlib.Path(file).resolve()) for file in files], mode=mode, top_n=top_n, **kwargs
+            )
+            if request.get("index_dir") is not None:
+                request["index_dir"] = str(pathlib.Path(request["index_dir"]).resolve())
+            try:
+                with profiler.stage("server.request"):
+                    results = search_server.request_search(request, server=None if server is True else server)
+            except OSError as e:
+                logger.warning(f"Couldn't reach the search server ({e}). Searching in-process instead.")
+            except search_server.SearchServerError as e:
+                logger.warning(f"{e}. Searching in-process instead.")
+        if results is None:
+            similarity_results: list[EmbeddedTextFileFragmentSimilarityResult] = semantic_search(
+                query, *files, mode=mode, top_n=top_n, **kwargs
+            )
+            results = [(result.embedded_fragment.fragment, result.similarity) for result in similarity_results]
+        with profiler.stage("render", results=len(results)):
+            print_results(results, order)
+
+
+def search_many(
+    queries_file: str,
+    *files: str,
+    top_n: Optional[int] = 3,
+    mode: Literal["openai", "cohere"] = "openai",
+    output: Optional[str] = None,
+    shards: Optional[tuple[str, ...]] = None,
+    workers: Optional[int] = None,
+    **kwargs,
+):
+    # Read the queries, one per line
+    queries = [line.strip() for line in pathlib.Path(queries_file).read_text().splitlines() if line.strip()]
+    if shards:
+        # Keep stdout for the results
+        Console(stderr=True).print(f"Searching for {len(queries)} queries in {len(shards)} indexes")
+        results = search_shards_many(
+            queries, *shards, top_n=top_n, threshold=kwargs.get("threshold", 0.0), workers=workers
         )
-        console.print(
-            Syntax(
-                result.embedded_fragment.fragment.contents,
-                lexer,
-                theme="monokai",
-                line_numbers=True,
-                start_line=result.embedded_fragment.fragment.start_line,
+    else:
+        files = [file for file in files if not pathlib.Path(file).is_dir()]
+        assert len(files) > 0, "No files were provided"
+        Console(stderr=True).print(f"Searching for {len(queries)} queries in {len(files)} files")
+        results = semantic_search_many(queries, *files, mode=mode, top_n=top_n, **kwargs)
+    with profiler.stage("render", results=sum(map(len, results.values()))):
+        with open(output, "w") if output is not None else contextlib.nullcontext(sys.stdout) as f:
+            for query, query_results in results.items():
+                record = {"query": query, "results": [search_server.result_to_json(result) for result in query_results]}
+                f.write(json.dumps(record) + "\n")
+
+
+def index(
+    *paths: str,
+    index_dir: str = DEFAULT_INDEX_DIR,
+    include: Optional[Union[str, tuple[str, ...]]] = None,
+    fragment_lines: int = 20,
+    min_fragment_lines: int = 0,
+    mode: Literal["openai", "cohere"] = "openai",
+    chunking: Literal["fixed", "content"] = "fixed",
+    watch: bool = False,
+    debounce: float = 0.5,
+    poll: bool = False,
+    rev: Optional[str] = None,
+    repo: str = ".",
+    root: str = ".",
+    verify: bool = True,
+    workers: Optional[int] = None,
+    verbose: bool = False,
+    profile: Union[bool, str] = False,
+):
+    """
+    Builds (or updates) a persistent search index for the given files and directories. Use it with
+    `embedit search --index-dir`.
+
+    `embedit index export BUNDLE` writes the index to a portable bundle file, and `embedit index import BUNDLE` builds
+    the index from one, re-embedding only the files that differ from the bundle.
+    :param paths: Files and directories to index. Directories are searched recursively, skipping hidden entries.
+    :param index_dir: The directory to store the index in.
+    :param include: Glob pattern(s) that files found in directories must match, e.g. "*.py".
+    :param fragment_lines: The number of lines to include in each fragment.
+    :param min_fragment_lines: The minimum number of lines a fragment must have to be indexed.
+    :param mode: The embedding mode to use. Can be 'openai' or 'cohere'.
+    :param chunking: Where fragments end: every `fragment_lines` lines ('fixed'), or at boundaries found in the text
+        ('content'), between half and twice `fragment_lines` long, so an edit only re-embeds the fragments around it.
+        Search the index with the same setting.
+    :param watch: Keep running and re-index files as they change.
+    :param debounce: Seconds to wait for a burst of changes to settle before re-indexing.
+    :param poll: Poll for changes instead of using inotify.
+    :param rev: Instead, embed every blob in this git revision (or under the given paths in it) that hasn't been
+        embedded before, for `embedit search --rev`. The blobs are read from the object database, so no checkout is
+        needed.
+    :param repo: The git repository for `--rev`.
+    :param root: The directory that paths in exported and imported bundles are relative to.
+    :param verify: Check an imported bundle against its checksums.
+    :param workers: The number of processes that read and split changed files (default: one per CPU, 0 for none).
+    :param verbose: Whether to print verbose output.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
+    """
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if isinstance(include, str):
+        include = (include,)
+    if paths and paths[0] in ("export", "import"):
+        # To index a file called `export` or `import`, pass it as `./export`
+        action, *bundles = paths
+        assert len(bundles) == 1, f"Usage: embedit index {action} BUNDLE"
+        with profile_run(profile):
+            if action == "export":
+                export_index(bundles[0], index_dir=index_dir, root=root)
+            else:
+                import_index(bundles[0], index_dir=index_dir, root=root, verify=verify)
+        return
+    if rev is not None:
+        with profile_run(profile):
+            index_revision(
+                rev,
+                *repo_relative_paths(open_repo(repo), paths),
+                repo_path=repo,
+                include=include,
+                fragment_lines=fragment_lines,
+                min_fragment_lines=min_fragment_lines,
+                mode=mode,
+                chunking=chunking,
             )
+        return
+    assert len(paths) > 0, "No files were provided"
+
+    with profile_run(profile):
+        build_index(
+            *paths,
+            index_dir=index_dir,
+            include=include,
+            fragment_lines=fragment_lines,
+            min_fragment_lines=min_fragment_lines,
+            mode=mode,
+            chunking=chunking,
+            watch=watch,
+            debounce=debounce,
+            poll=poll,
+            workers=workers,
         )
-        console.print()
+
+
+def log_search(
+    query: str,
+    rev: str = "HEAD",
+    repo: str = ".",
+    top_n: Optional[int] = 5,
+    threshold: float = 0.0,
+    kind: Optional[Literal["message", "hunk"]] = None,
+    mode: Literal["openai", "cohere"] = "openai",
+    update: bool = True,
+    verbose: bool = False,
+    profile: Union[bool, str] = False,
+):
+    """
+    Searches the history of a git repository: the message and diff hunks of every commit reachable from a revision.
+    The first run indexes the whole history (in `.git/embedit`); later runs only index the commits made since.
+    :param query: The search query string.
+    :param rev: Index and search the commits reachable from this revision.
+    :param repo: The git repository.
+    :param top_n: The maximum number of results to show.
+    :param threshold: The minimum similarity score a result must have to be shown.
+    :param kind: Only search commit messages ('message') or diff hunks ('hunk').
+    :param mode: The embedding mode to use. Can be 'openai' or 'cohere'.
+    :param update: Index new commits before searching. Pass --noupdate to search the index as it is.
+    :param verbose: Whether to print verbose output.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
+    """
+    if verbose:
+        logger.setLevel(logging.INFO)
+
+    console.print(f"Searching the history of {rev} for '{query}'")
+    with profile_run(profile):
+        results = search_log(
+            query, repo_path=repo, rev=rev, top_n=top_n, threshold=threshold, kind=kind, mode=mode, update=update
+        )
+        with profiler.stage("render", results=len(results)):
+            console.print(f"Found {len(results)} results")
+            for i, result in enumerate(results, start=1):
+                print(center_pad(f"Result {i}", width=80, fillchar="-"))
+                console.print(f"Similarity: {result.similarity:.2f}")
+                console.print(f"Commit: {result.commit[:10]} ({result.kind})")
+                if result.kind == "hunk":
+                    console.print(f"Path: {result.path}")
+                    console.print(Syntax(result.text, "diff", theme="monokai"))
+                else:
+                    console.print(result.text, markup=False, highlight=False)
+                console.print()
+
+
+def serve(
+    socket: Optional[str] = None,
+    port: Optional[int] = None,
+    host: str = search_server.DEFAULT_HOST,
+    token: Optional[str] = None,
+    verbose: bool = False,
+):
+    """
+    Runs a search server that keeps indexes and embeddings in memory between searches. Use `embedit search --server`
+    to send searches to it.
+    :param socket: The Unix socket to listen on. Defaults to $EMBEDIT_SOCKET or a per-user socket in the temp directory.
+    :param port: Listen for HTTP requests on this port instead of on a Unix socket.
+    :param host: The host to listen on when serving HTTP.
+    :param token: The token HTTP requests must send (default: $EMBEDIT_SERVER_TOKEN, or a new random one). It's saved
+        where `embedit search --server http://...` reads it.
+    :param verbose: Whether to print verbose output.
+    """
+    if verbose:
+        logger.setLevel(logging.INFO)
+
+    search_server.serve(socket_path=socket, host=host, port=port, token=token)
 
 
 def transform(
@@ -125,6 +429,10 @@ def transform(
     yes: bool = None,
     model: Optional[str] = None,
     engine: Optional[str] = None,
+    force: bool = False,
+    split_large_files: bool = True,
+    workers: int = 4,
+    profile: Union[bool, str] = False,
 ):
     """
     Transforms text files by passing their markdown representation to the OpenAI API.
@@ -136,19 +444,107 @@ def transform(
     :param yes: Whether to prompt before creating or overwriting files.
     :param model: The OpenAI API model to use.
     :param engine: (Deprecated) The OpenAI API engine to use. Use model instead.
+    :param force: Send every file, even those that haven't changed since they were last transformed into output_dir.
+    :param split_large_files: Transform files too large for one request in segments, and stitch them back together.
+    :param workers: The most segments of a large file to transform at once.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
     :return: Output of the OpenAI API.
     """
     model = resolve_model(model, engine)
 
-    simple_transform_files(
-        *files,
-        prompt=prompt,
-        pre_prompt=pre_prompt,
-        output_dir=output_dir,
-        max_chunk_len=max_chunk_len,
-        yes=yes,
-        model=model,
-    )
+    with profile_run(profile):
+        simple_transform_files(
+            *files,
+            prompt=prompt,
+            pre_prompt=pre_prompt,
+            output_dir=output_dir,
+            max_chunk_len=max_chunk_len,
+            yes=yes,
+            model=model,
+            force=force,
+            split_large_files=split_large_files,
+            workers=workers,
+        )
+
+
+def create(
+    prompt: str,
+    *,
+    pre_prompt: Optional[str] = None,
+    output_dir: str = "out",
+    yes: bool = False,
+    model: str = "gpt-3.5-turbo",
+    plan: bool = False,
+    workers: int = 4,
+    retries: int = DEFAULT_FILE_RETRIES,
+    profile: Union[bool, str] = False,
+):
+    """
+    Creates files from a prompt.
+    :param prompt: What to create.
+    :param pre_prompt: Instructions to send before the prompt.
+    :param output_dir: The directory to write the files to.
+    :param yes: Don't prompt before creating or overwriting files.
+    :param model: The OpenAI API model to use.
+    :param plan: Plan the files and their interfaces first, then generate each file in its own request, concurrently,
+        writing it as soon as it's done. Otherwise every file is written in a single response.
+    :param workers: With plan, the most files to generate at once.
+    :param retries: With plan, the times to ask for a file again if its response can't be used.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
+    :return: The created files, as markdown.
+    """
+    with profile_run(profile):
+        return create_files(
+            prompt,
+            pre_prompt=pre_prompt,
+            output_dir=output_dir,
+            yes=yes,
+            model=model,
+            plan=plan,
+            workers=workers,
+            retries=retries,
+        )
+
+
+def batch(
+    jobs_file: str,
+    output_dir: str = "batch",
+    workers: int = 4,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    segment_workers: int = 4,
+    verbose: bool = False,
+    profile: Union[bool, str] = False,
+):
+    """
+    Runs the transform and create jobs in a JSON lines file, a job per line, e.g.
+    {"id": "docs", "command": "transform", "files": ["src/**/*.py"], "prompt": "Add docstrings"}. Jobs can also set
+    pre_prompt, model and output_dir, and transform jobs max_chunk_len, force and split_large_files.
+
+    Progress is saved in output_dir/status.json, so running the same batch again skips the jobs that finished.
+    :param jobs_file: The JSON lines file of jobs.
+    :param output_dir: The directory for the status file and the outputs of jobs that don't set output_dir.
+    :param workers: The most jobs to run at once.
+    :param requests_per_minute: The most API requests to send per minute, across all jobs.
+    :param tokens_per_minute: The most tokens to send per minute, across all jobs.
+    :param segment_workers: The most segments of a large file to transform at once, within a job.
+    :param verbose: Whether to print verbose output.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
+    """
+    if verbose:
+        logger.setLevel(logging.INFO)
+
+    with profile_run(profile):
+        failed = run_batch(
+            jobs_file,
+            output_dir=output_dir,
+            workers=workers,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            segment_workers=segment_workers,
+        )
+    if failed:
+        sys.exit(1)
 
 
 def commit_msg(
@@ -163,6 +559,7 @@ def commit_msg(
     hint: Optional[str] = None,
     num_lines_context: int = 10,
     verbose: bool = False,
+    profile: Union[bool, str] = False,
 ):
     """
     Creates a commit message from the diff between the current working directory and the specified path.
@@ -177,6 +574,7 @@ def commit_msg(
     :param num_lines_context: The number of lines of context to include in the diff.
     :param hint: A hint to pass in the prompt.
     :param verbose: Print verbose output.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
     :return: A commit message.
     """
     if verbose:
@@ -184,17 +582,18 @@ def commit_msg(
 
     model = resolve_model(model, engine)
 
-    return make_commit_message(
-        path=path,
-        max_log_tokens=max_log_tokens,
-        max_diff_tokens=max_diff_tokens,
-        max_output_tokens=max_output_tokens,
-        model=model,
-        num_examples=num_examples,
-        use_builtin_examples=use_builtin_examples,
-        hint=hint,
-        num_lines_context=num_lines_context,
-    )
+    with profile_run(profile):
+        return make_commit_message(
+            path=path,
+            max_log_tokens=max_log_tokens,
+            max_diff_tokens=max_diff_tokens,
+            max_output_tokens=max_output_tokens,
+            model=model,
+            num_examples=num_examples,
+            use_builtin_examples=use_builtin_examples,
+            hint=hint,
+            num_lines_context=num_lines_context,
+        )
 
 
 def autocommit(
@@ -210,6 +609,7 @@ def autocommit(
     num_lines_context: int = 10,
     verbose: bool = False,
     git_params: dict = {},
+    profile: Union[bool, str] = False,
 ) -> str:
     """
     Creates a commit message from the diff between the current working directory and the specified path, then commits the changes.
@@ -225,6 +625,7 @@ def autocommit(
     :param num_lines_context: The number of lines of context to include in the diff.
     :param verbose: Print verbose output.
     :param git_params: Keyword arguments to pass to the git commit command.
+    :param profile: Print a profile of where the time went, and optionally write it to the given path.
     :return: A commit message.
     """
     if verbose:
@@ -232,17 +633,18 @@ def autocommit(
 
     model = resolve_model(model, engine)
 
-    message = make_commit_message(
-        path=path,
-        max_log_tokens=max_log_tokens,
-        max_diff_tokens=max_diff_tokens,
-        max_output_tokens=max_output_tokens,
-        model=model,
-        num_examples=num_examples,
-        use_builtin_examples=use_builtin_examples,
-        hint=hint,
-        num_lines_context=num_lines_context,
-    )
+    with profile_run(profile):
+        message = make_commit_message(
+            path=path,
+            max_log_tokens=max_log_tokens,
+            max_diff_tokens=max_diff_tokens,
+            max_output_tokens=max_output_tokens,
+            model=model,
+            num_examples=num_examples,
+            use_builtin_examples=use_builtin_examples,
+            hint=hint,
+            num_lines_context=num_lines_context,
+        )
     # Convert keyword arguments back into a reasonable format
     reassembled_args = []
     for key, value in git_params.items():
@@ -254,14 +656,83 @@ def autocommit(
     return message
 
 
+def stub_server(
+    port: int = 8080,
+    host: str = "127.0.0.1",
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    per_token_latency: float = 0.0,
+    requests_per_minute: Optional[float] = None,
+    error_rate: float = 0.0,
+    hang_rate: float = 0.0,
+    dimensions: int = 1536,
+    seed: int = 0,
+    verbose: bool = False,
+):
+    """
+    Runs a local stand-in for the OpenAI and Cohere APIs, with deterministic embeddings and echoing chat completions.
+    Point embedit at it with EMBEDIT_API_BASE=http://127.0.0.1:8080 (and dummy OPENAI_API_KEY/CO_API_KEY values).
+    :param port: The port to listen on.
+    :param host: The host to listen on.
+    :param latency: Mean seconds to wait before answering each request.
+    :param jitter: Standard deviation of the latency, in seconds.
+    :param per_token_latency: Extra seconds per token in the request and response.
+    :param requests_per_minute: Answer 429 to requests beyond this rate.
+    :param error_rate: Fraction of requests to answer with a 500.
+    :param hang_rate: Fraction of requests to never answer.
+    :param dimensions: Size of the returned embeddings.
+    :param seed: Seed for the latency and error injection.
+    :param verbose: Whether to print verbose output.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    config = StubConfig(
+        latency=latency,
+        jitter=jitter,
+        per_token_latency=per_token_latency,
+        requests_per_minute=requests_per_minute,
+        error_rate=error_rate,
+        hang_rate=hang_rate,
+        dimensions=dimensions,
+        seed=seed,
+    )
+    server = make_stub_server(config, host=host, port=port)
+    logger.warning(f"Stub API listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def tokenizer_data(source: Optional[str] = None, encodings: Union[str, tuple[str, ...]] = (DEFAULT_ENCODING,)):
+    """
+    Fetches the tokenisers' data ahead of time, so that embedit doesn't need network access to count tokens.
+    :param source: A directory with copies of the `<encoding>.tiktoken` files to install, instead of downloading them.
+    :param encodings: The encodings to install.
+    """
+    if isinstance(encodings, str):
+        encodings = tuple(encodings.split(","))
+    for path in seed_tokenizer_data(source, encodings):
+        logger.warning(f"Installed {path}")
+
+
 def main():
     fire.Fire(
         {
             "search"    : search,
+            "index"     : index,
+            "log-search": log_search,
+            "serve"     : serve,
             "transform" : transform,
             "create"    : create,
+            "batch"     : batch,
             "commit-msg": commit_msg,
             "autocommit": autocommit,
+            "stub-server": stub_server,
+            "tokenizer-data": tokenizer_data,
         }
     )
 
@@ -0,0 +1,179 @@
+import mmap
+from pathlib import Path
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+import numpy as np
+from attrs import define
+
+from .embedding import EmbeddedTextFileFragment
+from .embedding import EmbeddedTextFileFragmentSimilarityResult
+from .text_file import TextFileFragment
+
+Buffer = Union[bytes, mmap.mmap]
+
+
+@define
+class FragmentTable:
+    """
+    Columnar storage for text file fragments.
+
+    Rows don't hold copies of their text. Each row stores the id of the file it came from, byte offsets into that file's
+    buffer, its (inclusive) line range and the row of its embedding in `embeddings` (-1 if it hasn't been embedded).
+    Text is only decoded when it's asked for, and the attrs classes in `text_file` and `embedding` are built on demand
+    as views over a single row.
+    """
+
+    paths: list[Path]
+    buffers: list[Buffer]
+    path_ids: np.ndarray
+    byte_starts: np.ndarray
+    byte_ends: np.ndarray
+    start_lines: np.ndarray
+    end_lines: np.ndarray
+    embedding_rows: np.ndarray
+    embeddings: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_columns(
+        cls,
+        paths: list[Path],
+        buffers: list[Buffer],
+        path_ids: Sequence[int],
+        byte_starts: Sequence[int],
+        byte_ends: Sequence[int],
+        start_lines: Sequence[int],
+        end_lines: Sequence[int],
+    ) -> "FragmentTable":
+        return cls(
+            paths=paths,
+            buffers=buffers,
+            path_ids=np.asarray(path_ids, dtype=np.int32),
+            byte_starts=np.asarray(byte_starts, dtype=np.int64),
+            byte_ends=np.asarray(byte_ends, dtype=np.int64),
+            start_lines=np.asarray(start_lines, dtype=np.int32),
+            end_lines=np.asarray(end_lines, dtype=np.int32),
+            embedding_rows=np.full(len(path_ids), -1, dtype=np.int64),
+        )
+
+    @classmethod
+    def concat(cls, tables: Sequence["FragmentTable"]) -> "FragmentTable":
+        """
+        Concatenate tables. If any table is embedded, every non-empty table must be, and the result holds one stacked
+        embeddings matrix.
+        """
+        path_id_offsets = np.cumsum([0] + [len(table.paths) for table in tables])
+        embedded = [table for table in tables if len(table) and table.embeddings is not None]
+        if embedded:
+            embeddings = np.concatenate([table.embedding_matrix() for table in tables if len(table)])
+            embedding_rows = np.arange(len(embeddings), dtype=np.int64)
+        else:
+            embeddings = None
+            embedding_rows = np.full(sum(len(table) for table in tables), -1, dtype=np.int64)
+
+        def concat(arrays: list[np.ndarray], dtype) -> np.ndarray:
+            return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.empty(0, dtype=dtype)
+
+        return cls(
+            paths=[path for table in tables for path in table.paths],
+            buffers=[buffer for table in tables for buffer in table.buffers],
+            path_ids=concat([table.path_ids + offset for table, offset in zip(tables, path_id_offsets)], np.int32),
+            byte_starts=concat([table.byte_starts for table in tables], np.int64),
+            byte_ends=concat([table.byte_ends for table in tables], np.int64),
+            start_lines=concat([table.start_lines for table in tables], np.int32),
+            end_lines=concat([table.end_lines for table in tables], np.int32),
+            embedding_rows=embedding_rows,
+            embeddings=embeddings,
+        )
+
+    def __len__(self) -> int:
+        return len(self.path_ids)
+
+    @property
+    def line_counts(self) -> np.ndarray:
+        return self.end_lines - self.start_lines + 1
+
+    def text(self, i: int) -> str:
+        """
+        Decode the text of row `i` from its file buffer.
+        """
+        buffer = self.buffers[self.path_ids[i]]
+        text = bytes(buffer[self.byte_starts[i]: self.byte_ends[i]]).decode("utf-8", errors="replace")
+        # Normalise line endings the same way `str.splitlines` would
+        if "\r" in text:
+            text = "\n".join(text.splitlines())
+        return text
+
+    def texts(self, indices: Optional[Sequence[int]] = None) -> list[str]:
+        if indices is None:
+            indices = range(len(self))
+        return [self.text(i) for i in indices]
+
+    def select(self, indices: Union[Sequence[int], np.ndarray]) -> "FragmentTable":
+        """
+        Return a table holding only the given rows (or the rows where a boolean mask is set). Paths, buffers and
+        embeddings are shared, not copied.
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        return FragmentTable(
+            paths=self.paths,
+            buffers=self.buffers,
+            path_ids=self.path_ids[indices],
+            byte_starts=self.byte_starts[indices],
+            byte_ends=self.byte_ends[indices],
+            start_lines=self.start_lines[indices],
+            end_lines=self.end_lines[indices],
+            embedding_rows=self.embedding_rows[indices],
+            embeddings=self.embeddings,
+        )
+
+    def with_embeddings(self, embeddings: np.ndarray) -> "FragmentTable":
+        """
+        Return a table whose rows point, in order, at the rows of the given embeddings matrix.
+        """
+        assert len(embeddings) == len(self), "Need exactly one embedding per row"
+        return FragmentTable(
+            paths=self.paths,
+            buffers=self.buffers,
+            path_ids=self.path_ids,
+            byte_starts=self.byte_starts,
+            byte_ends=self.byte_ends,
+            start_lines=self.start_lines,
+            end_lines=self.end_lines,
+            embedding_rows=np.arange(len(self), dtype=np.int64),
+            embeddings=embeddings,
+        )
+
+    def embedding(self, i: int) -> np.ndarray:
+        row = self.embedding_rows[i]
+        if self.embeddings is None or row < 0:
+            raise ValueError(f"Row {i} has not been embedded")
+        return self.embeddings[row]
+
+    def embedding_matrix(self) -> np.ndarray:
+        """
+        Return the embeddings of every row, in row order.
+        """
+        if self.embeddings is None or (self.embedding_rows < 0).any():
+            raise ValueError("Not every row has been embedded")
+        rows = self.embedding_rows
+        if len(rows) == len(self.embeddings) and (rows == np.arange(len(rows))).all():
+            # Rows are in embedding order already, so avoid the copy
+            return self.embeddings
+        return self.embeddings[rows]
+
+    def fragment(self, i: int) -> TextFileFragment:
+        return TextFileFragment(
+            path=self.paths[self.path_ids[i]], contents=self.text(i), start_line=int(self.start_lines[i])
+        )
+
+    def embedded_fragment(self, i: int) -> EmbeddedTextFileFragment:
+        return EmbeddedTextFileFragment(fragment=self.fragment(i), embedding=self.embedding(i).tolist())
+
+    def similarity_result(self, i: int, similarity: float) -> EmbeddedTextFileFragmentSimilarityResult:
+        return EmbeddedTextFileFragmentSimilarityResult(
+            embedded_fragment=self.embedded_fragment(i), similarity=float(similarity)
+        )
@@ -0,0 +1,58 @@
+"""
+Running embedit's coroutines from synchronous code.
+
+The sync API (`complete`, `get_embeddings`, `semantic_search`, ...) is a thin wrapper around the async one: `run_sync`
+hands the coroutine to an event loop on a background thread and waits for it. There's one such loop per process, shared
+by every thread, so sync callers share its HTTP connection pool too, and it works whether or not the calling thread has
+an event loop of its own. Context variables (e.g. `track_usage`) are copied to the coroutine.
+"""
+import asyncio
+import os
+import threading
+from typing import Awaitable
+from typing import Optional
+from typing import TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    The background event loop that sync calls run on, started on first use (and again in a forked process).
+    """
+    global _loop, _loop_pid, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid() or not _loop_thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _loop_thread = threading.Thread(target=_run_loop, args=(_loop,), name="embedit-aio", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coroutine: Awaitable[T]) -> T:
+    """
+    Run the coroutine on the background event loop and return its result, blocking the calling thread until then.
+    """
+    loop = get_loop()
+    if threading.current_thread() is _loop_thread:
+        coroutine.close()
+        raise RuntimeError("Can't wait for a coroutine on the event loop that runs it. Await it instead.")
+    # The loop starts the coroutine in a copy of this thread's context
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # E.g. KeyboardInterrupt while waiting: don't leave the coroutine running
+        future.cancel()
+        raise
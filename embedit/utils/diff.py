@@ -1,6 +1,10 @@
 import difflib
-from typing import NamedTuple, Optional
+from bisect import bisect_left
+from collections import Counter
+from typing import Iterator, NamedTuple, Optional, Sequence
 
+from attrs import define
+from attrs import field
 from rich.console import Group, Console
 from rich.panel import Panel
 from rich.syntax import Syntax
@@ -12,6 +16,15 @@ console = Console()
 
 DEFAULT_INDENT_WIDTH = 4
 
+# Backgrounds of added and removed lines, and of the changed characters within them
+ADDED = Style(bgcolor="rgb(0,90,0)")
+ADDED_EMPHASIS = Style(bgcolor="rgb(0,140,0)")
+REMOVED = Style(bgcolor="rgb(90,0,0)")
+REMOVED_EMPHASIS = Style(bgcolor="rgb(140,0,0)")
+# Lines to lex before each highlighted range of a diff, to pick up state such as being inside a multi-line string
+LEXER_LOOKBACK = 200
+
+
 def remove_background_color(text: Text) -> Text:
     """
     Remove the background color from a Text object.
@@ -63,7 +76,284 @@ def indent(text: Text, prefix: str) -> Text:
     return Text(textwrap.indent(text.plain, prefix), spans=text.spans, style=text.style)
 
 
-def pretty_diff(a: str, b: str, context: Optional[int] = 3, syntax: str = "python"):
+class DiffStats(NamedTuple):
+    """
+    A named tuple containing the statistics of a diff.
+    """
+
+    added: int
+    removed: int
+
+
+# A region without any lines unique to both sides is searched for a shortest edit script only up to this many edits,
+# beyond which it's treated as one replaced block (heavily rewritten files would otherwise take quadratic time)
+MAX_EDIT_COST = 200
+# Replaced blocks with more characters than this are shown without character-level (intraline) detail
+INTRALINE_MAX_CHARS = 10_000
+
+
+class Opcode(NamedTuple):
+    """
+    A block of a diff, as in `difflib.SequenceMatcher.get_opcodes`: lines a[a_start:a_end] are `tag`ged ("equal",
+    "replace", "delete" or "insert") as lines b[b_start:b_end].
+    """
+
+    tag: str
+    a_start: int
+    a_end: int
+    b_start: int
+    b_end: int
+
+
+def _unique_matches(a: list[int], b: list[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> list[tuple[int, int]]:
+    """
+    Patience diff's anchors: the longest run of lines that occur exactly once in both ranges and in the same order.
+    """
+    a_counts = Counter(a[a_lo:a_hi])
+    b_counts = Counter(b[b_lo:b_hi])
+    b_positions = {b[j]: j for j in range(b_lo, b_hi) if b_counts[b[j]] == 1}
+    candidates = [(i, b_positions[a[i]]) for i in range(a_lo, a_hi) if a_counts[a[i]] == 1 and a[i] in b_positions]
+    # Longest increasing subsequence of the b positions, by patience sorting
+    pile_tops: list[int] = []
+    pile_top_indices: list[int] = []
+    previous = [-1] * len(candidates)
+    for k, (_, j) in enumerate(candidates):
+        pile = bisect_left(pile_tops, j)
+        if pile == len(pile_tops):
+            pile_tops.append(j)
+            pile_top_indices.append(k)
+        else:
+            pile_tops[pile] = j
+            pile_top_indices[pile] = k
+        previous[k] = pile_top_indices[pile - 1] if pile else -1
+    anchors = []
+    k = pile_top_indices[-1] if pile_top_indices else -1
+    while k >= 0:
+        anchors.append(candidates[k])
+        k = previous[k]
+    return anchors[::-1]
+
+
+def _myers_matches(
+    a: list[int], b: list[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int, max_cost: int
+) -> Optional[list[tuple[int, int]]]:
+    """
+    The matching lines of a shortest edit script between the ranges (Myers' O(ND) algorithm), or None if it takes
+    more than `max_cost` edits.
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    max_cost = min(max_cost, n + m)
+    offset = max_cost + 1
+    # v[offset + k] is the furthest x reached on diagonal k = x - y
+    v = [0] * (2 * max_cost + 3)
+    trace = []
+    for d in range(max_cost + 1):
+        trace.append(v[:])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+    # Walk back through the trace, collecting the diagonal (matching) moves
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = v[offset + previous_k]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((a_lo + x, b_lo + y))
+        x, y = previous_x, previous_y
+    return matches
+
+
+def _opcodes(matches: list[tuple[int, int]], n: int, m: int) -> list[Opcode]:
+    opcodes: list[Opcode] = []
+    i = j = 0
+    for match_i, match_j in [*matches, (n, m)]:
+        if i < match_i or j < match_j:
+            tag = "replace" if i < match_i and j < match_j else "delete" if i < match_i else "insert"
+            opcodes.append(Opcode(tag, i, match_i, j, match_j))
+        if match_i == n and match_j == m:
+            break
+        last = opcodes[-1] if opcodes else None
+        if last is not None and last.tag == "equal" and last.a_end == match_i and last.b_end == match_j:
+            opcodes[-1] = last._replace(a_end=match_i + 1, b_end=match_j + 1)
+        else:
+            opcodes.append(Opcode("equal", match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return opcodes
+
+
+def diff_lines(a: list[str], b: list[str], *, max_edit_cost: int = MAX_EDIT_COST) -> list[Opcode]:
+    """
+    Diff two lists of lines with patience diff, falling back to a bounded Myers diff between anchors.
+
+    :param a: The old lines.
+    :param b: The new lines.
+    :param max_edit_cost: The most edits to search for in a region without anchors before treating it as replaced.
+    :return: The opcodes of the diff.
+    """
+    # Compare lines by interned id rather than by string
+    ids: dict[str, int] = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+        # Match the common prefix and suffix
+        while a_lo < a_hi and b_lo < b_hi and a_ids[a_lo] == b_ids[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a_ids[a_hi - 1] == b_ids[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            matches.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        anchors = _unique_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi)
+        if anchors:
+            # Diff the regions between the anchors
+            matches.extend(anchors)
+            bounds = [(a_lo - 1, b_lo - 1), *anchors, (a_hi, b_hi)]
+            for (i0, j0), (i1, j1) in zip(bounds, bounds[1:]):
+                if i0 + 1 < i1 or j0 + 1 < j1:
+                    regions.append((i0 + 1, i1, j0 + 1, j1))
+        else:
+            matches.extend(_myers_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, max_edit_cost) or [])
+    matches.sort()
+    return _opcodes(matches, len(a), len(b))
+
+
+@define
+class Diff:
+    """
+    A line-level diff of two texts. Compute it once with `compute_diff` and share it between `pretty_diff` and
+    `get_diff_stats`.
+    """
+
+    a_lines: list[str]
+    b_lines: list[str]
+    opcodes: list[Opcode]
+    intraline_max_chars: int = INTRALINE_MAX_CHARS
+    _intraline: dict[Opcode, tuple[dict, dict]] = field(factory=dict, repr=False)
+
+    @property
+    def stats(self) -> DiffStats:
+        added = sum(op.b_end - op.b_start for op in self.opcodes if op.tag in ("replace", "insert"))
+        removed = sum(op.a_end - op.a_start for op in self.opcodes if op.tag in ("replace", "delete"))
+        return DiffStats(added=added, removed=removed)
+
+    def lines(self, opcodes: Optional[list[Opcode]] = None) -> Iterator[tuple[str, Optional[int], Optional[int]]]:
+        """
+        Yield the lines of the diff as (tag, index in a, index in b), where the tag is "+", "-" or " " and the index
+        is None for the side the line isn't on. Removed lines come before the lines that replace them.
+        """
+        for op in self.opcodes if opcodes is None else opcodes:
+            if op.tag == "equal":
+                for i, j in zip(range(op.a_start, op.a_end), range(op.b_start, op.b_end)):
+                    yield " ", i, j
+                continue
+            for i in range(op.a_start, op.a_end):
+                yield "-", i, None
+            for j in range(op.b_start, op.b_end):
+                yield "+", None, j
+
+    def hunks(self, context: Optional[int] = 3) -> list[list[Opcode]]:
+        """
+        Group the opcodes into hunks: runs of changes with (up to) `context` lines of unchanged lines around them, split
+        where more than twice that many lines are unchanged. With `context=None`, everything is one hunk.
+        """
+        if context is None:
+            return [self.opcodes] if self.opcodes else []
+        hunks = []
+        hunk: list[Opcode] = []
+        for op in self.opcodes:
+            if op.tag != "equal":
+                hunk.append(op)
+                continue
+            size = op.a_end - op.a_start
+            if hunk and size <= 2 * context and op is not self.opcodes[-1]:
+                # Close enough to the next change to keep in this hunk
+                hunk.append(op)
+                continue
+            n = min(size, context)
+            if hunk:
+                # Close the hunk with the first lines of this run
+                if n:
+                    hunk.append(op._replace(a_end=op.a_start + n, b_end=op.b_start + n))
+                hunks.append(hunk)
+            # Start the next hunk with the last lines of this run
+            hunk = [op._replace(a_start=op.a_end - n, b_start=op.b_end - n)] if n else []
+        if any(op.tag != "equal" for op in hunk):
+            hunks.append(hunk)
+        return hunks
+
+    def intraline(self, op: Opcode) -> tuple[dict[int, list[tuple[int, int]]], dict[int, list[tuple[int, int]]]]:
+        """
+        Return the changed character ranges within the lines of an opcode, if it's a replaced block of at most
+        `intraline_max_chars` characters, as dicts from line index (in a and in b) to ranges. Removed and added lines
+        are paired up in order, and only pairs that are mostly alike are compared.
+        """
+        if op in self._intraline:
+            return self._intraline[op]
+        a_changes: dict[int, list[tuple[int, int]]] = {}
+        b_changes: dict[int, list[tuple[int, int]]] = {}
+        a_block = self.a_lines[op.a_start:op.a_end]
+        b_block = self.b_lines[op.b_start:op.b_end]
+        size = sum(map(len, a_block)) + sum(map(len, b_block))
+        if op.tag == "replace" and size <= self.intraline_max_chars:
+            for i, j, a_line, b_line in zip(
+                range(op.a_start, op.a_end), range(op.b_start, op.b_end), a_block, b_block
+            ):
+                matcher = difflib.SequenceMatcher(None, a_line, b_line)
+                if matcher.real_quick_ratio() < 0.5 or matcher.quick_ratio() < 0.5 or matcher.ratio() < 0.5:
+                    continue
+                for tag, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+                    if tag in ("replace", "delete"):
+                        a_changes.setdefault(i, []).append((a_start, a_end))
+                    if tag in ("replace", "insert"):
+                        b_changes.setdefault(j, []).append((b_start, b_end))
+        self._intraline[op] = (a_changes, b_changes)
+        return a_changes, b_changes
+
+
+def compute_diff(a: str, b: str, *, intraline_max_chars: int = INTRALINE_MAX_CHARS) -> Diff:
+    """
+    Diff two strings line by line.
+
+    :param a: The first string to diff.
+    :param b: The second string to diff.
+    :param intraline_max_chars: The largest replaced block to compute character-level changes for.
+    :return: The diff.
+    """
+    a_lines = a.splitlines()
+    b_lines = b.splitlines()
+    return Diff(a_lines, b_lines, diff_lines(a_lines, b_lines), intraline_max_chars=intraline_max_chars)
+
+
+def pretty_diff(a: str, b: str, context: Optional[int] = 3, syntax: str = "python", *, diff: Optional[Diff] = None):
     """
     Pretty print a diff.
 
@@ -71,88 +361,106 @@ def pretty_diff(a: str, b: str, context: Optional[int] = 3, syntax: str = "pytho
     :param b: The second string to diff.
     :param context: The number of lines of context to show around each change.
     :param syntax: The syntax to highlight the diff with.
+    :param diff: The diff of the strings, if it's already been computed.
     :return: A pretty printed diff.
     """
-    # To get proper syntax highlighting, we need to render each string separately, combine them, and split into the
-    # intervals above. Render the texts separately with syntax highlighting.
-    theme = "github-dark"
-    a_with_syntax = Syntax(a, syntax, theme=theme)
-    b_with_syntax = Syntax(b, syntax, theme=theme)
-    # Just get the highlighted text
-    a_pretty_lines = a_with_syntax.highlight(a_with_syntax.code)
-    b_pretty_lines = b_with_syntax.highlight(b_with_syntax.code)
-    # Add line numbers to b (which we lost when we highlighted the text 🤦🏻‍). Indent a so that it lines up with b.
-    a_pretty_lines = indent(a_pretty_lines, " " * DEFAULT_INDENT_WIDTH)
-    b_pretty_lines = add_line_numbers(b_pretty_lines)
-    # Remove the background color from the texts
-    a_pretty_lines = remove_background_color(a_pretty_lines)
-    b_pretty_lines = remove_background_color(b_pretty_lines)
-    # Split into lines
-    a_pretty_lines = a_pretty_lines.split("\n")
-    b_pretty_lines = b_pretty_lines.split("\n")
-    # Splice the strings together
-    a_pretty_lines_iter = iter(a_pretty_lines)
-    b_pretty_lines_iter = iter(b_pretty_lines)
-    diff = []
-    difflines = list(difflib.Differ().compare(a.splitlines(), b.splitlines()))
-    for line in difflines:
-        try:
-            if line.startswith("+"):
-                b_line = next(b_pretty_lines_iter)
-                diff.append(Text(b_line.plain, spans=b_line.spans, style=Style(bgcolor="rgb(0,90,0)"), justify="left"))
-            elif line.startswith("-"):
-                a_line = next(a_pretty_lines_iter)
-                diff.append(Text(a_line.plain, spans=a_line.spans, style=Style(bgcolor="rgb(90,0,0)"), justify="left"))
-            elif line.startswith("  "):
-                next(a_pretty_lines_iter)
-                b_line = next(b_pretty_lines_iter)
-                diff.append(Text(b_line.plain, spans=b_line.spans))
-        except StopIteration:
-            pass
+    if diff is None:
+        diff = compute_diff(a, b)
+    # Work out what will be shown first, and only highlight those lines, so that the cost follows the size of the diff
+    # rather than of the files
+    hunks = diff.hunks(context)
+    a_pretty_lines = _highlight_ranges(
+        diff.a_lines, [(hunk[0].a_start, hunk[-1].a_end) for hunk in hunks], syntax, line_numbers=False
+    )
+    b_pretty_lines = _highlight_ranges(
+        diff.b_lines, [(hunk[0].b_start, hunk[-1].b_end) for hunk in hunks], syntax, line_numbers=True
+    )
+    rendered_hunks = []
+    for hunk in hunks:
+        # Character-level changes within replaced lines, where the blocks are small enough
+        a_changes: dict[int, list[tuple[int, int]]] = {}
+        b_changes: dict[int, list[tuple[int, int]]] = {}
+        for op in hunk:
+            if op.tag == "replace":
+                a_block_changes, b_block_changes = diff.intraline(op)
+                a_changes.update(a_block_changes)
+                b_changes.update(b_block_changes)
+        # Splice the strings together
+        rendered = []
+        for tag, i, j in diff.lines(hunk):
+            if tag == "+":
+                rendered.append(_changed_line(b_pretty_lines[j], b_changes.get(j, ()), ADDED, ADDED_EMPHASIS))
+            elif tag == "-":
+                rendered.append(_changed_line(a_pretty_lines[i], a_changes.get(i, ()), REMOVED, REMOVED_EMPHASIS))
+            else:
+                b_line = b_pretty_lines[j]
+                rendered.append(Text(b_line.plain, spans=b_line.spans))
+        rendered_hunks.append(rendered)
     if context is None:
-        return Group(*diff)
-    else:
-        # Compute the in-context lines
-        intervals = []
-        for i, line in enumerate(difflines):
-            if line.startswith("+") or line.startswith("-"):
-                if intervals and intervals[-1][1] >= i - context:
-                    # Extend the previous interval
-                    intervals[-1] = (intervals[-1][0], min(i + context, len(diff)))
-                else:
-                    # Start a new interval
-                    intervals.append((max(0, i - context), min(i + context, len(diff))))
-        # Split the diff into chunks and render them as panels
-        diff_chunks = [
-            Panel(Group(*diff[start:end+1]), title=f"{start+1}-{end}")
-            for start, end in intervals
-        ]
-        return Group(*diff_chunks)
+        return Group(*(line for rendered in rendered_hunks for line in rendered))
+    # Render the hunks as panels, titled with the lines of b they cover
+    return Group(
+        *(
+            Panel(Group(*rendered), title=f"{hunk[0].b_start + 1}-{hunk[-1].b_end}")
+            for hunk, rendered in zip(hunks, rendered_hunks)
+        )
+    )
 
 
-class DiffStats(NamedTuple):
+def _highlight_ranges(
+    lines: list[str], ranges: list[tuple[int, int]], syntax: str, *, line_numbers: bool, theme: str = "github-dark"
+) -> dict[int, Text]:
     """
-    A named tuple containing the statistics of a diff.
+    Syntax highlight the given ranges of lines, adding line numbers or the equivalent indent.
+
+    Each range is lexed from up to `LEXER_LOOKBACK` lines earlier, so that constructs that span lines (e.g. strings)
+    are highlighted as they would be in the whole file; ranges whose look-backs overlap are highlighted together.
+
+    :return: The highlighted lines, by index.
     """
+    windows: list[list[int]] = []
+    for start, end in sorted(ranges):
+        lexer_start = max(0, start - LEXER_LOOKBACK)
+        if windows and lexer_start <= windows[-1][2]:
+            windows[-1][2] = max(windows[-1][2], end)
+        else:
+            windows.append([lexer_start, start, end])
+    pretty_lines = {}
+    for lexer_start, start, end in windows:
+        with_syntax = Syntax("\n".join(lines[lexer_start:end]), syntax, theme=theme)
+        # Only style the lines we need. The lines before are only there to get the lexer into the right state.
+        line_range = (start - lexer_start + 1, end - lexer_start) if start > lexer_start else None
+        highlighted = with_syntax.highlight(with_syntax.code, line_range=line_range)
+        window_lines = remove_background_color(highlighted).split("\n")[start - lexer_start:end - lexer_start]
+        # The highlighter drops trailing blank lines
+        window_lines += [Text("")] * (end - start - len(window_lines))
+        for i, line in enumerate(window_lines, start=start):
+            # Prefix each line on its own, which keeps its spans in place
+            if line_numbers:
+                prefix = Text(f"{i + 1:>{DEFAULT_INDENT_WIDTH - 1}} ", style="dim")
+            else:
+                prefix = Text(" " * DEFAULT_INDENT_WIDTH)
+            pretty_lines[i] = prefix + line
+    return pretty_lines
 
-    added: int
-    removed: int
+
+def _changed_line(line: Text, changes: Sequence[tuple[int, int]], style: Style, emphasis: Style) -> Text:
+    text = Text(line.plain, spans=line.spans, style=style, justify="left")
+    # The highlighted lines start with a line number or the equivalent indent
+    for start, end in changes:
+        text.stylize(emphasis, DEFAULT_INDENT_WIDTH + start, DEFAULT_INDENT_WIDTH + end)
+    return text
 
 
-def get_diff_stats(a: str, b: str) -> DiffStats:
+def get_diff_stats(a: str, b: str, *, diff: Optional[Diff] = None) -> DiffStats:
     """
     Get the statistics of a diff.
 
     :param a: The first string to diff.
     :param b: The second string to diff.
+    :param diff: The diff of the strings, if it's already been computed.
     :return: A named tuple containing the statistics of the diff.
     """
-    difflines = list(difflib.Differ().compare(a.splitlines(), b.splitlines()))
-    added = 0
-    removed = 0
-    for line in difflines:
-        if line.startswith("+"):
-            added += 1
-        elif line.startswith("-"):
-            removed += 1
-    return DiffStats(added=added, removed=removed)
+    if diff is None:
+        diff = compute_diff(a, b)
+    return diff.stats
@@ -0,0 +1,211 @@
+"""
+Lightweight, opt-in instrumentation: timed stages, counters and latency histograms.
+
+Everything goes through the global `profiler`, which does nothing until it's enabled (e.g. by `--profile`).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import Union
+
+import numpy as np
+from attrs import define
+from attrs import field
+from rich.console import Console
+from rich.table import Table
+
+
+@define
+class StageStats:
+    calls: int = 0
+    durations: list[float] = field(factory=list)
+    counts: dict[str, float] = field(factory=dict)
+
+    @property
+    def total(self) -> float:
+        return sum(self.durations)
+
+
+class Stage:
+    """
+    A handle on a running stage, for attaching counts (e.g. bytes or tokens) to it.
+    """
+
+    def __init__(self):
+        self.counts: dict[str, float] = {}
+
+    def add(self, key: str, value: float = 1):
+        self.counts[key] = self.counts.get(key, 0) + value
+
+
+class _NullStage(Stage):
+    def add(self, key: str, value: float = 1):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+def percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def histogram(values: list[float]) -> dict[str, int]:
+    """
+    Bucket durations (in seconds) by powers of two of milliseconds.
+    """
+    buckets: dict[str, int] = {}
+    for value in sorted(values):
+        upper = 2 ** max(0, int(np.ceil(np.log2(max(value * 1000, 1)))))
+        key = f"<={upper}ms"
+        buckets[key] = buckets.get(key, 0) + 1
+    return buckets
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages: dict[str, StageStats] = {}
+            self.counters: dict[str, float] = {}
+            self.events: list[dict] = []
+            self.origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, **counts: float) -> Iterator[Stage]:
+        """
+        Time a stage of work. Counts given here or added to the yielded stage are summed per stage name.
+        """
+        if not self.enabled:
+            yield _null_stage
+            return
+        stage = Stage()
+        for key, value in counts.items():
+            stage.add(key, value)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.durations.append(duration)
+                for key, value in stage.counts.items():
+                    stats.counts[key] = stats.counts.get(key, 0) + value
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.origin) * 1e6,
+                        "dur": duration * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": stage.counts,
+                    }
+                )
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {
+                    name: {
+                        "calls": stats.calls,
+                        "total_s": stats.total,
+                        "p50_s": percentile(stats.durations, 50),
+                        "p99_s": percentile(stats.durations, 99),
+                        "max_s": max(stats.durations),
+                        "histogram": histogram(stats.durations),
+                        "counts": stats.counts,
+                    }
+                    for name, stats in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def to_chrome_trace(self) -> dict:
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def summary(self) -> Table:
+        table = Table(title="Profile")
+        for column in ["Stage", "Calls", "Total (s)", "p50 (ms)", "p99 (ms)", "Counts"]:
+            table.add_column(column, justify="left" if column in ("Stage", "Counts") else "right")
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1].total, reverse=True)
+            for name, stats in stages:
+                table.add_row(
+                    name,
+                    str(stats.calls),
+                    f"{stats.total:.3f}",
+                    f"{percentile(stats.durations, 50) * 1000:.1f}",
+                    f"{percentile(stats.durations, 99) * 1000:.1f}",
+                    ", ".join(f"{key}={value:g}" for key, value in sorted(stats.counts.items())),
+                )
+            for name, value in sorted(self.counters.items()):
+                table.add_row(name, "", "", "", "", f"{value:g}")
+        return table
+
+    def write(self, path: str):
+        """
+        Write the profile to a file: a Chrome trace (viewable in chrome://tracing or Perfetto) if the path ends in
+        `.trace` or `.trace.json`, and a JSON summary otherwise.
+        """
+        data = self.to_chrome_trace() if path.endswith((".trace", ".trace.json")) else self.to_json()
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+profiler = Profiler()
+
+
+def profiled(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorate a function so that each call is timed as a stage.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs) -> Any:
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profile_run(profile: Union[bool, str, None]) -> Iterator[None]:
+    """
+    Enable the profiler for the duration of a command if `profile` is set, then print a summary (to stderr) and, if
+    `profile` is a path, write the profile there.
+    """
+    if not profile:
+        yield
+        return
+    profiler.reset()
+    profiler.enabled = True
+    try:
+        yield
+    finally:
+        profiler.enabled = False
+        Console(stderr=True).print(profiler.summary())
+        if isinstance(profile, str):
+            profiler.write(profile)
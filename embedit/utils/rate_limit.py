@@ -0,0 +1,311 @@
+"""
+Client-side rate limiting: token buckets for requests and tokens per minute, per API key and model, shared by every
+thread and every embedit process on the machine.
+
+The buckets live in a small JSON file (`RATE_LIMIT_FILE`, by default per user in the temp directory), read and updated
+under an exclusive file lock, so that parallel processes (e.g. CI jobs sharing an API key) draw from the same budget
+instead of each retrying on its own after 429s. API calls take their budget with `acquire` (or `aacquire`, from async
+code) just before each attempt, so cached responses don't count.
+
+Only what's learned from the provider is shared: `observe` learns the limits and remaining budget from the
+`x-ratelimit-*` headers of responses, and a 429's `Retry-After` pauses the bucket for every process. Limits set with
+`configure` (e.g. `embedit batch --requests-per-minute`) or EMBEDIT_REQUESTS_PER_MINUTE and EMBEDIT_TOKENS_PER_MINUTE
+apply to the process that set them, in buckets of its own in memory, so they don't outlive it. Buckets with no known
+limit don't hold anything up.
+"""
+import asyncio
+import getpass
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+from typing import Mapping
+from typing import Optional
+
+from attrs import define
+from attrs import field
+
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are only shared between threads
+    fcntl = None
+
+# Set EMBEDIT_RATE_LIMIT_FILE to "off" to only share buckets between the threads of a process
+RATE_LIMIT_FILE = os.environ.get(
+    "EMBEDIT_RATE_LIMIT_FILE", str(Path(tempfile.gettempdir()) / f"embedit-ratelimit-{getpass.getuser()}.json")
+)
+# The longest to sleep before checking the buckets again, so that budget freed by other processes is noticed
+MAX_SLEEP = 1.0
+# Providers enforce their per-minute limits over shorter windows too, so a bucket holds only this many seconds' worth of
+# budget, and calls are spread out instead of a minute's worth going at once
+BURST_SECONDS = 1.0
+KINDS = ("requests", "tokens")
+# Bumped whenever what the file holds changes, so that older processes' buckets are ignored
+STATE_FORMAT = 2
+
+
+def _env_rate(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parse a reset duration from rate-limit headers, e.g. "1s", "6m0s", "250ms" or plain seconds, into seconds.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    number = ""
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    i = 0
+    while i < len(value):
+        if value[i].isdigit() or value[i] == ".":
+            number += value[i]
+            i += 1
+            continue
+        unit = "ms" if value.startswith("ms", i) else value[i]
+        if unit not in units or not number:
+            return None
+        seconds += float(number) * units[unit]
+        number = ""
+        i += len(unit)
+    return seconds if not number else None
+
+
+def key_id(api_key: Optional[str]) -> str:
+    # Buckets are per key, without writing the key itself to disk
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+
+
+def capacity(bucket: dict) -> float:
+    # BURST_SECONDS' worth of the limit, but room for the largest request seen, so that it needn't leave the bucket in
+    # debt (unless it's over a minute's worth)
+    limit = bucket["limit"]
+    return max(limit * BURST_SECONDS / 60, 1.0, min(bucket.get("largest", 0.0), limit))
+
+
+def refill(bucket: dict, now: float):
+    if bucket.get("limit") is not None:
+        elapsed = max(0.0, now - bucket.get("updated", now))
+        bucket["available"] = min(
+            capacity(bucket), bucket.get("available", capacity(bucket)) + elapsed * bucket["limit"] / 60
+        )
+    bucket["updated"] = now
+
+
+@define
+class Governor:
+    path: Optional[Path]
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    # The shared buckets, when they aren't kept in a file
+    _state: dict[str, dict] = field(factory=dict)
+    # The buckets of the configured limits, which are this process's alone
+    _configured: dict[str, dict] = field(factory=dict)
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    @contextmanager
+    def buckets(self) -> Iterator[dict[str, dict]]:
+        """
+        Lock the buckets for reading and updating, across threads and (if there's a file) processes.
+        """
+        with self._lock:
+            if self.path is None or fcntl is None:
+                yield self._state
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path.with_name(self.path.name + ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    try:
+                        state = json.loads(self.path.read_text())
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        state = {}
+                    if state.get("format") != STATE_FORMAT:
+                        state = {"format": STATE_FORMAT}
+                    yield state
+                    tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+                    tmp_path.write_text(json.dumps(state))
+                    os.replace(tmp_path, self.path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _bucket(self, state: dict, scope: str, kind: str) -> dict:
+        return state.setdefault(f"{scope}:{kind}", {})
+
+    def _configured_bucket(self, scope: str, kind: str) -> Optional[dict]:
+        configured = self.requests_per_minute if kind == "requests" else self.tokens_per_minute
+        if configured is None:
+            return None
+        return self._configured.setdefault(f"{scope}:{kind}", {"limit": configured})
+
+    def take(self, scope: str, tokens: int = 0) -> float:
+        """
+        Take a request of `tokens` tokens from the scope's buckets if it fits.
+
+        :return: 0 if it was taken, or else the seconds to wait before trying again.
+        """
+        amounts = {"requests": 1, "tokens": tokens}
+        now = time.time()
+        with self.buckets() as state:
+            # Both the shared bucket and this process's own, if it has a configured limit
+            buckets = [
+                (kind, bucket)
+                for kind in KINDS
+                for bucket in (self._bucket(state, scope, kind), self._configured_bucket(scope, kind))
+                if bucket is not None
+            ]
+            wait = 0.0
+            for kind, bucket in buckets:
+                refill(bucket, now)
+                wait = max(wait, bucket.get("paused_until", 0) - now)
+                limit = bucket.get("limit")
+                if limit is not None:
+                    bucket["largest"] = max(bucket.get("largest", 0.0), amounts[kind])
+                    # Amounts over a minute's worth go through once the bucket is full, and leave it in debt
+                    needed = min(amounts[kind], capacity(bucket))
+                    wait = max(wait, (needed - bucket["available"]) * 60 / limit)
+            if wait <= 0:
+                for kind, bucket in buckets:
+                    if bucket.get("limit") is not None:
+                        bucket["available"] -= amounts[kind]
+                return 0.0
+        return min(wait, MAX_SLEEP)
+
+    def acquire(self, scope: str, tokens: int = 0) -> float:
+        """
+        Block until a request of `tokens` tokens fits in the scope's buckets, and take it from them.
+
+        :return: The seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            wait = self.take(scope, tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, scope: str, tokens: int = 0) -> float:
+        """
+        Like `acquire`, but waiting without blocking the event loop. The buckets are read and written on a worker
+        thread, since that may wait for other processes' file locks.
+        """
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(self.take, scope, tokens)
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def observe(self, scope: str, headers: Mapping[str, str], *, status: int = 200):
+        """
+        Learn from the rate-limit headers of a response: the limits, the budget left, and how long to back off after a
+        429.
+        """
+        headers = {name.lower(): value for name, value in headers.items()}
+        now = time.time()
+        with self.buckets() as state:
+            for kind in KINDS:
+                bucket = self._bucket(state, scope, kind)
+                refill(bucket, now)
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit is not None:
+                    bucket["limit"] = float(limit)
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is not None:
+                    bucket["available"] = min(bucket.get("available", float(remaining)), float(remaining))
+            if status == 429:
+                retry_after = parse_duration(headers.get("retry-after", "")) or parse_duration(
+                    headers.get("x-ratelimit-reset-requests", "1")
+                )
+                requests = self._bucket(state, scope, "requests")
+                requests["paused_until"] = max(requests.get("paused_until", 0), now + (retry_after or 1.0))
+                logger.info(f"Rate limited: pausing {scope} for {retry_after}s")
+
+
+def _make_governor(**rates) -> Governor:
+    path = None if RATE_LIMIT_FILE.lower() in ("", "off", "none") else Path(RATE_LIMIT_FILE)
+    return Governor(
+        path=path,
+        requests_per_minute=rates.get("requests_per_minute", _env_rate("EMBEDIT_REQUESTS_PER_MINUTE")),
+        tokens_per_minute=rates.get("tokens_per_minute", _env_rate("EMBEDIT_TOKENS_PER_MINUTE")),
+    )
+
+
+_governor = _make_governor()
+
+
+def configure(*, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+    """
+    Limit every API call from this process to at most the given rates (None: the environment's, or the provider's).
+    """
+    global _governor
+    _governor = _make_governor(
+        **{
+            name: rate
+            for name, rate in [("requests_per_minute", requests_per_minute), ("tokens_per_minute", tokens_per_minute)]
+            if rate is not None
+        }
+    )
+
+
+def scope(name: str, *, api_key: Optional[str] = None, model: str = "") -> str:
+    return f"{name}:{key_id(api_key)}:{model}"
+
+
+def _count_wait(name: str, waited: float):
+    if waited:
+        profiler.count(f"ratelimit.{name}.waits")
+        profiler.count(f"ratelimit.{name}.wait_s", waited)
+
+
+def acquire(name: str, tokens: int = 0, *, api_key: Optional[str] = None, model: str = ""):
+    """
+    Wait for the budget for a call to the named endpoint with the given key and model. Waits are counted as
+    `ratelimit.<name>.waits` and `ratelimit.<name>.wait_s`.
+    """
+    _count_wait(name, _governor.acquire(scope(name, api_key=api_key, model=model), tokens))
+
+
+async def aacquire(name: str, tokens: int = 0, *, api_key: Optional[str] = None, model: str = ""):
+    """
+    Like `acquire`, without blocking the event loop.
+    """
+    _count_wait(name, await _governor.aacquire(scope(name, api_key=api_key, model=model), tokens))
+
+
+def _has_limits(headers: Mapping[str, str], status: int) -> bool:
+    return status == 429 or any(header.lower().startswith("x-ratelimit-") for header in headers)
+
+
+def observe(
+    name: str, headers: Mapping[str, str], *, status: int = 200, api_key: Optional[str] = None, model: str = ""
+):
+    """
+    Learn from a response's rate-limit headers, if it has any.
+    """
+    if _has_limits(headers, status):
+        _governor.observe(scope(name, api_key=api_key, model=model), headers, status=status)
+
+
+async def aobserve(
+    name: str, headers: Mapping[str, str], *, status: int = 200, api_key: Optional[str] = None, model: str = ""
+):
+    """
+    Like `observe`, without blocking the event loop.
+    """
+    if _has_limits(headers, status):
+        await asyncio.to_thread(_governor.observe, scope(name, api_key=api_key, model=model), headers, status=status)
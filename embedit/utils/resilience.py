@@ -0,0 +1,270 @@
+"""
+Tail-latency controls for API calls: a timeout per attempt and a deadline for the whole call, retries with jittered
+exponential backoff, hedged duplicate requests for idempotent calls that are slower than usual, and a circuit breaker
+per endpoint that fails fast while the provider is unhealthy.
+
+`acall` wraps coroutines (blocking callers run it with `run_sync`). Settings come from the environment (see
+`CallPolicy.from_env`). Retries, hedges, timeouts and breaker trips are counted by the profiler as
+`api.<endpoint>.<event>`.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable
+from typing import Callable
+from typing import Optional
+from typing import TypeVar
+
+import numpy as np
+from attrs import define
+from attrs import field
+
+from embedit.utils.log import logger
+from embedit.utils.profile import profiler
+
+T = TypeVar("T")
+
+# Latencies kept per endpoint, for choosing when to hedge
+LATENCY_WINDOW = 200
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+@define(frozen=True)
+class CallPolicy:
+    # Seconds to wait for each attempt
+    timeout: float = 60.0
+    # Seconds to spend on the whole call, retries and backoff included
+    deadline: float = 180.0
+    attempts: int = 3
+    # The longest backoff between attempts, in seconds
+    max_wait: float = 10.0
+    # Send a duplicate of an idempotent request once it's slower than this percentile of recent ones (None: never)
+    hedge_percentile: Optional[float] = 95.0
+    # Latencies to see before hedging
+    hedge_min_samples: int = 20
+    # Consecutive failures that open the circuit, and seconds before letting a request through to probe it
+    breaker_failures: int = 5
+    breaker_reset: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "CallPolicy":
+        """
+        Read the policy from EMBEDIT_API_TIMEOUT, EMBEDIT_API_DEADLINE, EMBEDIT_API_ATTEMPTS,
+        EMBEDIT_API_HEDGE_PERCENTILE ("off" to disable hedging), EMBEDIT_API_BREAKER_FAILURES and
+        EMBEDIT_API_BREAKER_RESET, defaulting any that aren't set.
+        """
+        default = cls()
+        hedge_percentile = os.environ.get("EMBEDIT_API_HEDGE_PERCENTILE")
+        return cls(
+            timeout=float(os.environ.get("EMBEDIT_API_TIMEOUT", default.timeout)),
+            deadline=float(os.environ.get("EMBEDIT_API_DEADLINE", default.deadline)),
+            attempts=int(os.environ.get("EMBEDIT_API_ATTEMPTS", default.attempts)),
+            max_wait=default.max_wait,
+            hedge_percentile=(
+                default.hedge_percentile
+                if hedge_percentile is None
+                else None
+                if hedge_percentile.lower() in ("", "off", "none")
+                else float(hedge_percentile)
+            ),
+            hedge_min_samples=default.hedge_min_samples,
+            breaker_failures=int(os.environ.get("EMBEDIT_API_BREAKER_FAILURES", default.breaker_failures)),
+            breaker_reset=float(os.environ.get("EMBEDIT_API_BREAKER_RESET", default.breaker_reset)),
+        )
+
+
+@define
+class LatencyTracker:
+    latencies: deque = field(factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, q: float, *, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < min_samples:
+                return None
+            return float(np.percentile(self.latencies, q))
+
+
+@define
+class CircuitBreaker:
+    """
+    Opens after `failures_to_open` consecutive failures, and then rejects calls until `reset_after` seconds have passed.
+    After that it lets one call through: if it succeeds, the circuit closes again, and if it fails, it stays open for
+    another `reset_after` seconds.
+    """
+
+    name: str
+    failures_to_open: int
+    reset_after: float
+    failures: int = 0
+    opened_at: Optional[float] = None
+    probing: bool = False
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_after:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning(f"{self.name} is responding again")
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.failures_to_open):
+                if not self.probing:
+                    logger.warning(
+                        f"{self.name} failed {self.failures} times in a row. Failing fast for {self.reset_after:g}s."
+                    )
+                    profiler.count(f"api.{self.name}.breaker_opened")
+                self.opened_at, self.probing = time.monotonic(), False
+
+
+@define
+class Endpoint:
+    latencies: LatencyTracker
+    breaker: CircuitBreaker
+
+
+_endpoints: dict[str, Endpoint] = {}
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoint(name: str, policy: CallPolicy) -> Endpoint:
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(
+                latencies=LatencyTracker(),
+                breaker=CircuitBreaker(
+                    name=name, failures_to_open=policy.breaker_failures, reset_after=policy.breaker_reset
+                ),
+            )
+        return _endpoints[name]
+
+
+async def _aattempt(
+    name: str,
+    endpoint: Endpoint,
+    function: Callable[[float], Awaitable[T]],
+    timeout: float,
+    hedge_after: Optional[float],
+) -> T:
+    # Run one attempt, plus a duplicate if it's still running after hedge_after seconds, and return the first success.
+    # Attempts that aren't needed any more are cancelled.
+    start = time.monotonic()
+    primary = asyncio.ensure_future(function(timeout))
+    running: set[asyncio.Future] = {primary}
+    hedged = False
+    error: Optional[BaseException] = None
+    try:
+        while running:
+            if hedged or hedge_after is None:
+                wake = start + timeout
+            else:
+                wake = start + min(hedge_after, timeout)
+            done, running = await asyncio.wait(
+                running, timeout=max(0.0, wake - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    endpoint.latencies.record(time.monotonic() - start)
+                    if task is not primary:
+                        profiler.count(f"api.{name}.hedge_wins")
+                    return task.result()
+                error = task.exception()
+            if not running:
+                break
+            if time.monotonic() - start >= timeout:
+                profiler.count(f"api.{name}.timeouts")
+                raise DeadlineExceeded(f"{name} didn't respond within {timeout:.1f}s")
+            if not hedged and hedge_after is not None and time.monotonic() - start >= hedge_after:
+                logger.info(f"{name} is slower than {hedge_after:.2f}s. Sending a hedged request.")
+                profiler.count(f"api.{name}.hedges")
+                running.add(asyncio.ensure_future(function(timeout - (time.monotonic() - start))))
+                hedged = True
+        raise error
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def acall(
+    name: str,
+    function: Callable[[float], Awaitable[T]],
+    *,
+    idempotent: bool = False,
+    retry_if: Callable[[BaseException], bool] = lambda error: True,
+    policy: Optional[CallPolicy] = None,
+    before_attempt: Optional[Callable[[], Awaitable[None]]] = None,
+) -> T:
+    """
+    Call the coroutine function `function(timeout)`, which should make one request that gives up after `timeout`
+    seconds, under the policy.
+
+    :param name: The endpoint, e.g. "openai.chat". Latencies and circuit breakers are kept per endpoint.
+    :param idempotent: Whether duplicate requests are harmless, so that slow ones can be hedged.
+    :param retry_if: Whether an error is worth retrying. Other errors are raised straight away, and don't count against
+        the endpoint's health.
+    :param before_attempt: A coroutine function awaited before each attempt (e.g. to wait for rate-limit budget),
+        outside its timeout.
+    :raises CircuitOpenError: If the endpoint has been failing and isn't being probed yet.
+    :raises DeadlineExceeded: If an attempt times out and there's no time or attempts left to retry.
+    """
+    if policy is None:
+        policy = CallPolicy.from_env()
+    endpoint = get_endpoint(name, policy)
+    if not endpoint.breaker.allow():
+        profiler.count(f"api.{name}.short_circuits")
+        raise CircuitOpenError(f"{name} has been failing. Not calling it until it's had time to recover.")
+    start = time.monotonic()
+    for attempt in range(1, policy.attempts + 1):
+        if before_attempt is not None:
+            await before_attempt()
+        remaining = policy.deadline - (time.monotonic() - start)
+        hedge_after = None
+        if idempotent and policy.hedge_percentile is not None:
+            hedge_after = endpoint.latencies.percentile(policy.hedge_percentile, min_samples=policy.hedge_min_samples)
+        try:
+            result = await _aattempt(name, endpoint, function, min(policy.timeout, remaining), hedge_after)
+        except Exception as e:
+            if not retry_if(e):
+                # The provider answered, so it's healthy
+                endpoint.breaker.record_success()
+                raise
+            endpoint.breaker.record_failure()
+            backoff = random.uniform(0, min(policy.max_wait, 2 ** attempt))
+            remaining = policy.deadline - (time.monotonic() - start)
+            if attempt == policy.attempts or endpoint.breaker.is_open or backoff >= remaining:
+                raise
+            logger.warning(f"{name} failed ({type(e).__name__}: {e}). Retrying in {backoff:.1f}s.")
+            profiler.count(f"api.{name}.retries")
+            await asyncio.sleep(backoff)
+            continue
+        endpoint.breaker.record_success()
+        return result
@@ -0,0 +1,233 @@
+"""
+A local stand-in for the OpenAI and Cohere APIs, for benchmarking and testing without API keys.
+
+It implements OpenAI's `/v1/embeddings` and `/v1/chat/completions` and Cohere's `/v1/embed`. Embeddings are
+deterministic (the normalised sum of a hashed random vector per word, so texts that share words are similar) and chat
+completions echo the last `## Context` section of the prompt, which makes `transform` a no-op. Latency, rate limits and
+errors can be injected.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+from attrs import define
+from attrs import field
+
+from embedit.utils.log import logger
+
+WORD_PATTERN = re.compile(r"\w+")
+CONTEXT_PATTERN = re.compile(r"## Context\n(.*?)\n## (?:Request|Response)", re.DOTALL)
+
+
+@lru_cache(maxsize=1 << 16)
+def word_vector(word: str, dimensions: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+
+
+def stub_embedding(text: str, dimensions: int) -> list[float]:
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower()):
+        vector += word_vector(word, dimensions)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector = word_vector("", dimensions)
+        norm = np.linalg.norm(vector)
+    return (vector / norm).tolist()
+
+
+def count_tokens(text: str) -> int:
+    # Roughly four characters per token, like the real tokenisers on English text
+    return max(1, len(text) // 4)
+
+
+def stub_completion(prompt: str) -> str:
+    contexts = CONTEXT_PATTERN.findall(prompt)
+    if contexts and "```" in contexts[-1]:
+        return contexts[-1]
+    return "Update files"
+
+
+@define
+class StubConfig:
+    """
+    :param latency: Mean seconds to wait before answering each request.
+    :param jitter: Standard deviation of the latency, in seconds.
+    :param per_token_latency: Extra seconds per token in the request and response.
+    :param requests_per_minute: Answer 429 to requests beyond this rate (None for no limit).
+    :param error_rate: Fraction of requests to answer with a 500.
+    :param hang_rate: Fraction of requests to never answer (until `hang_seconds` have passed).
+    :param dimensions: Size of the returned embeddings.
+    :param seed: Seed for the latency and error injection.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    per_token_latency: float = 0.0
+    requests_per_minute: Optional[float] = None
+    error_rate: float = 0.0
+    hang_rate: float = 0.0
+    hang_seconds: float = 600.0
+    dimensions: int = 1536
+    seed: int = 0
+
+
+@define
+class StubState:
+    config: StubConfig
+    random: random.Random
+    tokens: float = 0.0
+    last_refill: float = field(factory=time.monotonic)
+    requests: int = 0
+    _lock: threading.Lock = field(factory=threading.Lock)
+
+    def admit(self) -> Optional[float]:
+        """
+        Take a request from the token bucket.
+
+        :return: None if the request may go ahead, otherwise the number of seconds until it could.
+        """
+        rate = self.config.requests_per_minute
+        with self._lock:
+            self.requests += 1
+            if rate is None:
+                return None
+            now = time.monotonic()
+            if self.requests == 1:
+                self.tokens = rate / 60
+            self.tokens = min(rate / 60, self.tokens + (now - self.last_refill) * rate / 60)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) * 60 / rate
+
+    def draw(self) -> tuple[float, float]:
+        with self._lock:
+            return self.random.random(), self.random.gauss(self.config.latency, self.config.jitter)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        state: StubState = self.server.state
+        config = state.config
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        retry_after = state.admit()
+        if retry_after is not None:
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}, "message": "Rate limit reached"},
+                {"Retry-After": f"{retry_after:.3f}", "x-ratelimit-remaining-requests": "0"},
+            )
+            return
+        chance, latency = state.draw()
+        if chance < config.hang_rate:
+            time.sleep(config.hang_seconds)
+        elif chance < config.hang_rate + config.error_rate:
+            self.send_json(500, {"error": {"message": "Injected error", "type": "server_error"}, "message": "Injected error"})
+            return
+
+        path = self.path.rstrip("/")
+        if path == "/v1/embeddings":
+            texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            tokens = sum(count_tokens(text) for text in texts)
+            body = {
+                "object": "list",
+                "model": request.get("model", "stub"),
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": stub_embedding(text, config.dimensions)}
+                    for i, text in enumerate(texts)
+                ],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        elif path == "/v1/embed":
+            texts = request["texts"]
+            tokens = sum(count_tokens(text) for text in texts)
+            body = {
+                "id": hashlib.sha1(json.dumps(texts).encode()).hexdigest(),
+                "response_type": "embeddings_floats",
+                "texts": texts,
+                "embeddings": [stub_embedding(text, config.dimensions) for text in texts],
+                "meta": {"api_version": {"version": "1"}},
+            }
+        elif path == "/v1/chat/completions":
+            prompt = "\n".join(message["content"] for message in request["messages"])
+            content = stub_completion(prompt)
+            for stop in request.get("stop") or []:
+                content = content.split(stop)[0]
+            finish_reason = "stop"
+            max_tokens = request.get("max_tokens")
+            if max_tokens is not None and count_tokens(content) > max_tokens:
+                content = content[: max_tokens * 4]
+                finish_reason = "length"
+            tokens = count_tokens(prompt) + count_tokens(content)
+            body = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+                ],
+                "usage": {
+                    "prompt_tokens": count_tokens(prompt),
+                    "completion_tokens": count_tokens(content),
+                    "total_tokens": tokens,
+                },
+            }
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}, "message": "Not found"})
+            return
+        time.sleep(max(0.0, latency + tokens * config.per_token_latency))
+        headers = {}
+        if config.requests_per_minute is not None:
+            # Like OpenAI, tell clients the limit so that they can pace themselves
+            headers["x-ratelimit-limit-requests"] = f"{config.requests_per_minute:g}"
+        self.send_json(200, body, headers)
+
+    def log_message(self, format: str, *args):
+        logger.debug(format % args)
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def make_stub_server(config: StubConfig, *, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Create (but don't start) a stub server. Port 0 picks a free port; see `server.server_address`.
+    """
+    server = _StubServer((host, port), _StubHandler)
+    server.state = StubState(config=config, random=random.Random(config.seed))
+    return server
+
+
+def start_stub_server(config: StubConfig, *, host: str = "127.0.0.1", port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Start a stub server on a background thread.
+
+    :return: The server (call `shutdown()` to stop it) and its base URL, for `configure_api_base`.
+    """
+    server = make_stub_server(config, host=host, port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,176 @@
+"""
+Counting tokens: exactly, with tiktoken's encodings, or approximately and several times faster, for planning (e.g.
+packing files into chunks) where a few percent either way doesn't matter. Exact counts are kept for the final budget
+checks before a request is sent.
+
+The estimate counts the pieces that tiktoken's pre-tokeniser splits text into, by byte class (letters, digits,
+punctuation, whitespace), with runs of letters broken up every few bytes as byte-pair encoding does with long or rare
+words, and scales the count by a factor calibrated on source code for each encoding (see `benchmarks/tokens.py`).
+
+tiktoken downloads an encoding's data the first time it's used. Unless TIKTOKEN_CACHE_DIR is set, it's kept in
+`DEFAULT_TOKENIZER_DIR` rather than the temp directory, and `embedit tokenizer-data` fills it in ahead of time, from the
+network or from a copy of the files for machines without network access. Without the data, exact counts fall back to
+the estimate.
+"""
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from hashlib import sha1
+from pathlib import Path
+from typing import Iterator
+from typing import Literal
+from typing import Optional
+from typing import Sequence
+
+import tiktoken
+from tiktoken.model import MODEL_PREFIX_TO_ENCODING
+from tiktoken.model import MODEL_TO_ENCODING
+
+from embedit.utils.log import logger
+
+DEFAULT_TOKENIZER_DIR = Path.home() / ".cache" / "embedit" / "tiktoken"
+TOKENIZER_DATA_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+# The encoding of the chat and embedding models embedit uses, and of models tiktoken doesn't know
+DEFAULT_ENCODING = "cl100k_base"
+# Encodings whose data is a single `.tiktoken` file that `embedit tokenizer-data` can fetch or copy
+DATA_FILES = {
+    "cl100k_base": "cl100k_base",
+    "p50k_base": "p50k_base",
+    "p50k_edit": "p50k_base",
+    "r50k_base": "r50k_base",
+}
+
+# One match per piece of the pre-tokeniser: a word (with the space or symbol before it), up to three digits, a run of
+# punctuation (or of the bytes of non-ASCII characters), or whitespace
+ESTIMATE_PATTERN = re.compile(
+    rb"[^A-Za-z0-9\r\n]?[A-Za-z]{1,8}|[0-9]{1,3}| ?[^A-Za-z0-9\s]{1,3}[\r\n]*|\s*[\r\n]+|\s+(?!\S)"
+)
+# Tokens per piece, fitted on a few hundred Python, JavaScript and Markdown files
+CALIBRATION = {"cl100k_base": 1.054, "p50k_base": 1.32, "p50k_edit": 1.32, "r50k_base": 1.32, "gpt2": 1.32}
+
+
+def encoding_name(model: str) -> str:
+    """
+    The name of the model's encoding, without loading it.
+    """
+    if model in MODEL_TO_ENCODING:
+        return MODEL_TO_ENCODING[model]
+    for prefix, name in MODEL_PREFIX_TO_ENCODING.items():
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_ENCODING
+
+
+_environ_lock = threading.Lock()
+
+
+def tokenizer_dir() -> Path:
+    """
+    Where tiktoken keeps encodings' data when embedit loads them.
+    """
+    return Path(os.environ.get("TIKTOKEN_CACHE_DIR") or DEFAULT_TOKENIZER_DIR)
+
+
+@contextmanager
+def tokenizer_cache_dir() -> Iterator[None]:
+    # tiktoken only reads its cache directory from the environment, while it loads an encoding, so set it for just
+    # that long (unless it's set already)
+    with _environ_lock:
+        if os.environ.get("TIKTOKEN_CACHE_DIR"):
+            yield
+            return
+        os.environ["TIKTOKEN_CACHE_DIR"] = str(DEFAULT_TOKENIZER_DIR)
+        try:
+            yield
+        finally:
+            os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str) -> Optional[tiktoken.Encoding]:
+    """
+    Load an encoding, or return None (once warning how to fix it) if its data can't be downloaded.
+    """
+    try:
+        with tokenizer_cache_dir():
+            return tiktoken.get_encoding(name)
+    except OSError as e:
+        # requests' errors are OSErrors
+        logger.warning(
+            f"Couldn't load the {name} tokeniser ({type(e).__name__}), so token counts are estimated. Run `embedit"
+            f" tokenizer-data` with network access, or with --source pointing at a copy of {name}.tiktoken, to fix it."
+        )
+        return None
+
+
+def estimate_tokens(string: str, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Estimate the number of tokens in the string, usually to within a few percent on code.
+    """
+    pieces = ESTIMATE_PATTERN.subn(b"", string.encode("utf-8", "surrogatepass"))[1]
+    return math.ceil(pieces * CALIBRATION.get(encoding_name(model), CALIBRATION[DEFAULT_ENCODING]))
+
+
+def count_tokens(string: str, model: str, *, estimate: bool = False) -> int:
+    """
+    Count the tokens in the string, or estimate them if `estimate` is set or the encoding isn't available.
+    """
+    encoding = None if estimate else get_encoding(encoding_name(model))
+    if encoding is None:
+        return estimate_tokens(string, model)
+    return len(encoding.encode(string, disallowed_special=()))
+
+
+def clip_tokens(string: str, max_tokens: int, model: str, *, keep: Literal["left", "right"] = "right") -> str:
+    """
+    Clip the string to at most `max_tokens` tokens, keeping its end ("left") or its start ("right").
+    """
+    encoding = get_encoding(encoding_name(model))
+    if encoding is None:
+        # Keep the share of the characters that the estimate says fits
+        estimate = estimate_tokens(string, model)
+        if estimate <= max_tokens:
+            return string
+        num_chars = len(string) * max_tokens // estimate
+        return string[len(string) - num_chars:] if keep == "left" else string[:num_chars]
+    token_ids = encoding.encode(string, disallowed_special=())
+    if len(token_ids) <= max_tokens:
+        return string
+    return encoding.decode(token_ids[-max_tokens:] if keep == "left" else token_ids[:max_tokens])
+
+
+def tokenizer_data_path(name: str) -> Path:
+    # Where tiktoken looks for the encoding's data before downloading it
+    return tokenizer_dir() / sha1(TOKENIZER_DATA_URL.format(name=DATA_FILES[name]).encode()).hexdigest()
+
+
+def seed_tokenizer_data(source: Optional[str] = None, encodings: Sequence[str] = (DEFAULT_ENCODING,)) -> list[Path]:
+    """
+    Make the encodings' data available offline, by downloading it or by copying `<name>.tiktoken` files from `source`.
+
+    :return: The paths of the data files.
+    """
+    paths = []
+    for name in encodings:
+        if name not in DATA_FILES:
+            raise ValueError(f"Unknown encoding {name}. Choose from: {', '.join(DATA_FILES)}")
+        path = tokenizer_data_path(name)
+        if source is not None:
+            source_path = Path(source) / f"{DATA_FILES[name]}.tiktoken"
+            if not source_path.exists():
+                raise FileNotFoundError(f"{source_path} doesn't exist")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+                with open(source_path, "rb") as f:
+                    shutil.copyfileobj(f, tmp)
+            os.replace(tmp.name, path)
+        get_encoding.cache_clear()
+        if get_encoding(name) is None:
+            raise OSError(f"Couldn't load the {name} tokeniser")
+        paths.append(path)
+    return paths
@@ -0,0 +1,53 @@
+"""
+Per-task accounting of API usage, for reporting what each of several concurrent tasks (e.g. batch jobs) cost.
+
+Usage is recorded into whatever `track_usage` block is current in the calling context. Threads don't inherit the
+context, so work handed to a pool should be run with `contextvars.copy_context().run` to be counted.
+"""
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+from typing import Optional
+
+from attrs import define
+from attrs import field
+
+
+@define
+class Usage:
+    requests: int = 0
+    tokens_sent: int = 0
+    tokens_received: int = 0
+    _lock: threading.Lock = field(factory=threading.Lock, repr=False, eq=False)
+
+    def add(self, *, requests: int = 0, tokens_sent: int = 0, tokens_received: int = 0):
+        with self._lock:
+            self.requests += requests
+            self.tokens_sent += tokens_sent
+            self.tokens_received += tokens_received
+
+    def to_json(self) -> dict:
+        return {"requests": self.requests, "tokens_sent": self.tokens_sent, "tokens_received": self.tokens_received}
+
+
+_current: contextvars.ContextVar[Optional[Usage]] = contextvars.ContextVar("usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[Usage]:
+    """
+    Count the API usage of everything run in this context until the block exits.
+    """
+    usage = Usage()
+    token = _current.set(usage)
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+
+
+def record_usage(*, requests: int = 1, tokens_sent: int = 0, tokens_received: int = 0):
+    usage = _current.get()
+    if usage is not None:
+        usage.add(requests=requests, tokens_sent=tokens_sent, tokens_received=tokens_received)
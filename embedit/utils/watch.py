@@ -0,0 +1,220 @@
+"""
+Watch directory trees for changes, using inotify where it's available and polling otherwise.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+from typing import Sequence
+
+from embedit.utils.log import logger
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+# A batch of changed paths, or None if the watcher lost track and everything should be rescanned
+Changes = Optional[set[Path]]
+
+
+class WatchLimitError(OSError):
+    """
+    The inotify watch limit (fs.inotify.max_user_watches) was reached.
+    """
+
+
+def _is_hidden(path: Path) -> bool:
+    return path.name.startswith(".")
+
+
+class InotifyWatcher:
+    """
+    Watches directory trees with Linux's inotify, adding watches for directories as they're created.
+    """
+
+    def __init__(self, roots: Sequence[Path]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: dict[int, Path] = {}
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, root: Path):
+        for directory, dirnames, _ in os.walk(root):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed (or replaced by a file) since it was listed, e.g. a short-lived build or temporary
+                    # directory
+                    continue
+                if error == errno.ENOSPC:
+                    raise WatchLimitError(error, f"Reached the inotify watch limit adding {directory}")
+                raise OSError(error, f"inotify_add_watch failed for {directory}")
+            self.directories[wd] = Path(directory)
+
+    def read(self, timeout: Optional[float]) -> Changes:
+        """
+        Wait up to `timeout` seconds for events and return the paths they concern.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 1 << 16)
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size: offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # A watched directory went away. Whatever was under it is gone too.
+                return None
+            path = directory / os.fsdecode(name)
+            if _is_hidden(path):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                    return None
+                if mask & IN_MOVED_FROM:
+                    return None
+                continue
+            changes.add(path)
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watches directory trees by comparing the mtimes and sizes of the files in them.
+    """
+
+    def __init__(self, roots: Sequence[Path], *, interval: float = 1.0):
+        self.roots = roots
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self) -> dict[Path, tuple[int, int]]:
+        state = {}
+        for root in self.roots:
+            for directory, dirnames, filenames in os.walk(root):
+                dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+                for filename in filenames:
+                    path = Path(directory, filename)
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def read(self, timeout: Optional[float]) -> Changes:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        state = self.scan()
+        changes = {path for path in state.keys() | self.state.keys() if state.get(path) != self.state.get(path)}
+        self.state = state
+        return {path for path in changes if not _is_hidden(path)}
+
+    def close(self):
+        pass
+
+
+def make_watcher(roots: Sequence[Path], *, poll: bool = False, poll_interval: float = 1.0):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            # E.g. the watch limit was hit, or libc has no inotify
+            logger.warning(f"Couldn't use inotify ({e}). Falling back to polling.")
+    return PollingWatcher(roots, interval=poll_interval)
+
+
+def watch(
+    roots: Sequence[str],
+    *,
+    debounce: float = 0.5,
+    max_delay: float = 10.0,
+    poll: bool = False,
+    poll_interval: float = 1.0,
+    stop: Callable[[], bool] = lambda: False,
+) -> Iterator[Changes]:
+    """
+    Yield batches of changed files under the given directories.
+
+    A batch is yielded once no new changes have arrived for `debounce` seconds (or `max_delay` seconds after the
+    first change, for trees that never go quiet). A batch of None means the watcher lost track of the tree (e.g. a
+    directory was moved) and everything should be rescanned.
+    """
+    paths = [Path(root) for root in roots]
+    watcher = make_watcher(paths, poll=poll, poll_interval=poll_interval)
+
+    def read(timeout: float) -> Changes:
+        nonlocal watcher
+        try:
+            return watcher.read(timeout=timeout)
+        except WatchLimitError as e:
+            # New directories can't be watched any more, so watch everything by polling instead, and rescan in case
+            # something changed in the directories that weren't watched
+            logger.warning(f"{e.strerror}. Falling back to polling.")
+            watcher.close()
+            watcher = PollingWatcher(paths, interval=poll_interval)
+            return None
+
+    try:
+        while not stop():
+            changes = read(timeout=1.0)
+            if changes is not None and not changes:
+                continue
+            first = time.monotonic()
+            while time.monotonic() - first < max_delay:
+                more = read(timeout=debounce)
+                if more is None:
+                    changes = None
+                elif not more:
+                    break
+                elif changes is not None:
+                    changes |= more
+            yield changes
+    finally:
+        watcher.close()
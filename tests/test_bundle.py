@@ -0,0 +1,118 @@
+"""
+Exporting and importing index bundles, with the embeddings faked.
+"""
+import json
+import zipfile
+
+import numpy as np
+import pytest
+
+from embedit.behaviour.search import index as search_index
+from embedit.behaviour.search.bundle import MANIFEST
+from embedit.behaviour.search.bundle import Bundle
+from embedit.behaviour.search.bundle import BundleError
+from embedit.behaviour.search.bundle import export_index
+from embedit.behaviour.search.bundle import import_index
+from embedit.behaviour.search.bundle import member_offset
+from embedit.behaviour.search.index import SearchIndex
+
+
+@pytest.fixture
+def embedded(monkeypatch) -> list[str]:
+    texts_embedded = []
+
+    def embed_texts(texts, mode="openai"):
+        texts_embedded.extend(texts)
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32).reshape(len(texts), 2)
+
+    monkeypatch.setattr(search_index, "embed_texts", embed_texts)
+    return texts_embedded
+
+
+def build_bundle(tmp_path, root, names) -> str:
+    index = SearchIndex(fragment_lines=4)
+    index.update([str(root / name) for name in names], workers=0)
+    index.save(str(tmp_path / "idx"))
+    bundle_path = tmp_path / "index.bundle"
+    assert export_index(str(bundle_path), index_dir=str(tmp_path / "idx"), root=str(root)) == len(names)
+    return str(bundle_path)
+
+
+def test_export_then_import_with_changed_and_missing_files(tmp_path, embedded):
+    root = tmp_path / "root"
+    root.mkdir()
+    for name in ["same.py", "changed.py", "missing.py"]:
+        (root / name).write_text("".join(f"{name} line {i}\n" for i in range(10)))
+    bundle_path = build_bundle(tmp_path, root, ["same.py", "changed.py", "missing.py"])
+    exported = SearchIndex.load(str(tmp_path / "idx"))
+
+    (root / "changed.py").write_text("changed\n" + (root / "changed.py").read_text())
+    (root / "missing.py").unlink()
+    embedded.clear()
+    imported = import_index(bundle_path, index_dir=str(tmp_path / "imported"), root=str(root))
+
+    assert set(imported.entries) == {(root / "same.py").resolve(), (root / "changed.py").resolve()}
+    # Only the changed file is embedded again
+    assert embedded and all(text.startswith("changed") or "changed.py" in text for text in embedded)
+    same = (root / "same.py").resolve()
+    assert imported.entries[same].table.texts() == exported.entries[same].table.texts()
+    assert (imported.entries[same].table.embedding_matrix() == exported.entries[same].table.embedding_matrix()).all()
+    # And the imported index is saved
+    reloaded = SearchIndex.load(str(tmp_path / "imported"))
+    assert set(reloaded.entries) == set(imported.entries)
+
+
+def test_corrupted_member_fails_verification(tmp_path, embedded):
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "a.py").write_text("".join(f"line {i}\n" for i in range(10)))
+    bundle_path = build_bundle(tmp_path, root, ["a.py"])
+    Bundle.open(bundle_path)
+    with zipfile.ZipFile(bundle_path) as zf:
+        info = zf.getinfo("embeddings.npy")
+    # Flip the last byte of the embeddings' data
+    with open(bundle_path, "r+b") as f:
+        f.seek(member_offset(tmp_path / "index.bundle", info) + info.file_size - 1)
+        last = f.read(1)
+        f.seek(-1, 1)
+        f.write(bytes([last[0] ^ 0xFF]))
+    with pytest.raises(BundleError, match="embeddings.npy.*checksum"):
+        Bundle.open(bundle_path)
+    with pytest.raises(BundleError, match="checksum"):
+        import_index(bundle_path, index_dir=str(tmp_path / "imported"), root=str(root))
+    # Unchecked, it opens
+    Bundle.open(bundle_path, verify=False)
+
+
+def rewrite_manifest(bundle_path, update):
+    # Copies every member, replacing the manifest
+    with zipfile.ZipFile(bundle_path) as zf:
+        members = {info.filename: zf.read(info) for info in zf.infolist()}
+    manifest = json.loads(members[MANIFEST])
+    update(manifest)
+    members[MANIFEST] = json.dumps(manifest).encode()
+    with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+
+@pytest.mark.parametrize("path", ["../outside.py", "/etc/passwd"])
+def test_import_refuses_files_outside_root(tmp_path, embedded, path):
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "a.py").write_text("a = 1\n")
+    (tmp_path / "outside.py").write_text("secret = 1\n")
+    index = SearchIndex()
+    index.update([str(root / "a.py")], workers=0)
+    index.save(str(tmp_path / "idx"))
+    bundle_path = tmp_path / "index.bundle"
+    export_index(str(bundle_path), index_dir=str(tmp_path / "idx"), root=str(root))
+
+    def point_outside(manifest):
+        manifest["files"][0].update(path=path, digest="0" * 40)
+
+    rewrite_manifest(bundle_path, point_outside)
+    embedded.clear()
+    with pytest.raises(BundleError, match="outside"):
+        import_index(str(bundle_path), index_dir=str(tmp_path / "imported"), root=str(root), verify=False)
+    assert embedded == []
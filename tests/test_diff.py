@@ -0,0 +1,113 @@
+"""
+The line diff: its opcodes must rebuild the new lines from the old ones, whichever way it found them.
+"""
+import random
+
+import pytest
+
+from embedit.utils.diff import Opcode
+from embedit.utils.diff import compute_diff
+from embedit.utils.diff import diff_lines
+
+
+def apply_opcodes(a: list[str], b: list[str], opcodes: list[Opcode]) -> list[str]:
+    # Checks that the opcodes cover both sides in order, and that equal blocks are equal
+    i = j = 0
+    result = []
+    for op in opcodes:
+        assert (op.a_start, op.b_start) == (i, j)
+        assert op.a_start <= op.a_end and op.b_start <= op.b_end
+        if op.tag == "equal":
+            assert a[op.a_start:op.a_end] == b[op.b_start:op.b_end]
+            result += a[op.a_start:op.a_end]
+        else:
+            assert op.tag == {(True, True): "replace", (True, False): "delete", (False, True): "insert"}[
+                (op.a_end > op.a_start, op.b_end > op.b_start)
+            ]
+            result += b[op.b_start:op.b_end]
+        i, j = op.a_end, op.b_end
+    assert (i, j) == (len(a), len(b))
+    return result
+
+
+def random_edit(lines: list[str], rng: random.Random, vocabulary: list[str]) -> list[str]:
+    lines = list(lines)
+    for _ in range(rng.randrange(1, 8)):
+        i = rng.randrange(len(lines) + 1)
+        edit = rng.choice(["insert", "delete", "replace", "move"])
+        if edit == "insert" or not lines:
+            lines[i:i] = rng.choices(vocabulary, k=rng.randrange(1, 4))
+        elif edit == "delete":
+            del lines[i: i + rng.randrange(1, 4)]
+        elif edit == "replace":
+            lines[i: i + 1] = [rng.choice(vocabulary)]
+        else:
+            block = lines[i: i + 3]
+            del lines[i: i + 3]
+            j = rng.randrange(len(lines) + 1)
+            lines[j:j] = block
+    return lines
+
+
+@pytest.mark.parametrize("seed", range(200))
+@pytest.mark.parametrize("max_edit_cost", [0, 3, 200])
+def test_opcodes_rebuild_random_edits(seed, max_edit_cost):
+    rng = random.Random(seed)
+    # Few distinct lines, so there are regions without unique lines for the bounded Myers diff, and some unique ones to
+    # anchor the patience diff
+    vocabulary = ["", "pass", "return x", "    x += 1", *(f"line {i}" for i in range(rng.randrange(1, 20)))]
+    a = rng.choices(vocabulary, k=rng.randrange(0, 60))
+    b = random_edit(a, rng, vocabulary)
+    opcodes = diff_lines(a, b, max_edit_cost=max_edit_cost)
+    assert apply_opcodes(a, b, opcodes) == b
+    diff = compute_diff("\n".join(a), "\n".join(b))
+    assert diff.stats.added - diff.stats.removed == len(diff.b_lines) - len(diff.a_lines)
+
+
+def test_edit_cost_bound_replaces_the_region():
+    # No line is unique, so there are no anchors, and the region takes more than 2 edits
+    a = ["x", "y"] * 10
+    b = ["y", "x"] * 10 + ["z", "z"]
+    assert diff_lines(a, b, max_edit_cost=2) == [Opcode("replace", 0, 20, 0, 22)]
+    opcodes = diff_lines(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    # The shortest edit script: drop the first x, and add x, z, z at the end
+    assert sum(op.a_end - op.a_start + op.b_end - op.b_start for op in opcodes if op.tag != "equal") == 4
+
+
+def test_patience_anchors_on_unique_lines():
+    a = ["def f():", "    return 1", "", "def g():", "    return 2"]
+    b = ["def g():", "    return 2", "", "def f():", "    return 1"]
+    opcodes = diff_lines(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    assert [op.tag for op in opcodes].count("equal") >= 1
+
+
+def test_hunks_keep_context_around_changes():
+    a = [f"line {i}" for i in range(40)]
+    b = list(a)
+    b[5] = "changed 5"
+    b[30] = "changed 30"
+    diff = compute_diff("\n".join(a), "\n".join(b))
+    hunks = diff.hunks(context=3)
+    assert len(hunks) == 2
+    for hunk, changed in zip(hunks, [5, 30]):
+        lines = list(diff.lines(hunk))
+        assert [i for tag, i, _ in lines if tag == "-"] == [changed]
+        assert [j for tag, _, j in lines if tag == "+"] == [changed]
+        assert len(lines) == 3 + 2 + 3
+    assert diff.hunks(context=None) == [diff.opcodes]
+    # Changes closer than twice the context share a hunk
+    b[10] = "changed 10"
+    assert len(compute_diff("\n".join(a), "\n".join(b)).hunks(context=3)) == 2
+
+
+def test_intraline_marks_changed_characters():
+    diff = compute_diff("value = compute(1)\nend", "value = compute(2)\nend")
+    [op] = [op for op in diff.opcodes if op.tag != "equal"]
+    a_changes, b_changes = diff.intraline(op)
+    assert [diff.a_lines[0][start:end] for start, end in a_changes[0]] == ["1"]
+    assert [diff.b_lines[0][start:end] for start, end in b_changes[0]] == ["2"]
+    # Blocks too large get no character-level detail
+    large = compute_diff("value = compute(1)\nend", "value = compute(2)\nend", intraline_max_chars=10)
+    assert large.intraline(op) == ({}, {})
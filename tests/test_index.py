@@ -0,0 +1,45 @@
+"""
+`SearchIndex` with the embeddings faked, counting the fragments sent to be embedded.
+"""
+import numpy as np
+import pytest
+
+from embedit.behaviour.search import index as search_index
+from embedit.behaviour.search.index import SearchIndex
+
+
+@pytest.fixture
+def embedded(monkeypatch) -> list[str]:
+    texts_embedded = []
+
+    def embed_texts(texts, mode="openai"):
+        texts_embedded.extend(texts)
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32).reshape(len(texts), 2)
+
+    monkeypatch.setattr(search_index, "embed_texts", embed_texts)
+    return texts_embedded
+
+
+def test_reload_reuses_unchanged_fragments_of_edited_file(tmp_path, embedded):
+    source = tmp_path / "module.py"
+    source.write_text("".join(f"def function_{i}():\n    return {i}\n\n\n" for i in range(30)))
+    index_dir = tmp_path / "idx"
+
+    index = SearchIndex(fragment_lines=8, chunking="content")
+    index.update([str(source)], workers=0)
+    index.save(str(index_dir))
+    fragments = len(index.snapshot)
+    assert len(embedded) == fragments
+
+    # Edited after the index was saved, so it's re-split when the index is next loaded and updated
+    source.write_text("import os\n" + source.read_text())
+    embedded.clear()
+    reloaded = SearchIndex.load(str(index_dir))
+    assert reloaded.update([str(source)], workers=0)
+    assert 0 < len(embedded) < fragments
+    assert not reloaded.stale
+
+    # The reused embeddings belong to the same texts
+    table = reloaded.snapshot
+    lengths = [len(text.replace("\n", " ")) for text in table.texts()]
+    assert table.embedding_matrix()[:, 0].tolist() == lengths
@@ -0,0 +1,66 @@
+"""
+Indexing a repository's history, with the embeddings faked.
+"""
+import numpy as np
+import pytest
+from git import Actor
+from git import Repo
+
+from embedit.behaviour.search import log_index
+from embedit.behaviour.search.log_index import TIPS_FILE
+from embedit.behaviour.search.log_index import LogIndex
+
+
+@pytest.fixture
+def embedded(monkeypatch) -> list[str]:
+    texts_embedded = []
+
+    def embed_texts(texts, mode="openai"):
+        texts_embedded.extend(texts)
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32).reshape(len(texts), 2)
+
+    monkeypatch.setattr(log_index, "embed_texts", embed_texts)
+    return texts_embedded
+
+
+def commit(repo: Repo, name: str) -> str:
+    path = f"{repo.working_tree_dir}/{name}.txt"
+    with open(path, "w") as f:
+        f.write(f"{name}\n")
+    repo.index.add([path])
+    author = Actor("Test", "test@example.com")
+    return repo.index.commit(f"Add {name}", author=author, committer=author).hexsha
+
+
+def test_tips_stay_independent(tmp_path, embedded):
+    repo = Repo.init(tmp_path / "repo")
+    first = commit(repo, "first")
+    second = commit(repo, "second")
+    index_dir = tmp_path / "log"
+    index = LogIndex.open(index_dir)
+    assert index.update(repo, second) == 2
+    segments = sorted(index_dir.iterdir())
+
+    # An older commit has nothing new, so only the tips are checked, and nothing is written
+    assert index.update(repo, first) == 0
+    assert sorted(index_dir.iterdir()) == segments
+    assert index.tips == {second}
+
+    third = commit(repo, "third")
+    assert index.update(repo, third) == 1
+    assert index.tips == {third}
+    assert (index_dir / TIPS_FILE).read_text().split() == [third]
+    reopened = LogIndex.open(index_dir)
+    assert reopened.tips == {third}
+    assert reopened.commits == {first, second, third}
+    embedded.clear()
+    assert reopened.update(repo, third) == 0
+    assert embedded == []
+
+
+def test_missing_tips_are_skipped(tmp_path, embedded):
+    repo = Repo.init(tmp_path / "repo")
+    tip = commit(repo, "first")
+    index = LogIndex.open(tmp_path / "log")
+    index.tips = {"0" * 40, tip}
+    assert index._known_tips(repo) == [tip]
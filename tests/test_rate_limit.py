@@ -0,0 +1,94 @@
+"""
+The rate-limit governor, with its buckets shared between processes through a file.
+"""
+import multiprocessing
+import time
+
+import pytest
+
+from embedit.utils import rate_limit
+from embedit.utils.rate_limit import Governor
+from embedit.utils.rate_limit import capacity
+
+pytestmark = pytest.mark.skipif(rate_limit.fcntl is None, reason="buckets are only shared between processes with fcntl")
+
+SCOPE = "openai.chat:key:model"
+
+
+def observe(path, headers, status=200):
+    Governor(path=path).observe(SCOPE, headers, status=status)
+
+
+def take_for(path, seconds, results):
+    governor = Governor(path=path)
+    taken = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if not governor.take(SCOPE):
+            taken += 1
+    results.put(taken)
+
+
+def run(target, *args):
+    process = multiprocessing.get_context("spawn").Process(target=target, args=args)
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+
+
+def test_observed_limits_are_shared(tmp_path):
+    path = tmp_path / "ratelimit.json"
+    # Another process learns that only one request is left this minute
+    run(observe, path, {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "1"})
+    governor = Governor(path=path)
+    assert governor.take(SCOPE) == 0
+    assert 0 < governor.take(SCOPE) <= rate_limit.MAX_SLEEP
+
+
+def test_retry_after_pauses_every_process(tmp_path):
+    path = tmp_path / "ratelimit.json"
+    run(observe, path, {"retry-after": "30"}, 429)
+    assert Governor(path=path).take(SCOPE) == rate_limit.MAX_SLEEP
+
+
+def test_processes_draw_from_one_bucket(tmp_path):
+    path = tmp_path / "ratelimit.json"
+    # Ten requests a second, and a bucket of ten
+    observe(path, {"x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "10"})
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=take_for, args=(path, 2.0, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    taken = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join(30)
+    # Each process alone would take about 30 (the bucket, then ten a second); together they take about that many
+    assert sum(taken) <= 40
+
+
+def test_configured_limits_stay_in_the_process(tmp_path):
+    path = tmp_path / "ratelimit.json"
+    limited = Governor(path=path, requests_per_minute=60)
+    assert limited.take(SCOPE) == 0
+    assert limited.take(SCOPE) > 0
+    # Another process (or a later run) without the limit isn't held up by it
+    unlimited = Governor(path=path)
+    assert all(unlimited.take(SCOPE) == 0 for _ in range(10))
+    assert '"limit"' not in path.read_text()
+
+
+def test_bucket_makes_room_for_the_largest_request():
+    assert capacity({"limit": 600.0}) == 10.0
+    assert capacity({"limit": 600.0, "largest": 100.0}) == 100.0
+    # But not for more than a minute's worth
+    assert capacity({"limit": 600.0, "largest": 1000.0}) == 600.0
+
+    governor = Governor(path=None, tokens_per_minute=600)
+    # Waits for the bucket to fill up to the request, rather than going through it in debt
+    assert governor.take(SCOPE, tokens=100) > 0
+    bucket = governor._configured[f"{SCOPE}:tokens"]
+    assert bucket["largest"] == 100
+    bucket["updated"] -= 60
+    assert governor.take(SCOPE, tokens=100) == 0
+    assert bucket["available"] >= 0
@@ -0,0 +1,71 @@
+"""
+`transform` against the local stub API, whose completions echo the files they're sent back unchanged.
+"""
+import os
+
+import openai
+import pytest
+
+from embedit.behaviour import openai_tools
+from embedit.behaviour.prompts.transform import default_transform_pre_prompt
+from embedit.behaviour.transform import simple_transform_files
+from embedit.behaviour.transform_manifest import MANIFEST_FILE
+from embedit.behaviour.transform_segments import transform_large_file
+from embedit.utils import rate_limit
+from embedit.utils.stub_server import StubConfig
+from embedit.utils.stub_server import start_stub_server
+
+
+@pytest.fixture(scope="module")
+def stub_api():
+    api_base, co_api_url = openai.api_base, os.environ.get("CO_API_URL")
+    server, base = start_stub_server(StubConfig())
+    openai_tools.configure_api_base(base)
+    yield base
+    server.shutdown()
+    openai.api_base = api_base
+    if co_api_url is None:
+        os.environ.pop("CO_API_URL", None)
+    else:
+        os.environ["CO_API_URL"] = co_api_url
+
+
+@pytest.fixture(autouse=True)
+def isolated(stub_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "stub")
+    # Both are read when their modules are imported
+    monkeypatch.setattr(openai_tools, "CACHE_FILE", tmp_path / "cache.pickle.gz")
+    monkeypatch.setattr(rate_limit, "_governor", rate_limit.Governor(path=None))
+    monkeypatch.chdir(tmp_path)
+
+
+def test_transform_twice_reuses_manifest(tmp_path):
+    source = tmp_path / "hello.py"
+    source.write_text("def hello():\n    return 'hello'\n")
+    output_dir = tmp_path / "out"
+
+    first = simple_transform_files(
+        "hello.py", prompt="Keep it as it is", output_dir=str(output_dir), yes=True, show_diff=False
+    )
+    assert (output_dir / MANIFEST_FILE).exists()
+    assert [result.path for result in first] == ["hello.py"]
+    assert (output_dir / "hello.py").read_text().rstrip("\n") == source.read_text().rstrip("\n")
+
+    # Unchanged, so the output comes from the manifest, and is already saved
+    second = simple_transform_files(
+        "hello.py", prompt="Keep it as it is", output_dir=str(output_dir), yes=True, show_diff=False
+    )
+    assert second == []
+    assert (output_dir / "hello.py").read_text().rstrip("\n") == source.read_text().rstrip("\n")
+
+
+def test_transform_large_file_in_segments(tmp_path):
+    source = tmp_path / "large.py"
+    source.write_text("".join(f"def function_{i}():\n    return {i}\n\n\n" for i in range(60)))
+
+    result = transform_large_file(
+        "large.py", model="gpt-3.5-turbo", pre_prompt=default_transform_pre_prompt, prompt="Keep it", max_tokens=100
+    )
+    assert result.path == "large.py"
+    assert not result.partial
+    assert result.text.rstrip("\n") == source.read_text().rstrip("\n")
@@ -0,0 +1,57 @@
+"""
+The inotify watcher when directories can't be watched.
+"""
+import ctypes
+import errno
+import sys
+import threading
+
+import pytest
+
+from embedit.utils import watch as watch_module
+from embedit.utils.watch import InotifyWatcher
+from embedit.utils.watch import PollingWatcher
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+def failing_add_watch(error: int):
+    def add_watch(fd, path, mask):
+        ctypes.set_errno(error)
+        return -1
+
+    return add_watch
+
+
+@pytest.mark.parametrize("error", [errno.ENOENT, errno.ENOTDIR])
+def test_directory_gone_before_it_is_watched(tmp_path, error):
+    watcher = InotifyWatcher([tmp_path])
+    try:
+        watched = dict(watcher.directories)
+        watcher._add_watch = failing_add_watch(error)
+        (tmp_path / "build").mkdir()
+        assert watcher.read(timeout=1.0) is None
+        assert watcher.directories == watched
+    finally:
+        watcher.close()
+
+
+def test_watch_limit_falls_back_to_polling(tmp_path, monkeypatch):
+    watchers = []
+
+    def make_watcher(roots, *, poll=False, poll_interval=1.0):
+        watcher = InotifyWatcher(roots)
+        watcher._add_watch = failing_add_watch(errno.ENOSPC)
+        watchers.append(watcher)
+        return watcher
+
+    monkeypatch.setattr(watch_module, "make_watcher", make_watcher)
+    polled = []
+    monkeypatch.setattr(PollingWatcher, "read", lambda self, timeout: polled.append(timeout) or set())
+    batches = watch_module.watch([str(tmp_path)], debounce=0.1)
+    # Made once the watcher is watching
+    threading.Timer(0.5, (tmp_path / "new").mkdir).start()
+    # A rescan, as the new directory couldn't be watched
+    assert next(batches) is None
+    assert polled
+    batches.close()